@@ -24,11 +24,14 @@
 import sys
 sys.dont_write_bytecode = True
 
-from converter import Convert, Tilemap, ConversionError
+from converter import ConversionError, stale_maps
+from converter.output import ImageBatch, convert_and_write, record_maps
+from converter.ir import default_cache_directory
 from pickle import dumps, loads
-from os import getenv, mkdir, listdir, remove
-from os.path import join, normpath, split
-from shutil import copyfile
+from os import getenv
+from os.path import join, normpath, split, realpath, exists
+from threading import Event
+from time import perf_counter
 
 from PySide6.QtCore import *
 from PySide6.QtGui import *
@@ -44,6 +47,47 @@ class Application(QApplication):
         super().__init__(argv)
         self.setApplicationDisplayName("tiled2hva")
 
+###############
+### WORKERS ###
+###############
+class ConversionSignals(QObject):
+    stage = Signal(str, str, float)     # map, stage, seconds
+    finished = Signal(str, str, object) # map, map name, manifest entry
+    failed = Signal(str, str)           # map, error
+
+class ConversionTask(QRunnable):
+    """
+    Converts and writes a single map off the main thread
+    """
+    def __init__(self, map:str, destinations:list[str], nest:bool, options:dict, images:ImageBatch, cancelled:Event):
+        super().__init__()
+        self.map = map
+        self.destinations = destinations
+        self.nest = nest
+        self.options = options
+        self.images = images
+        self.cancelled = cancelled
+        self.signals = ConversionSignals()
+
+    def run(self):
+        try:
+            # Manifests are shared between tasks, so they are recorded on the main thread
+            convert, entry = convert_and_write(self.map, self.destinations, self.nest, self.options, default_cache_directory(), stage=self.stage, images=self.images)
+            self.signals.finished.emit(self.map, convert.map_name, entry)
+        except Exception as e:
+            self.signals.failed.emit(self.map, str(e))
+
+    def stage(self, name:str, function, *args, **kwargs):
+        """
+        Runs one stage of the conversion and reports its time, stopping if cancelled
+        """
+        if self.cancelled.is_set():
+            raise ConversionError("Cancelled")
+        start = perf_counter()
+        result = function(*args, **kwargs)
+        self.signals.stage.emit(self.map, name, perf_counter() - start)
+        return result
+
 ###################
 ### MAIN WINDOW ###
 ###################
@@ -94,6 +138,78 @@ class MainWindow(QMainWindow):
         self.nest = QCheckBox("Nest")
         self.options_layout.addWidget(self.nest)
 
+        self.merge_collisions = QCheckBox("Merge collisions")
+        self.merge_collisions.setToolTip("Merge full tile colliders of each layer into larger shapes")
+        self.options_layout.addWidget(self.merge_collisions)
+        self.prune_tiles = QCheckBox("Prune tiles")
+        self.prune_tiles.setToolTip("Only keep tiles used by the map in the generated tileset")
+        self.options_layout.addWidget(self.prune_tiles)
+        self.atlas = QCheckBox("Pack atlas")
+        self.atlas.setToolTip("Pack the images of every tileset a map uses into a single texture")
+        self.options_layout.addWidget(self.atlas)
+        self.binary = QCheckBox("Binary output")
+        self.binary.setToolTip("Write Godot's binary .res and .scn instead of the text .tres and .tscn")
+        self.options_layout.addWidget(self.binary)
+        self.chunk_size = QSpinBox()
+        self.chunk_size.setRange(0, 1024)
+        self.chunk_size.setSingleStep(16)
+        self.chunk_size.setPrefix("Chunks of ")
+        self.chunk_size.setSuffix(" cells")
+        self.chunk_size.setSpecialValueText("No chunks")
+        self.chunk_size.setToolTip("Split each layer into TileMaps of this many cells square, leaving out empty ones")
+        self.options_layout.addWidget(self.chunk_size)
+        self.object_grid = QSpinBox()
+        self.object_grid.setRange(0, 4096)
+        self.object_grid.setSingleStep(64)
+        self.object_grid.setPrefix("Object grid of ")
+        self.object_grid.setSuffix(" px")
+        self.object_grid.setSpecialValueText("No object grid")
+        self.object_grid.setToolTip("Index zone and point objects by grid cell in the Objects node's metadata")
+        self.options_layout.addWidget(self.object_grid)
+
+        self.force = QCheckBox("Force")
+        self.force.setToolTip("Convert every map, even if unchanged since the last conversion")
+        self.options_layout.addWidget(self.force)
+
+        self.watch = QCheckBox("Watch")
+        self.watch.setToolTip("Reconvert maps when they or their tilesets change")
+        self.watch.toggled.connect(self.toggle_watch)
+        self.options_layout.addWidget(self.watch)
+
+        # Changes are collected until saves settle
+        self.file_watcher = QFileSystemWatcher()
+        self.file_watcher.fileChanged.connect(self.watched_file_changed)
+        self.watch_timer = QTimer()
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(300)
+        self.watch_timer.timeout.connect(self.reconvert_changed)
+        self.changed_files = set()
+        # map -> files it was converted from
+        self.map_inputs = {}
+
+        # PROGRESS
+        self.progress_box = QGroupBox("Progress")
+        self.progress_box_layout = QVBoxLayout()
+        self.progress_box.setLayout(self.progress_box_layout)
+        self.options_layout.addWidget(self.progress_box)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+        self.progress_box_layout.addWidget(self.progress_bar)
+
+        self.progress_log = QListWidget()
+        self.progress_box_layout.addWidget(self.progress_log)
+
+        self.cancel = QPushButton("Cancel")
+        self.cancel.setEnabled(False)
+        self.cancel.clicked.connect(self.cancel_conversion)
+        self.progress_box_layout.addWidget(self.cancel)
+
+        self.thread_pool = QThreadPool.globalInstance()
+        self.cancelled = Event()
+        self.tasks = []
+        self.manifest_entries = []
+
         # DESTINATIONS
         self.destination_box = QGroupBox()
         self.destination_box_layout = QGridLayout()
@@ -117,6 +233,8 @@ class MainWindow(QMainWindow):
         selected_file_path:str = QFileDialog.getOpenFileName(self, "Open File", "C:\\", "Tilemap files (*.tmx)")[0]
         if selected_file_path:
             self.map_list.addItem(selected_file_path)
+            if self.watch.isChecked():
+                self.watch_map(selected_file_path)
 
     def remove_map_item(self):
         self.map_list.takeItem(self.map_list.currentRow())
@@ -150,37 +268,132 @@ class MainWindow(QMainWindow):
             )
             return
 
-        for map_id in range(0, self.map_list.count()):
-            for destination_id in range(0, self.destination_list.count()):
-                map = self.map_list.item(map_id).text()
-
-                tilemap = Tilemap(map)
-                convert = Convert(tilemap)
-                map_name = f"{tilemap.mode}_{tilemap.name}"
-                # path to destination folder
-                full_destination = normpath(join(
-                    self.destination_list.item(destination_id).text(), # grab item path from qlist
-                    f"{map_name}/" if self.nest.isChecked() else "" # grab name
-                ))
-
-                try:
-                    mkdir(full_destination)
-                except FileExistsError as e:
-                    if self.nest.isChecked():    
-                        for file in listdir(full_destination):
-                            remove(join(full_destination, file))
-
-
-                with open(join(full_destination, f"{map_name}.tres"), "w+") as file:
-                    file.write(convert.tres)
-
-                with open(join(full_destination, f"{map_name}.tscn"), "w+") as file:
-                    file.write(convert.tscn)
-
-                for image in convert.images:
-                    origin = join(split(map)[0], image)
-                    img_destination = join(full_destination, image)
-                    copyfile(origin, img_destination)
+        self.start_conversion(self.list_maps())
+
+    def list_maps(self) -> list[str]:
+        return [self.map_list.item(map_id).text() for map_id in range(0, self.map_list.count())]
+
+    def start_conversion(self, maps:list[str]):
+        self.destinations = [self.destination_list.item(destination_id).text() for destination_id in range(0, self.destination_list.count())]
+
+        # Skip maps whose inputs are unchanged
+        self.progress_log.clear()
+        if not self.force.isChecked():
+            maps = stale_maps(maps, self.destinations, self.nest.isChecked(), self.convert_options())
+        if not maps:
+            self.progress_log.addItem("All maps are up to date")
+            return
+
+        # Convert maps concurrently on the thread pool
+        self.convert.setEnabled(False)
+        self.cancel.setEnabled(True)
+        self.progress_bar.setRange(0, len(maps))
+        self.progress_bar.setValue(0)
+        self.cancelled.clear()
+        self.manifest_entries = []
+        # Maps sharing an image sync it once
+        self.images = ImageBatch()
+
+        self.tasks = [ConversionTask(map, self.destinations, self.nest.isChecked(), self.convert_options(), self.images, self.cancelled) for map in maps]
+        for task in self.tasks:
+            task.signals.stage.connect(self.conversion_stage)
+            task.signals.finished.connect(self.conversion_finished)
+            task.signals.failed.connect(self.conversion_failed)
+            self.thread_pool.start(task)
+
+    def convert_options(self) -> dict:
+        # Convert keyword arguments from the options panel
+        return {
+            "merge_collisions": self.merge_collisions.isChecked(),
+            "prune_tiles": self.prune_tiles.isChecked(),
+            "atlas": self.atlas.isChecked(),
+            "binary": self.binary.isChecked(),
+            "chunk_size": self.chunk_size.value(),
+            "object_grid": self.object_grid.value(),
+        }
+
+    def cancel_conversion(self):
+        # Running tasks stop after their current stage, queued tasks stop immediately
+        self.cancelled.set()
+        self.cancel.setEnabled(False)
+        self.progress_log.addItem("Cancelling...")
+
+    def conversion_stage(self, map:str, stage:str, seconds:float):
+        self.progress_log.addItem(f"{split(map)[1]}: {stage} {seconds:.2f}s")
+        self.progress_log.scrollToBottom()
+
+    def conversion_finished(self, map:str, map_name:str, manifest_entry:dict):
+        # Maps saved while converting stay out of date, and are picked up again when watching
+        if manifest_entry is None:
+            self.progress_log.addItem(f"{split(map)[1]}: converted to {map_name}, but its inputs changed while converting")
+            self.conversion_step()
+            return
+
+        self.manifest_entries.append(manifest_entry)
+        self.map_inputs[map] = list(manifest_entry["inputs"])
+        if self.watch.isChecked():
+            self.watch_map(map)
+        self.progress_log.addItem(f"{split(map)[1]}: converted to {map_name}")
+        self.conversion_step()
+
+    def conversion_failed(self, map:str, error:str):
+        self.progress_log.addItem(f"{split(map)[1]}: {error}")
+        self.conversion_step()
+
+    def conversion_step(self):
+        self.progress_bar.setValue(self.progress_bar.value() + 1)
+        self.progress_log.scrollToBottom()
+        if self.progress_bar.value() < self.progress_bar.maximum():
+            return
+
+        # Record converted maps once every task is done
+        record_maps(self.destinations, self.manifest_entries)
+        self.images.close()
+
+        self.progress_log.addItem(f"Converted {len(self.manifest_entries)}/{len(self.tasks)} maps")
+        self.progress_log.scrollToBottom()
+        self.tasks = []
+        self.convert.setEnabled(True)
+        self.cancel.setEnabled(False)
+
+        # Pick up changes made while converting
+        if self.changed_files:
+            self.watch_timer.start()
+
+    def toggle_watch(self, checked:bool):
+        if checked:
+            for map in self.list_maps():
+                self.watch_map(map)
+        elif self.file_watcher.files():
+            self.file_watcher.removePaths(self.file_watcher.files())
+            self.changed_files.clear()
+
+    def watch_map(self, map:str):
+        watched = self.file_watcher.files()
+        for path in [realpath(map)] + self.map_inputs.get(map, []):
+            if path not in watched and exists(path):
+                self.file_watcher.addPath(path)
+
+    def watched_file_changed(self, path:str):
+        self.changed_files.add(realpath(path))
+        # Files saved by replacing them are dropped from the watcher
+        if path not in self.file_watcher.files() and exists(path):
+            self.file_watcher.addPath(path)
+        # Restart debounce
+        self.watch_timer.start()
+
+    def reconvert_changed(self):
+        # Wait for the running conversion
+        if self.tasks or self.destination_list.count() < 1:
+            return
+
+        changed_maps = [
+            map for map in self.list_maps()
+            if realpath(map) in self.changed_files or self.changed_files.intersection(self.map_inputs.get(map, []))
+        ]
+        self.changed_files.clear()
+        if changed_maps:
+            self.start_conversion(changed_maps)
             
 
 ### RUN
@@ -1 +1,4 @@
-from converter.core import Convert, ConversionError, Tilemap
\ No newline at end of file
+from converter.core import Convert, ConversionError, Tilemap
+from converter.output import write_maps, stale_maps
+from converter.instrument import Observer, Profile, add_observer, remove_observer
+from converter.ir import MapIR, load_tilemap
\ No newline at end of file
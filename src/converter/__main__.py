@@ -0,0 +1,176 @@
+# tiled2hva CLI
+# Converts Tiled .tmx files to Godot .tscn for High Velocity Arena without the UI
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import pstats
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from tempfile import mkstemp
+from os import cpu_count, close, remove
+from os.path import realpath
+from time import perf_counter
+
+from converter.output import Manifest, PendingImages, convert_and_write, convert_batch
+from converter.instrument import Profile, Recorder, format_report
+from converter.watch import Watcher
+from converter.ir import default_cache_directory
+
+### WORKER
+def convert_map(map:str, destinations:list[str], nest:bool, options:dict, profile:bool=False, cache_directory:str=None) -> dict:  #type:ignore
+    """
+    Converts a single map with the given Convert options and writes it to every destination
+    Maps are read through the IR cache unless cache_directory is None
+    Returns the map name, time taken, manifest entry, images left to sync and, when profiling, the profile results
+    """
+    if not profile:
+        return write_map(map, destinations, nest, options, cache_directory)
+
+    with Profile(cprofile=True, memory=True) as map_profile:
+        result = write_map(map, destinations, nest, options, cache_directory)
+
+    # Profiler stats are handed back through a file, as they can't be pickled
+    descriptor, stats_path = mkstemp(suffix=".prof")
+    close(descriptor)
+    map_profile.profiler.dump_stats(stats_path)  #type:ignore
+    return {**result, "profile": {**map_profile.results(), "stats_path": stats_path}}
+
+def write_map(map:str, destinations:list[str], nest:bool, options:dict, cache_directory:str=None) -> dict:  #type:ignore
+    start = perf_counter()
+    # Manifests and images are shared between workers, so they are recorded and synced by the main process
+    images = PendingImages()
+    convert, entry = convert_and_write(map, destinations, nest, options, cache_directory, images=images)
+    return {"map_name": convert.map_name, "seconds": perf_counter() - start, "entry": entry, "images": images.images}
+
+### ARGUMENTS
+def find_maps(patterns:list[str]) -> list[str]:
+    """
+    Expands globs into a list of unique .tmx paths, keeping their order
+    """
+    maps = []
+    for pattern in patterns:
+        for map in sorted(glob(pattern, recursive=True)) or [pattern]:
+            if map not in maps:
+                maps.append(map)
+    return maps
+
+def parse_args(argv:list[str]):
+    parser = ArgumentParser(prog="python -m converter", description="Converts Tiled .tmx files to Godot .tscn for High Velocity Arena")
+    parser.add_argument("maps", nargs="+", help="tilemap files or globs, e.g. maps/**/*.tmx")
+    parser.add_argument("-d", "--destination", action="append", required=True, help="destination folder, may be given more than once")
+    parser.add_argument("-n", "--nest", action="store_true", help="write each map into its own folder")
+    parser.add_argument("-m", "--merge-collisions", action="store_true", help="merge full tile colliders of each layer into larger shapes")
+    parser.add_argument("-t", "--prune-tiles", action="store_true", help="only keep tiles used by the map in the generated tileset")
+    parser.add_argument("-a", "--atlas", action="store_true", help="pack the images of every tileset a map uses into a single texture")
+    parser.add_argument("-b", "--binary", action="store_true", help="write Godot's binary .res and .scn instead of the text .tres and .tscn")
+    parser.add_argument("-c", "--chunk-size", type=int, default=0, metavar="CELLS", help="split each layer into TileMaps of CELLS by CELLS cells, e.g. 64 (default: no chunks)")
+    parser.add_argument("-g", "--object-grid", type=int, default=0, metavar="PIXELS", help="index zone and point objects by PIXELS sized cells in the Objects node's metadata (default: no grid)")
+    parser.add_argument("-f", "--force", action="store_true", help="convert every map, even if up to date")
+    parser.add_argument("-w", "--watch", action="store_true", help="keep running, reconverting maps when they or their tilesets change")
+    parser.add_argument("-p", "--profile", metavar="REPORT", help="write a report of stage timings, counters, peak memory and cProfile stats")
+    parser.add_argument("--cache-dir", default=default_cache_directory(), help="where parsed maps and atlases are cached (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="always parse maps from their .tmx")
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count(), help="maps to convert in parallel (default: cpu count)")
+    return parser.parse_args(argv)
+
+def convert_options(args) -> dict:
+    """
+    Convert keyword arguments from the command line
+    """
+    return {"merge_collisions": args.merge_collisions, "prune_tiles": args.prune_tiles, "atlas": args.atlas, "binary": args.binary, "chunk_size": args.chunk_size, "object_grid": args.object_grid}
+
+### BATCH
+def run_batch(executor:ProcessPoolExecutor, maps:list[str], args, force:bool=False) -> tuple[int, dict]:
+    """
+    Converts stale maps on the pool and records them, returning the failure count and manifest entries by map
+    """
+    recorder = Recorder()
+    stats = None
+    peak_bytes = 0
+
+    def submit(map:str, images):
+        return executor.submit(convert_map, map, args.destination, args.nest, options, bool(args.profile), None if args.no_cache else args.cache_dir)
+
+    def report(result:dict):
+        nonlocal stats, peak_bytes
+        if "error" in result:
+            print(f"{result['map']}: {result['error']}", file=sys.stderr)
+            return
+        note = ", but its inputs changed while converting so it stays out of date" if result.get("changed") else ""
+        print(f"{result['map']} -> {result['map_name']} ({result['seconds']:.2f}s){note}")
+
+        # Merge worker profiles
+        profile = result.get("profile")
+        if profile:
+            recorder.merge(profile)
+            peak_bytes = max(peak_bytes, profile["peak_bytes"])
+            if stats:
+                stats.add(profile["stats_path"])
+            else:
+                stats = pstats.Stats(profile["stats_path"])
+            remove(profile["stats_path"])
+
+    start = perf_counter()
+    options = convert_options(args)
+    up_to_date, results, entries = convert_batch(maps, args.destination, args.nest, options, submit, force, report)
+    for map in up_to_date:
+        print(f"{map} is up to date")
+
+    if args.profile:
+        with open(args.profile, "w") as file:
+            file.write(format_report({**recorder.results(), "peak_bytes": peak_bytes}, stats))  #type:ignore
+        print(f"Profile written to {args.profile}")
+
+    failed = len([result for result in results if "error" in result])
+    print(f"Converted {len(results) - failed}/{len(results)} maps in {perf_counter() - start:.2f}s, {len(up_to_date)} up to date")
+    return failed, entries
+
+### RUN
+def main(argv:list[str]=None) -> int:  #type:ignore
+    args = parse_args(argv)
+    maps = find_maps(args.maps)
+
+    # Workers are kept between batches, so their parsed Tilesets are reused while watching
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        failed, entries = run_batch(executor, maps, args, args.force)
+        if not args.watch:
+            return 1 if failed else 0
+
+        # Watch every map along with the tilesets and images it was converted from
+        watcher = Watcher()
+        for map in maps:
+            entry = entries.get(map) or Manifest(args.destination[0]).maps.get(realpath(map))
+            watcher.watch(map, list(entry["inputs"]) if entry else None)
+
+        print("Watching for changes, press Ctrl+C to stop")
+        try:
+            while True:
+                changed_maps = watcher.wait()
+                failed, entries = run_batch(executor, changed_maps, args)
+                for map, entry in entries.items():
+                    watcher.watch(map, list(entry["inputs"]))
+        except KeyboardInterrupt:
+            return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# tiled2hva API
+# Packs the tileset images of a map into a single texture
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+from hashlib import sha1
+from math import ceil, sqrt
+from os import getpid, makedirs, replace
+from os.path import join, exists
+from threading import get_ident
+
+from converter.core import throw
+from converter.instrument import span, count
+from converter.output import file_hash
+
+# Bump whenever the packing below changes
+ATLAS_FORMAT = 1
+
+# Largest texture Godot imports
+MAX_SIZE = 16384
+
+class Atlas:
+    """
+    A packed texture in the cache folder, with the top left corner of each packed image by its path
+    """
+    def __init__(self, path:str, size:tuple[int, int], offsets:dict[str, tuple[int, int]]) -> None:
+        self.path = path
+        self.size = size
+        self.offsets = offsets
+
+def pack_atlas(images:list[str], cache_directory:str) -> Atlas:
+    """
+    Packs images into one texture, reusing the cached atlas when the images' contents are unchanged
+    Offsets are keyed by image path, identical images share one spot
+    """
+    with span("atlas_hash"):
+        hashes = [file_hash(image) for image in images]
+    key = sha1(f"{ATLAS_FORMAT}:{','.join(hashes)}".encode()).hexdigest()
+    path = join(cache_directory, f"{key}.png")
+    layout_path = join(cache_directory, f"{key}.json")
+
+    # Reuse cache
+    if exists(path) and exists(layout_path):
+        try:
+            with open(layout_path, "r") as file:
+                layout = json.load(file)
+            count("atlas_hits")
+            # Offsets are stored in the same order as the images the key was made from
+            return Atlas(path, tuple(layout["size"]), {image: tuple(offset) for image, offset in zip(images, layout["offsets"])})  #type:ignore
+        except (OSError, ValueError, KeyError):
+            pass
+
+    with span("atlas_pack"):
+        # Imported lazily, so the converter runs without Qt unless atlases are used
+        try:
+            from PySide6.QtGui import QImage, QPainter
+        except ImportError:
+            throw("Packing atlases requires the PySide6 package")
+
+        # Only load each distinct image once
+        unique_images = {}
+        for image, image_hash in zip(images, hashes):
+            if image_hash not in unique_images:
+                loaded = QImage(image)  #type:ignore
+                if loaded.isNull():
+                    throw(f"Image \"{image}\" cannot be loaded")
+                unique_images[image_hash] = loaded
+
+        size, placements = shelf_pack({image_hash: (image.width(), image.height()) for image_hash, image in unique_images.items()})
+        if size[0] > MAX_SIZE or size[1] > MAX_SIZE:
+            throw(f"Atlas of {size[0]}x{size[1]} is larger than Godot's {MAX_SIZE}x{MAX_SIZE} texture limit")
+
+        atlas = QImage(size[0], size[1], QImage.Format.Format_RGBA8888)  #type:ignore
+        atlas.fill(0)
+        painter = QPainter(atlas)  #type:ignore
+        # Copy pixels as they are, instead of blending onto the transparent background
+        painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)  #type:ignore
+        for image_hash, image in unique_images.items():
+            painter.drawImage(*placements[image_hash], image)
+        painter.end()
+
+        # Write then swap, so an interrupted or concurrent pack never leaves a broken atlas
+        makedirs(cache_directory, exist_ok=True)
+        temp_suffix = f".{getpid()}.{get_ident()}.tmp"
+        if not atlas.save(path + temp_suffix, "PNG"):
+            throw(f"Atlas cannot be written to \"{cache_directory}\"")
+        replace(path + temp_suffix, path)
+
+        offsets = [placements[image_hash] for image_hash in hashes]
+        with open(layout_path + temp_suffix, "w") as file:
+            json.dump({"size": size, "offsets": offsets}, file)
+        replace(layout_path + temp_suffix, layout_path)
+
+    count("atlas_misses")
+    return Atlas(path, size, {image: tuple(offset) for image, offset in zip(images, offsets)})
+
+def shelf_pack(sizes:dict) -> tuple[tuple[int, int], dict]:
+    """
+    Places rectangles on rows, tallest first, aiming for a roughly square result
+    Returns the total size and the top left corner of each rectangle
+    """
+    area = sum([width * height for width, height in sizes.values()])
+    row_width = max(max([width for width, height in sizes.values()]), ceil(sqrt(area)))
+
+    placements = {}
+    x = y = row_height = width = 0
+    for key, (rect_width, rect_height) in sorted(sizes.items(), key=lambda item: (-item[1][1], -item[1][0])):
+        # Start a new row once this one is full
+        if x + rect_width > row_width:
+            y += row_height
+            x = row_height = 0
+        placements[key] = (x, y)
+        x += rect_width
+        width = max(width, x)
+        row_height = max(row_height, rect_height)
+
+    return (width, y + row_height), placements
@@ -0,0 +1,269 @@
+# tiled2hva API
+# Benchmarks the converter on generated maps
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import platform
+import sys
+import tracemalloc
+import zlib
+from argparse import ArgumentParser
+from base64 import b64encode
+from os import devnull, makedirs
+from os.path import join
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+
+from converter.core import Convert, Tilemap, TiledUtil, VERSION
+
+# Preset scenarios, each overriding GENERATOR_DEFAULTS
+PRESETS = {
+    "small":  {"width": 64,  "height": 64},
+    "medium": {"width": 256, "height": 256, "layers": 3},
+    "arena":  {"width": 512, "height": 512, "layers": 4, "tilesets": 4, "objects": 64},
+}
+
+GENERATOR_DEFAULTS = {
+    "width": 64,
+    "height": 64,
+    "layers": 2,
+    "tilesets": 2,
+    "tiles": 256,          # tiles per tileset
+    "density": 0.4,        # share of filled cells
+    "flip_ratio": 0.1,     # share of filled cells with flip flags
+    "shapes": 1,           # collision shapes per tile
+    "shape_ratio": 0.25,   # share of tiles with collision shapes
+    "objects": 16,
+    "encoding": "csv",     # csv or zlib
+    "seed": 0,
+}
+
+### GENERATOR
+def generate_map(directory:str, **options) -> str:
+    """
+    Writes a synthetic .tmx with its .tsx files and images to a directory, returning the .tmx path
+    """
+    options = {**GENERATOR_DEFAULTS, **options}
+    random = Random(options["seed"])
+    makedirs(directory, exist_ok=True)
+    width, height = options["width"], options["height"]
+    columns = 16
+
+    # Tilesets
+    tileset_elements = []
+    for set_id in range(options["tilesets"]):
+        tiles = []
+        for tile_id in range(options["tiles"]):
+            if random.random() >= options["shape_ratio"]:
+                continue
+            objects = []
+            for object_id in range(options["shapes"]):
+                if object_id % 2:
+                    objects.append(f'<object id="{object_id + 1}" x="0" y="0"><polygon points="0,0 16,0 8,16"/></object>')
+                else:
+                    objects.append(f'<object id="{object_id + 1}" x="0" y="0" width="16" height="16"/>')
+            tiles.append(f' <tile id="{tile_id}">\n  <objectgroup draworder="index">{"".join(objects)}</objectgroup>\n </tile>\n')
+
+        with open(join(directory, f"set_{set_id}.tsx"), "w") as file:
+            file.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<tileset version="1.9" name="set_{set_id}" tilewidth="16" tileheight="16" tilecount="{options["tiles"]}" columns="{columns}">\n'
+                f' <image source="set_{set_id}.png" width="{columns * 16}" height="{-(-options["tiles"] // columns) * 16}"/>\n'
+                f'{"".join(tiles)}</tileset>\n'
+            )
+        with open(join(directory, f"set_{set_id}.png"), "wb") as file:
+            file.write(bytes(random.getrandbits(8) for _ in range(1024)))
+        tileset_elements.append(f' <tileset firstgid="{set_id * options["tiles"] + 1}" source="set_{set_id}.tsx"/>\n')
+
+    # Layers
+    generator = np.random.default_rng(options["seed"])
+    gid_count = options["tilesets"] * options["tiles"]
+    layer_elements = []
+    for layer_id in range(options["layers"]):
+        gids = generator.integers(1, gid_count + 1, size=(height, width), dtype=np.uint32)
+        flags = generator.integers(1, 8, size=(height, width), dtype=np.uint32) << 29
+        gids |= np.where(generator.random((height, width)) < options["flip_ratio"], flags, 0).astype(np.uint32)
+        gids[generator.random((height, width)) >= options["density"]] = 0
+
+        if options["encoding"] == "zlib":
+            data = f'<data encoding="base64" compression="zlib">\n   {b64encode(zlib.compress(gids.astype("<u4").tobytes())).decode()}\n  </data>'
+        else:
+            rows = ",\n".join([",".join(map(str, row)) for row in gids.tolist()])
+            data = f'<data encoding="csv">\n{rows}\n</data>'
+        layer_elements.append(f' <layer id="{layer_id + 1}" name="Layer {layer_id}" width="{width}" height="{height}">\n  {data}\n </layer>\n')
+
+    # Objects
+    objects = []
+    types = ["zone", "point", "spawn", "hill"]
+    for object_id in range(options["objects"]):
+        x, y = random.randrange(width * 16), random.randrange(height * 16)
+        properties = f'<properties><property name="type" value="{types[object_id % len(types)]}"/><property name="team" value="offense"/></properties>'
+        if object_id % 2:
+            objects.append(f'  <object id="{object_id + 1}" x="{x}" y="{y}">{properties}<polygon points="0,0 32,0 32,32 0,32"/></object>\n')
+        else:
+            objects.append(f'  <object id="{object_id + 1}" x="{x}" y="{y}" width="32" height="32">{properties}</object>\n')
+
+    filepath = join(directory, "benchmark.tmx")
+    with open(filepath, "w") as file:
+        file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<map version="1.9" orientation="orthogonal" renderorder="right-down" width="{width}" height="{height}" tilewidth="16" tileheight="16" infinite="0">\n'
+            ' <properties>\n  <property name="hva:mode" value="koth"/>\n  <property name="hva:name" value="Benchmark"/>\n </properties>\n'
+            f'{"".join(tileset_elements)}{"".join(layer_elements)}'
+            f' <objectgroup id="{options["layers"] + 1}" name="Objects">\n{"".join(objects)} </objectgroup>\n'
+            '</map>\n'
+        )
+    return filepath
+
+### STAGES
+def stage_parse(filepath:str) -> tuple:
+    """
+    Reads the header and every layer's raw gids
+    """
+    tilemap = Tilemap(filepath)
+    gids = []
+    for event, element in TiledUtil.iter_children(filepath):
+        if event == "end" and element.tag == "layer":
+            data = element.find("data")
+            gids.append(TiledUtil.data_to_gids(data.text, data.attrib, (int(element.attrib["height"]), int(element.attrib["width"])), element.attrib["name"]))  #type:ignore
+    return tilemap, gids
+
+def stage_decode(tilemap:Tilemap, gids:list) -> None:
+    for layer_gids in gids:
+        TiledUtil.gids_to_tiles(layer_gids, tilemap.tileset_list)
+
+def stage_tres(tilemap:Tilemap) -> None:
+    with open(devnull, "w") as file:
+        Convert(tilemap, stream=True).generate_tres(file)
+
+def stage_tscn(tilemap:Tilemap) -> None:
+    """
+    Generates the tscn, which streams and decodes every layer again
+    """
+    with open(devnull, "w") as file:
+        Convert(tilemap, stream=True).generate_tscn(file)
+
+def stage_res(tilemap:Tilemap) -> None:
+    with open(devnull, "wb") as file:
+        Convert(tilemap, stream=True, binary=True).generate_res(file)
+
+def stage_scn(tilemap:Tilemap) -> None:
+    """
+    Generates the binary scn, writing tile data without formatting it as text
+    """
+    with open(devnull, "wb") as file:
+        Convert(tilemap, stream=True, binary=True).generate_scn(file)
+
+def measure(function, *args, repeat:int=3) -> dict:
+    """
+    Times the best of several runs, then measures peak memory over one more run
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function(*args)
+        seconds.append(perf_counter() - start)
+
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"seconds": min(seconds), "peak_bytes": peak}
+
+### BENCHMARK
+def run_scenario(options:dict, repeat:int=3) -> dict:
+    """
+    Generates a map and measures each converter stage on it
+    """
+    with TemporaryDirectory() as directory:
+        filepath = generate_map(directory, **options)
+        tilemap, gids = stage_parse(filepath)
+        return {
+            "options": {**GENERATOR_DEFAULTS, **options},
+            "stages": {
+                "parse": measure(stage_parse, filepath, repeat=repeat),
+                "decode": measure(stage_decode, tilemap, gids, repeat=repeat),
+                "tres": measure(stage_tres, tilemap, repeat=repeat),
+                "tscn": measure(stage_tscn, tilemap, repeat=repeat),
+                "res": measure(stage_res, tilemap, repeat=repeat),
+                "scn": measure(stage_scn, tilemap, repeat=repeat),
+            }
+        }
+
+def compare(results:dict, baseline:dict) -> None:
+    """
+    Prints the change of each stage against earlier results
+    """
+    for name, scenario in results["scenarios"].items():
+        baseline_scenario = baseline["scenarios"].get(name)
+        if not baseline_scenario:
+            continue
+        for stage, result in scenario["stages"].items():
+            before = baseline_scenario["stages"].get(stage)
+            if not before or not before["seconds"]:
+                continue
+            print(f"{name:>8} {stage:>7} {result['seconds'] / before['seconds']:6.2f}x time  {result['peak_bytes'] / max(before['peak_bytes'], 1):6.2f}x memory")
+
+def parse_args(argv:list[str]):
+    parser = ArgumentParser(prog="python -m converter.benchmark", description="Benchmarks the converter on generated maps")
+    parser.add_argument("-s", "--scenario", action="append", choices=list(PRESETS), help="preset to run, may be given more than once (default: all)")
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("-c", "--compare", help="compare against earlier JSON results")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs per stage, the best is kept")
+    # Any generator option given replaces the presets with a single custom scenario
+    for option, default in GENERATOR_DEFAULTS.items():
+        parser.add_argument(f"--{option.replace('_', '-')}", type=type(default), dest=option)
+    return parser.parse_args(argv)
+
+def main(argv:list[str]=None) -> int:  #type:ignore
+    args = parse_args(argv)
+
+    custom = {option: getattr(args, option) for option in GENERATOR_DEFAULTS if getattr(args, option) is not None}
+    scenarios = {"custom": custom} if custom else {name: PRESETS[name] for name in args.scenario or PRESETS}
+
+    results = {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scenarios": {}
+    }
+    for name, options in scenarios.items():
+        scenario = run_scenario(options, args.repeat)
+        results["scenarios"][name] = scenario
+        for stage, result in scenario["stages"].items():
+            print(f"{name:>8} {stage:>7} {result['seconds'] * 1000:10.2f}ms {result['peak_bytes'] / 1048576:10.2f}MB")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare(results, json.load(file))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+# tiled2hva API
+# Writes Godot 3 binary resources (.res/.scn)
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+# Binary resource format of Godot 3, loaded by any 3.x release
+MAGIC = b"RSRC"
+FORMAT_VERSION = 3
+ENGINE_VERSION = (3, 0)
+# Format of the _bundled dictionary of a PackedScene
+PACK_VERSION = 2
+
+# Variant type tags
+VARIANT_NIL = 1
+VARIANT_BOOL = 2
+VARIANT_INT = 3
+VARIANT_REAL = 4
+VARIANT_STRING = 5
+VARIANT_VECTOR2 = 10
+VARIANT_RECT2 = 11
+VARIANT_TRANSFORM2D = 18
+VARIANT_COLOR = 20
+VARIANT_OBJECT = 24
+VARIANT_DICTIONARY = 26
+VARIANT_ARRAY = 30
+VARIANT_INT_ARRAY = 32
+VARIANT_STRING_ARRAY = 34
+VARIANT_VECTOR2_ARRAY = 37
+VARIANT_INT64 = 40
+
+OBJECT_EMPTY = 0
+OBJECT_INTERNAL_RESOURCE = 2
+OBJECT_EXTERNAL_RESOURCE_INDEX = 3
+
+### VALUES
+# Godot types without a Python equivalent, matching their text constructors
+class Vector2(NamedTuple):
+    x: float
+    y: float
+
+class Rect2(NamedTuple):
+    x: float
+    y: float
+    width: float
+    height: float
+
+class Transform2D(NamedTuple):
+    xx: float
+    xy: float
+    yx: float
+    yy: float
+    ox: float
+    oy: float
+
+class Color(NamedTuple):
+    r: float
+    g: float
+    b: float
+    a: float
+
+class ExtResource(NamedTuple):
+    id: int
+
+class SubResource(NamedTuple):
+    id: int
+
+class PoolIntArray(NamedTuple):
+    values: np.ndarray
+
+class PoolVector2Array(NamedTuple):
+    values: np.ndarray
+
+class PoolStringArray(NamedTuple):
+    values: list
+
+### ENCODING
+def encode_string(string:str, out:list) -> None:
+    data = string.encode("utf-8") + b"\0"
+    out.append(struct.pack("<I", len(data)))
+    out.append(data)
+
+def template(parts:list) -> bytes:
+    """
+    Joins encoded parts into a template for bytes %, None parts being %b fields to fill in
+    """
+    return b"".join([b"%b" if part is None else part.replace(b"%", b"%%") for part in parts])
+
+def encode_array(values:np.ndarray, dtype:str) -> memoryview:
+    """
+    Views an array as raw little endian bytes, only copying when its type or layout differ
+    """
+    return memoryview(np.ascontiguousarray(values, dtype=dtype)).cast("B")
+
+def encode_variant(value, out:list) -> None:
+    """
+    Appends the binary encoding of a value to out, as bytes or memoryviews
+    """
+    if value is None:
+        out.append(struct.pack("<I", VARIANT_NIL))
+    elif isinstance(value, bool):
+        out.append(struct.pack("<II", VARIANT_BOOL, value))
+    elif isinstance(value, (int, np.integer)):
+        if -0x80000000 <= value <= 0x7FFFFFFF:
+            out.append(struct.pack("<Ii", VARIANT_INT, value))
+        else:
+            out.append(struct.pack("<Iq", VARIANT_INT64, value))
+    elif isinstance(value, float):
+        out.append(struct.pack("<If", VARIANT_REAL, value))
+    elif isinstance(value, str):
+        out.append(struct.pack("<I", VARIANT_STRING))
+        encode_string(value, out)
+    elif isinstance(value, Vector2):
+        out.append(struct.pack("<I2f", VARIANT_VECTOR2, *value))
+    elif isinstance(value, Rect2):
+        out.append(struct.pack("<I4f", VARIANT_RECT2, *value))
+    elif isinstance(value, Transform2D):
+        out.append(struct.pack("<I6f", VARIANT_TRANSFORM2D, *value))
+    elif isinstance(value, Color):
+        out.append(struct.pack("<I4f", VARIANT_COLOR, *value))
+    elif isinstance(value, ExtResource):
+        # Text ids start at 1, binary indices at 0
+        out.append(struct.pack("<III", VARIANT_OBJECT, OBJECT_EXTERNAL_RESOURCE_INDEX, value.id - 1))
+    elif isinstance(value, SubResource):
+        out.append(struct.pack("<III", VARIANT_OBJECT, OBJECT_INTERNAL_RESOURCE, value.id))
+    elif isinstance(value, PoolIntArray):
+        out.append(struct.pack("<II", VARIANT_INT_ARRAY, value.values.size))
+        out.append(encode_array(value.values, "<i4"))
+    elif isinstance(value, PoolVector2Array):
+        out.append(struct.pack("<II", VARIANT_VECTOR2_ARRAY, value.values.size // 2))
+        out.append(encode_array(value.values, "<f4"))
+    elif isinstance(value, PoolStringArray):
+        out.append(struct.pack("<II", VARIANT_STRING_ARRAY, len(value.values)))
+        for string in value.values:
+            encode_string(string, out)
+    elif isinstance(value, dict):
+        out.append(struct.pack("<II", VARIANT_DICTIONARY, len(value)))
+        for key, item in value.items():
+            encode_variant(key, out)
+            encode_variant(item, out)
+    elif isinstance(value, list):
+        out.append(struct.pack("<II", VARIANT_ARRAY, len(value)))
+        for item in value:
+            encode_variant(item, out)
+    else:
+        raise TypeError(f"{type(value).__name__} has no Godot binary encoding")
+
+### RESOURCES
+class ResourceWriter:
+    """
+    Collects external resources, sub resources and properties of a resource, then writes it in Godot's binary format
+    """
+    def __init__(self, type:str) -> None:
+        self.type = type
+        # property name -> packed string table index
+        self.strings = {}
+        # Encoded string table entries, and how many names they hold
+        self.string_table = []
+        self.string_count = 0
+        # (type, value) -> encoding, for values repeated across properties
+        self.encodings = {}
+        # (type, path)
+        self.ext_resources = []
+        # (id, type, properties)
+        self.sub_resources = []
+
+    def ext_resource(self, path:str, type:str) -> ExtResource:
+        self.ext_resources.append((type, path))
+        return ExtResource(len(self.ext_resources))
+
+    def sub_resource(self, type:str, properties:list) -> SubResource:
+        sub_resource = SubResource(len(self.sub_resources) + 1)
+        self.sub_resources.append((sub_resource.id, type, self.encode_properties(properties)))
+        return sub_resource
+
+    def name(self, name:str) -> bytes:
+        """
+        Adds a property name to the string table, returning its encoded index
+        """
+        name_index = self.strings.get(name)
+        if name_index is None:
+            name_index = self.strings[name] = struct.pack("<I", self.string_count)
+            encode_string(name, self.string_table)
+            self.string_count += 1
+        return name_index
+
+    def add_names(self, encoded:bytes, count:int) -> list[bytes]:
+        """
+        Adds count names already encoded as string table entries, returning their encoded indices
+        Only for names known to be new, as they aren't looked up like name does
+        """
+        self.string_table.append(encoded)
+        self.string_count += count
+        return [struct.pack("<I", index) for index in range(self.string_count - count, self.string_count)]
+
+    def encode(self, value) -> bytes:
+        """
+        Encodes a hashable value once, returning the same bytes for every property holding it
+        """
+        encoding = self.encodings.get((type(value), value))
+        if encoding is None:
+            encoded = []
+            encode_variant(value, encoded)
+            encoding = self.encodings[(type(value), value)] = b"".join(encoded)
+        return encoding
+
+    def encode_properties(self, properties:list) -> list:
+        """
+        Encodes (name, value) pairs, adding their names to the string table
+        """
+        out = [struct.pack("<I", len(properties))]
+        for name, value in properties:
+            out.append(self.name(name))
+
+            # Arrays and other mutable values aren't hashable, so are encoded every time
+            try:
+                out.append(self.encode(value))
+            except TypeError:
+                encode_variant(value, out)
+        return out
+
+    def write(self, file, properties:list, path:str="") -> None:
+        """
+        Writes the resource with its main properties to an open binary file
+        """
+        self.write_encoded(file, self.encode_properties(properties), path)
+
+    def write_encoded(self, file, main_properties:list, path:str="") -> None:
+        """
+        Writes the resource with main properties already encoded, as their count followed by name and value encodings
+        """
+        header = [MAGIC, struct.pack("<5I", 0, 0, *ENGINE_VERSION, FORMAT_VERSION)]
+        encode_string(self.type, header)
+        # Import metadata offset, then reserved fields
+        header.append(struct.pack("<Q14I", 0, *[0] * 14))
+
+        header.append(struct.pack("<I", self.string_count))
+        header += self.string_table
+
+        header.append(struct.pack("<I", len(self.ext_resources)))
+        for type, ext_path in self.ext_resources:
+            encode_string(type, header)
+            encode_string(ext_path, header)
+
+        # Resource bodies, sub resources first and the main resource last
+        bodies = []
+        for id, type, encoded_properties in self.sub_resources:
+            body = []
+            encode_string(type, body)
+            bodies.append((f"local://{id}", body + encoded_properties))
+        body = []
+        encode_string(self.type, body)
+        bodies.append((path, body + main_properties))
+
+        # Offsets of each body follow the table of them
+        table = [struct.pack("<I", len(bodies))]
+        for local_path, body in bodies:
+            encode_string(local_path, table)
+            table.append(b"\0" * 8)
+        offset = sum(map(len, header + table))
+        offsets = []
+        for local_path, body in bodies:
+            offsets.append(offset)
+            offset += sum(map(len, body))
+        for index, body_offset in enumerate(offsets):
+            table[3 + index * 3] = struct.pack("<Q", body_offset)
+
+        file.writelines(header + table)
+        for local_path, body in bodies:
+            file.writelines(body)
+        file.write(MAGIC)
+
+class SceneWriter:
+    """
+    Builds the node tree of a PackedScene, which is stored as a single _bundled dictionary
+    """
+    def __init__(self) -> None:
+        self.resource = ResourceWriter("PackedScene")
+        # name -> names index
+        self.names = {}
+        self.variants = []
+        self.nodes = []
+        self.node_count = 0
+
+    def ext_resource(self, path:str, type:str) -> ExtResource:
+        return self.resource.ext_resource(path, type)
+
+    def sub_resource(self, type:str, properties:list) -> SubResource:
+        return self.resource.sub_resource(type, properties)
+
+    def name(self, name:str) -> int:
+        return self.names.setdefault(name, len(self.names))
+
+    def node(self, name:str, type:str, parent:int=-1, properties:list=[]) -> int:
+        """
+        Adds a node under the node at index parent, returning its own index
+        """
+        # parent, owner, type, name, instance, properties, groups
+        self.nodes += [parent, -1 if parent < 0 else 0, self.name(type), self.name(name), -1, len(properties)]
+        for property_name, value in properties:
+            self.nodes += [self.name(property_name), len(self.variants)]
+            self.variants.append(value)
+        self.nodes.append(0)
+
+        self.node_count += 1
+        return self.node_count - 1
+
+    def write(self, file, path:str="") -> None:
+        self.resource.write(file, [("_bundled", {
+            "names": PoolStringArray(list(self.names)),
+            "variants": self.variants,
+            "node_count": self.node_count,
+            "nodes": PoolIntArray(np.array(self.nodes, dtype=np.int32)),
+            "conn_count": 0,
+            "conns": PoolIntArray(np.zeros(0, dtype=np.int32)),
+            "node_paths": [],
+            "editable_instances": [],
+            "version": PACK_VERSION
+        })], path)
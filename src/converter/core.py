@@ -22,7 +22,22 @@
 # SOFTWARE.
 
 import xml.etree.ElementTree as element_tree
-from os.path import join, split, normpath, exists
+import numpy as np
+import re
+import struct
+import zlib
+from mmap import mmap, ACCESS_READ
+from base64 import b64decode
+from functools import lru_cache
+from io import StringIO, BytesIO
+from os import stat
+from os.path import join, split, normpath, exists, realpath
+from time import perf_counter
+from converter.instrument import span, record, count
+from converter import binary
+
+# Bump whenever generated output changes, so previously converted maps are rebuilt
+VERSION = "1.4.0"
 
 ### TILEMAP
 class Tilemap:
@@ -37,125 +52,203 @@ class Tilemap:
         # Check filetype
         if not self.filepath.endswith('.tmx'):
             throw("Tilemap file must be .tmx format")
+
+        # Taken before reading, so a file saved while it's read no longer matches afterwards
+        self.fingerprint = TiledUtil.fingerprint(filepath)
             
         # Parse filepath
         self.filepath = split(self.filepath)
 
-        # Load file
-        self.tree = element_tree.parse(filepath)
-        self.root = self.tree.getroot()
-        
-        # Grab tile size
-        self.tile_size = (
-            int(self.root.attrib["tilewidth"]),
-            int(self.root.attrib["tileheight"])
-        )
+        # Stream header, stopping at the first layer
+        with span("header"):
+            self.properties = None
+            self.tileset_list:list = []
+            for event, element in TiledUtil.iter_children(filepath):
+                # Grab tile size
+                if event == "root":
+                    self.tile_size = (
+                        int(element.attrib["tilewidth"]),
+                        int(element.attrib["tileheight"])
+                    )
+                elif event == "start":
+                    if element.tag in ["layer", "objectgroup"]:
+                        break
 
-        # Trim out editor settings
-        [self.root.remove(element) for element in self.root if element.tag == "editorsettings"]
-
-        # Grab properties
-        properties_element = self.root.find("properties")
-        if properties_element == None:
+                # Grab properties
+                elif element.tag == "properties":
+                    self.properties = {property.attrib["name"]: property.attrib["value"] for property in element}
+
+                # Grab tilesets
+                elif element.tag == "tileset":
+                    # Create Tileset
+                    tileset = Tileset.load(join(self.filepath[0], element.attrib["source"]))
+
+                    self.tileset_list.append((
+                        tileset,
+                        int( element.attrib["firstgid"] ),
+                        # optimized firstgid relative to user-defined tilecount
+                        sum([tileset.tile_count for tileset, fg, ofg in self.tileset_list]),
+                    ))
+
+        if self.properties == None:
             throw(f"No properties found in Tilemap \"{self.file_name}\"")
 
-        self.properties = {property.attrib["name"]: property.attrib["value"] for property in properties_element} #type:ignore
-
-        if not self.properties.get("hva:mode"):
+        if not self.properties.get("hva:mode"):  #type:ignore
             throw(f"Property hva:mode not provided in Tilemap \"{self.filepath[1]}\"")
-        self.mode = self.properties["hva:mode"]
+        self.mode = self.properties["hva:mode"]  #type:ignore
         
-        if not self.properties.get("hva:name"):
+        if not self.properties.get("hva:name"):  #type:ignore
             throw(f"Property hva:name not provided in Tilemap \"{self.filepath[1]}\"")
-        self.name = self.properties["hva:name"]
+        self.name = self.properties["hva:name"]  #type:ignore
+
+        # Filled in while streaming layers
+        self.objects = []
+        self.layer_count = 0
 
-        # Grab tilesets
-        self.tileset_list:list = []
-        for tilemap_set in self.root.findall("tileset"): 
+    def iter_layers(self):
+        """
+        Streams each layer as a (name, tiles) tuple, only holding one layer in memory at a time
+        Object layers are collected into self.objects as they are reached
+        """
+        self.objects = []
+        self.layer_count = 0
 
-            # Create Tileset
-            tileset = Tileset(join(self.filepath[0], tilemap_set.attrib["source"]))
+        parse_start = perf_counter()
+        for event, element in TiledUtil.iter_children(join(*self.filepath)):
+            if event != "end":
+                continue
 
-            self.tileset_list.append((
-                tileset,
-                int( tilemap_set.attrib["firstgid"] ),
-                # optimized firstgid relative to user-defined tilecount
-                sum([tileset.tile_count for tileset, fg, ofg in self.tileset_list]),
-            ))
+            # Grab layers
+            if element.tag == "layer":
+                # Time spent reading the layer's xml
+                record("parse", perf_counter() - parse_start)
+                with span("decode"):
+                    layer = self.read_layer(element)
+                if layer is None:
+                    continue
+                self.layer_count += 1
+                count("layers")
+                yield layer
+                parse_start = perf_counter()
 
-        # Grab layers
-        self.layers = []
-        for layer in self.root.findall("layer"):
+            # Grab object layers
+            elif element.tag == "objectgroup":
+                self.read_objects(element)
 
-            # Convert each tile to an int
-            layer_data = []
+    def read_layer(self, layer:element_tree.Element):
+        """
+        Decodes a layer element to a (name, tiles) tuple
+        """
+        # Strip out all unnecessary tags
+        if layer.find("data") == None:
+            return None
+        xml_layer_data = layer.find("data")
+
+        # Infinite maps store layers as chunks
+        chunks = xml_layer_data.findall("chunk")  #type:ignore
+        if chunks:
+            sparse_layer = SparseLayer()
+            for chunk in chunks:
+                gids = TiledUtil.data_to_gids(
+                    chunk.text,  #type:ignore
+                    xml_layer_data.attrib,  #type:ignore
+                    (int(chunk.attrib["height"]), int(chunk.attrib["width"])),
+                    layer.attrib["name"]
+                )
+                sparse_layer.add_chunk(
+                    int(chunk.attrib["x"]),
+                    int(chunk.attrib["y"]),
+                    TiledUtil.gids_to_tiles(gids, self.tileset_list)
+                )
+                count("tiles", gids.size)
+            return (layer.attrib['name'], sparse_layer)
+
+        # Decode whole layer at once
+        gids = TiledUtil.data_to_gids(
+            xml_layer_data.text,  #type:ignore
+            xml_layer_data.attrib,  #type:ignore
+            (int(layer.attrib["height"]), int(layer.attrib["width"])),
+            layer.attrib["name"]
+        )
+        layer_data = TiledUtil.gids_to_tiles(gids, self.tileset_list)
+        count("tiles", gids.size)
+        return (layer.attrib['name'], layer_data)
 
-            # Strip out all unnecessary tags
-            if layer.find("data") == None:
+    def read_objects(self, layer:element_tree.Element) -> None:
+        """
+        Collects objects of an object layer element into self.objects
+        """
+        for object in layer:
+            # Skip if no properties are provided
+            if not object.find("properties"):
                 continue
-            xml_layer_data = layer.find("data")
-
-            if xml_layer_data.attrib.get("encoding") != "csv":  #type:ignore
-                throw("Tilemaps must be encoded in csv format!")
-
-            # For each row in the layer
-            for row in xml_layer_data.text.strip().split("\n"):  #type:ignore
-                row_data = []
-                # For each tile in the layer
-                for tile in row.split(","):
-                    try:
-                        tile = int(tile)
-                    except:
-                        continue
-
-                    # Convert to byte
-                    tile_byte = (32 - len( f"{tile:b}" )) * "0" + f"{tile:b}"
-
-                    tiled_to_godot_flags = {"000":"000", "101":"-011", "110":"011", "011":"-010", "100":"001", "111":"-001", "010":"010", "001":"-100"}
-                    # Split tile
-                    rotation_value = int( tiled_to_godot_flags[tile_byte[0:3]] + "0" * 29, 2 )
-                    tile_value = int( tile_byte[3:], 2)
-
-                    # Find tile id relative to tileset via firstgid, convert to global id
-                    for tileset, firstgid, optimized_firstgid in self.tileset_list:
-                        if tile_value in range( firstgid, firstgid + tileset.tile_count ):
-                            # original value - firstgid to get tile without tileset
-                            # addition of 1 to includes tile lost when subtracting tile_value ... id 10 - firstgid 5 = 5 left, when 6 is correct because id 5 is included
-                            # add optimized_firstgid to restore set position, and add rotation into tile value
-                            global_tile = tile_value - firstgid + 1 + optimized_firstgid + rotation_value
-                            break
-                        global_tile = 0
-
-                    row_data.append(global_tile)  #type:ignore
-                layer_data.append(row_data)
-            self.layers.append((layer.attrib['name'], layer_data))
-
-        # Grab object layers
-        self.objects = []
-        for layer in self.root.findall("objectgroup"):
-            for object in layer:
-                # Skip if no properties are provided
-                if not object.find("properties"):
-                    continue
 
-                # Grab properties
-                properties = {property.attrib["name"]: property.attrib["value"] for property in object.find("properties")}
-                if not properties.get("stage"):
-                    properties["stage"] = 1
+            # Grab properties
+            properties = {property.attrib["name"]: property.attrib["value"] for property in object.find("properties")}
+            if not properties.get("stage"):
+                properties["stage"] = 1
 
-                # Grab points
-                x = int(object.attrib["x"])
-                y = int(object.attrib["y"])
+            # Grab points
+            x = int(object.attrib["x"])
+            y = int(object.attrib["y"])
 
-                if object.attrib.get("width"):
-                    points = TiledUtil.square_to_points(0, 0, object.attrib)
-                else:
-                    points = TiledUtil.object_to_points(0, 0, object.find("polygon").attrib["points"])
-                
-                # Stache
-                self.objects.append((points, properties, x, y))
+            if object.attrib.get("width"):
+                points = TiledUtil.square_to_points(0, 0, object.attrib)
+                # Rectangles and ellipses become primitive shapes
+                width, height = points[2]
+                shape = ("ellipse" if object.find("ellipse") is not None else "rectangle", width, height)
+            else:
+                points = TiledUtil.object_to_points(0, 0, object.find("polygon").attrib["points"])
+                shape = ("polygon", 0, 0)
+            
+            # Stache
+            self.objects.append((points, properties, x, y, shape))
+
+    def load_objects(self) -> list[tuple]:
+        """
+        Reads object layers without parsing tile layers, for when objects are needed before layers are streamed
+        """
+        self.objects = []
+        for element in TiledUtil.find_children(join(*self.filepath), "objectgroup"):
+            self.read_objects(element)
+        return self.objects
+
+### SPARSE LAYER
+class SparseLayer:
+    """
+    Sparse tile storage for infinite layers, only keeping placed tiles of each chunk
+    """
+    def __init__(self) -> None:
+        # (chunk x, chunk y, cell xs, cell ys, tiles)
+        self.chunks = []
+
+    def add_chunk(self, x:int, y:int, tiles:np.ndarray) -> None:
+        """
+        Stores the placed tiles of a decoded chunk positioned at x, y
+        """
+        cell_ys, cell_xs = np.nonzero(tiles)
+        if not cell_xs.size:
+            return
+        self.chunks.append((
+            x, y,
+            (cell_xs + x).astype(np.int32),
+            (cell_ys + y).astype(np.int32),
+            tiles[cell_ys, cell_xs]
+        ))
+
+    def cells(self) -> tuple:
+        """
+        Returns cell xs, cell ys and tiles of every placed tile
+        """
+        if not self.chunks:
+            empty = np.zeros(0, dtype=np.int32)
+            return empty, empty, empty
+        return tuple(np.concatenate([chunk[i] for chunk in self.chunks]) for i in range(2, 5))
 
 ### TILESET
+# Amount of parsed Tilesets kept in memory
+TILESET_CACHE_SIZE = 64
+
 class Tileset:
 
     def __init__(self, filepath:str) -> None:
@@ -167,9 +260,11 @@ class Tileset:
         # Check filetype
         if not self.filepath.endswith('.tsx'):
             throw("Tileset file must be .tsx format")
+        self.fingerprint = TiledUtil.fingerprint(filepath)
 
         # Load file
-        self.tree = element_tree.parse(filepath)
+        with span("tileset"):
+            self.tree = element_tree.parse(filepath)
         self.root = self.tree.getroot()
         self.name = self.root.attrib["name"]
 
@@ -201,23 +296,44 @@ class Tileset:
         self.shapes = []
         self.object_id = 0
         for tile in self.root.findall("tile"):
-            # TODO deal with concave objects
             objectgroup = tile.find("objectgroup")
             if not objectgroup:
                 continue
 
             for object in objectgroup:
-                self.object_id += 1
-
                 x = int(object.attrib["x"])
                 y = int(object.attrib["y"])
 
                 if "width" in object.attrib:
                     points = TiledUtil.square_to_points(x, y, object.attrib)
+                    parts = [points]
                 else:
                     points = TiledUtil.object_to_points(x, y, object[0].attrib["points"])
+                    # Concave shapes are split into convex parts
+                    parts = TiledUtil.convex_parts(tuple(points))
 
-                self.shapes.append((int(tile.attrib["id"]), self.object_id, points))
+                for part in parts:
+                    self.object_id += 1
+                    self.shapes.append((int(tile.attrib["id"]), self.object_id, list(part)))
+
+    @staticmethod
+    def load(filepath:str) -> "Tileset":
+        """
+        Loads a Tileset through a process-wide cache, only parsing again when the file changes
+        """
+        filepath = realpath(filepath)
+        if not exists(filepath):
+            throw("Tileset file cannot be found")
+        file_stat = stat(filepath)
+        return Tileset.cached(filepath, file_stat.st_mtime_ns, file_stat.st_size)
+
+    @staticmethod
+    @lru_cache(maxsize=TILESET_CACHE_SIZE)
+    def cached(filepath:str, mtime:int, size:int) -> "Tileset":
+        """
+        Parses a Tileset once per path, modification time and size
+        """
+        return Tileset(filepath)
 
 ### UTIL
 class TiledUtil:
@@ -246,137 +362,917 @@ class TiledUtil:
             ))
         return points
 
+    @staticmethod
+    def fingerprint(filepath:str) -> list[int]:
+        """
+        Modification time and size of a file
+        """
+        file_stat = stat(filepath)
+        return [file_stat.st_mtime_ns, file_stat.st_size]
+
+    @staticmethod
+    def iter_children(filepath:str):
+        """
+        Streams a Tiled file as ("root", element) followed by ("start", element) and ("end", element) for each child of the root
+        Children are cleared once handled, so only one is held in memory at a time
+        """
+        depth = 0
+        root = None
+        for event, element in element_tree.iterparse(filepath, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = element
+                    yield "root", element
+                elif depth == 2:
+                    yield "start", element
+            else:
+                depth -= 1
+                if depth == 1:
+                    yield "end", element
+                    root.clear()  #type:ignore
+
+    # Tags, then comments, CDATA, the declaration and other markup, whose contents are skipped
+    XML_MARKUP = re.compile(rb'<(/?)([\w:.-]+)(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>|<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[?!][^>]*>', re.S)
+
+    @staticmethod
+    def find_children(filepath:str, tag:str):
+        """
+        Yields the root's children of a tag as elements, only parsing those children
+        Tags elsewhere are matched without tokenizing the text between them, so layer data is skipped over
+        """
+        tag_bytes = tag.encode()
+        with open(filepath, "rb") as file, mmap(file.fileno(), 0, access=ACCESS_READ) as data:
+            # Children are parsed alone, so are given the file's declaration for its encoding
+            declaration = data[:data.find(b"?>") + 2] if data[:5] == b"<?xml" else b""
+            depth = 0
+            start = None
+            for markup in TiledUtil.XML_MARKUP.finditer(data):  #type:ignore
+                closing, name, empty = markup.group(1, 2, 3)
+                if name is None or empty:
+                    continue
+                if closing:
+                    depth -= 1
+                    if depth == 1 and start is not None:
+                        yield element_tree.fromstring(declaration + data[start:markup.end()])
+                        start = None
+                else:
+                    depth += 1
+                    if depth == 2 and name == tag_bytes:
+                        start = markup.start()
+
+    @staticmethod
+    def cell_keys(xs:np.ndarray, ys:np.ndarray) -> np.ndarray:
+        """
+        Packs cell coordinates into Godot tile_data keys, 16 bits each, allowing negative coordinates
+        """
+        keys = ((ys.astype(np.uint32) & 0xFFFF) << 16) | (xs.astype(np.uint32) & 0xFFFF)
+        return keys.view(np.int32)
+
+    @staticmethod
+    def tile_cells(xs:np.ndarray, ys:np.ndarray, tiles:np.ndarray) -> np.ndarray:
+        """
+        Interleaves placed tiles into the key, tile, 0 triples of a Godot tile_data PoolIntArray
+        """
+        flat_layer = np.zeros((tiles.size, 3), dtype=np.int32)
+        flat_layer[:, 0] = TiledUtil.cell_keys(xs, ys)
+        flat_layer[:, 1] = tiles
+        return flat_layer.ravel()
+
+    @staticmethod
+    def split_chunks(xs:np.ndarray, ys:np.ndarray, tiles:np.ndarray, size:int):
+        """
+        Groups placed tiles into size by size chunks, yielding each chunk's coordinates and its cells relative to it
+        Chunks without tiles are never yielded
+        """
+        if not tiles.size:
+            return
+        chunk_xs, chunk_ys = xs // size, ys // size
+        # Stable, so cells keep their row order within a chunk
+        order = np.lexsort((chunk_xs, chunk_ys))
+        chunk_xs, chunk_ys = chunk_xs[order], chunk_ys[order]
+
+        starts = np.flatnonzero(np.r_[True, (chunk_xs[1:] != chunk_xs[:-1]) | (chunk_ys[1:] != chunk_ys[:-1])])
+        ends = np.r_[starts[1:], order.size]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            cells = order[start:end]
+            chunk_x, chunk_y = int(chunk_xs[start]), int(chunk_ys[start])
+            yield chunk_x, chunk_y, xs[cells] - chunk_x * size, ys[cells] - chunk_y * size, tiles[cells]
+
+    @staticmethod
+    def tile_data(xs:np.ndarray, ys:np.ndarray, tiles:np.ndarray) -> str:
+        """
+        Serializes placed tiles to the contents of a Godot tile_data PoolIntArray
+        """
+        return TiledUtil.format_ints(TiledUtil.tile_cells(xs, ys, tiles))
+
+    # Strings of 0 to 99 and the bytes around each number, as pairs of ascii bytes
+    DIGIT_PAIRS = np.frombuffer("".join([f"{i:02d}" for i in range(100)]).encode(), dtype=np.uint16)
+    SIGN_PAIR = np.frombuffer(b" -", dtype=np.uint16)[0]
+    SEPARATOR_PAIR = np.frombuffer(b", ", dtype=np.uint16)[0]
+    # Smallest number with each digit count above one
+    DIGIT_THRESHOLDS = (10 ** np.arange(1, 10)).astype(np.uint32)
+
+    @staticmethod
+    def format_ints(values:np.ndarray) -> str:
+        """
+        Formats int32 values as ", ".join(map(str, values)) would, without a Python object per value
+        Each value is written right aligned into a fixed width row of bytes, then the padding before it is dropped
+        """
+        if not values.size:
+            return ""
+        # abs of the smallest int32 wraps around, but is still its magnitude as unsigned
+        magnitudes = np.abs(values).view(np.uint32)
+        digit_counts = np.searchsorted(TiledUtil.DIGIT_THRESHOLDS, magnitudes, side="right") + 1
+        pair_count = (int(digit_counts.max()) + 1) // 2
+
+        # Sign, digits two at a time, then separator
+        rows = np.empty((values.size, pair_count + 2), dtype=np.uint16)
+        rows[:, 0] = TiledUtil.SIGN_PAIR
+        remaining = magnitudes
+        for column in range(pair_count, 0, -1):
+            quotient = remaining // 100
+            rows[:, column] = TiledUtil.DIGIT_PAIRS.take(remaining - quotient * 100)
+            remaining = quotient
+        rows[:, -1] = TiledUtil.SEPARATOR_PAIR
+
+        # Bytes kept for each digit count, then again with the sign for negative values
+        width = pair_count * 2
+        patterns = np.arange(width + 4) >= width + 2 - np.arange(width + 1)[:, None]
+        patterns = np.concatenate([patterns, patterns])
+        patterns[:, 0] = False
+        patterns[width + 1:, 1] = True
+        keep = patterns.take(digit_counts + (values < 0) * (width + 1), axis=0)
+
+        # Without the last separator
+        return rows.view(np.uint8)[keep][:-2].tobytes().decode("ascii")
+
+    # Tiled flip flags (H, V, D) to Godot flip flags (transpose, V, H), indexed by the top three gid bits
+    TILED_TO_GODOT_FLAGS = np.array([0b000, 0b100, 0b010, 0b110, 0b001, 0b101, 0b011, 0b111], dtype=np.uint32)
+
+    @staticmethod
+    def cross(origin:tuple, a:tuple, b:tuple) -> int:
+        """
+        Z component of the cross product of origin->a and origin->b
+        """
+        return (a[0] - origin[0]) * (b[1] - origin[1]) - (a[1] - origin[1]) * (b[0] - origin[0])
+
+    @staticmethod
+    def is_convex(points:list[tuple]) -> bool:
+        """
+        Checks a polygon of positive orientation is convex, allowing collinear points
+        """
+        return all([
+            TiledUtil.cross(points[i - 2], points[i - 1], points[i]) >= 0
+            for i in range(len(points))
+        ])
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def convex_parts(points:tuple) -> tuple:
+        """
+        Splits a polygon into as few convex parts as Hertel-Mehlhorn finds, returning convex polygons unchanged
+        Triangulates by ear clipping, then drops every diagonal whose removal keeps both sides convex
+        """
+        # Work in positive orientation, restoring the original orientation at the end
+        area = sum([points[i - 1][0] * points[i][1] - points[i][0] * points[i - 1][1] for i in range(len(points))])
+        oriented = list(points) if area > 0 else list(reversed(points))
+        if len(points) < 4 or TiledUtil.is_convex(oriented):
+            return (points,)
+
+        # Ear clipping, on vertex indices
+        triangles = []
+        remaining = list(range(len(oriented)))
+        while len(remaining) > 3:
+            for i in range(len(remaining)):
+                previous, current, next = remaining[i - 1], remaining[i], remaining[(i + 1) % len(remaining)]
+                a, b, c = oriented[previous], oriented[current], oriented[next]
+                if TiledUtil.cross(a, b, c) <= 0:
+                    continue
+                # An ear holds no other vertex
+                if any([
+                    TiledUtil.cross(a, b, oriented[other]) >= 0 and
+                    TiledUtil.cross(b, c, oriented[other]) >= 0 and
+                    TiledUtil.cross(c, a, oriented[other]) >= 0
+                    for other in remaining if other not in (previous, current, next)
+                ]):
+                    continue
+                triangles.append([previous, current, next])
+                remaining.pop(i)
+                break
+            else:
+                # Degenerate polygon, leave it to Godot
+                return (points,)
+        triangles.append(remaining)
+
+        # Hertel-Mehlhorn, merge parts across shared diagonals while they stay convex
+        parts = triangles
+        merged = True
+        while merged:
+            merged = False
+            for first_id in range(len(parts)):
+                for second_id in range(first_id + 1, len(parts)):
+                    part = TiledUtil.merge_parts(parts[first_id], parts[second_id])
+                    if part and TiledUtil.is_convex([oriented[i] for i in part]):
+                        parts[first_id] = part
+                        parts.pop(second_id)
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        # Drop collinear vertices left behind by removed diagonals
+        convex_parts = []
+        for part in parts:
+            part_points = [oriented[i] for i in part]
+            part_points = [
+                part_points[i] for i in range(len(part_points))
+                if TiledUtil.cross(part_points[i - 1], part_points[i], part_points[(i + 1) % len(part_points)]) != 0
+            ]
+            convex_parts.append(tuple(part_points if area > 0 else reversed(part_points)))
+        return tuple(convex_parts)
+
+    @staticmethod
+    def merge_parts(first:list[int], second:list[int]) -> list[int]:
+        """
+        Joins two polygons of vertex indices along their shared edge, None if they share none
+        """
+        for i in range(len(first)):
+            a, b = first[i], first[(i + 1) % len(first)]
+            # The other side walks the edge the opposite way
+            for j in range(len(second)):
+                if second[j] == b and second[(j + 1) % len(second)] == a:
+                    # first from b around to a, then second from a around to b, without repeating a and b
+                    first_walk = first[i + 1:] + first[:i + 1]
+                    second_walk = second[j + 1:] + second[:j + 1]
+                    return first_walk + second_walk[1:-1]
+        return None  #type:ignore
+
+    @staticmethod
+    def normalize_points(points:list[tuple]) -> tuple:
+        """
+        Rotates a polygon to start at its smallest point, so identical polygons compare equal
+        """
+        points = [tuple(point) for point in points]
+        start = points.index(min(points))
+        return tuple(points[start:] + points[:start])
+
+    @staticmethod
+    def merge_rectangles(xs:np.ndarray, ys:np.ndarray) -> list[tuple]:
+        """
+        Greedily merges the cells at xs, ys into (x, y, width, height) rectangles
+        Runs of each row are extended downward while the next row has the same run
+        """
+        # Runs come from the sorted cells, so nothing spans the gaps of sparse layers
+        order = np.lexsort((xs, ys))
+        xs, ys = xs[order], ys[order]
+        # A run breaks where the row changes or a cell is skipped
+        breaks = np.flatnonzero((ys[1:] != ys[:-1]) | (xs[1:] != xs[:-1] + 1)) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [xs.size])) - 1
+
+        rectangles = []
+        # (x, end x) -> index of rectangle still growing downward
+        open_runs = {}
+        last_row = None
+        for row, x, end_x in zip(ys[starts].tolist(), xs[starts].tolist(), (xs[ends] + 1).tolist()):
+            if row != last_row:
+                # Rectangles not continued on consecutive rows are closed
+                if last_row is None or row != last_row + 1:
+                    open_runs = {}
+                open_runs = {run: index for run, index in open_runs.items() if rectangles[index][1] + rectangles[index][3] == row}
+                last_row = row
+
+            index = open_runs.get((x, end_x))
+            if index is not None:
+                x, y, width, height = rectangles[index]
+                rectangles[index] = (x, y, width, height + 1)
+            else:
+                open_runs[(x, end_x)] = len(rectangles)
+                rectangles.append((x, row, end_x - x, 1))
+        return rectangles
+
+    @staticmethod
+    def csv_to_gids(csv_str:str, shape:tuple, name:str) -> np.ndarray:
+        """
+        Converts csv layer data to a 2D array of raw Tiled gids, checking it holds every cell of the layer named name
+        """
+        # Rows end with a separator, and some exporters end the last row with one too
+        csv_str = csv_str.strip().rstrip(",").replace(",\n", "\n")
+        try:
+            # Parsed in C, rejecting anything but unsigned 32 bit numbers and rows of differing lengths
+            gids = np.loadtxt(StringIO(csv_str), delimiter=",", dtype=np.uint32, ndmin=2)
+        except ValueError as e:
+            throw(f"Tilemap layer \"{name}\" has invalid csv data: {e}")
+        if gids.size != shape[0] * shape[1]:  #type:ignore
+            throw(f"Tilemap layer \"{name}\" has {gids.size} cells instead of {shape[1]}x{shape[0]}")  #type:ignore
+        return gids.reshape(shape)  #type:ignore
+
+    @staticmethod
+    def data_to_gids(data_str:str, data_attrib:dict[str, str], shape:tuple, name:str) -> np.ndarray:
+        """
+        Converts layer or chunk data to a 2D array of raw Tiled gids, using the encoding of the data element
+        """
+        encoding = data_attrib.get("encoding")
+        if encoding == "csv":
+            return TiledUtil.csv_to_gids(data_str, shape, name)
+        elif encoding == "base64":
+            return TiledUtil.base64_to_gids(data_str, data_attrib.get("compression"), shape, name)  #type:ignore
+        throw("Tilemaps must be encoded in csv or base64 format!")
+
+    @staticmethod
+    def base64_to_gids(data_str:str, compression:str, shape:tuple, name:str) -> np.ndarray:
+        """
+        Converts base64 layer data, optionally zlib, gzip or zstd compressed, to a 2D array of raw Tiled gids
+        """
+        data = b64decode(data_str.strip())
+
+        if compression in ["zlib", "gzip"]:
+            # wbits 47 detects either header
+            data = zlib.decompress(data, 47)
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                throw("Tilemaps compressed with zstd require the zstandard package")
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)  #type:ignore
+        elif compression:
+            throw(f"Unsupported Tilemap compression \"{compression}\"")
+
+        # Tiled stores gids as little-endian unsigned 32 bit ints
+        if len(data) != shape[0] * shape[1] * 4:
+            throw(f"Tilemap layer \"{name}\" has {len(data) / 4:g} cells instead of {shape[1]}x{shape[0]}")
+        return np.frombuffer(data, dtype="<u4").reshape(shape)
+
+    @staticmethod
+    def gids_to_tiles(gids:np.ndarray, tileset_list:list) -> np.ndarray:
+        """
+        Converts an array of raw Tiled gids to Godot global tile ids with flip flags
+        """
+        # Tileset ranges in document order
+        # original value - firstgid to get tile without tileset, + 1 as godot ids start at 1, + optimized_firstgid to restore set position
+        ranges = [(firstgid, firstgid + tileset.tile_count, optimized_firstgid + 1 - firstgid) for tileset, firstgid, optimized_firstgid in tileset_list]
+
+        # Split gids wherever a range starts or ends, sorted for searching
+        # each piece belongs to the first set covering it, as sets may overlap (via hva:tiles) or be out of firstgid order
+        bounds = sorted({bound for start, end, offset in ranges for bound in (start, end)})
+        starts, ends, offsets = [], [], []
+        for start, end in zip(bounds, bounds[1:]):
+            for set_start, set_end, offset in ranges:
+                if set_start <= start and end <= set_end:
+                    starts.append(start)
+                    ends.append(end)
+                    offsets.append(offset)
+                    break
+
+        tiles = np.zeros(gids.shape, dtype=np.uint32)
+        if not starts:
+            return tiles.view(np.int32)
+
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        offsets = np.array(offsets, dtype=np.int64)
+
+        # Split tile
+        flags = gids >> 29
+        values = (gids & 0x1FFFFFFF).astype(np.int64)
+
+        # Find tileset of each tile via firstgid, convert to global id
+        set_ids = np.searchsorted(starts, values, side="right") - 1
+        found = set_ids >= 0
+        set_ids[~found] = 0
+        found &= values < ends[set_ids]
+
+        global_tiles = (values + offsets[set_ids]).astype(np.uint32) | (TiledUtil.TILED_TO_GODOT_FLAGS[flags] << 29)
+        np.copyto(tiles, global_tiles, where=found)
+
+        # Godot stores tiles as signed 32 bit ints
+        return tiles.view(np.int32)
+
 ### GENERATION
 class Convert:
     """
     Generates necessary files from given filepath
     """
-    def __init__(self, tilemap:Tilemap) -> None:
+    # Per-tile tres entry, {texture}, {width} and {height} are filled in once per tileset
+    TILE_TEMPLATE = \
+        "{s}name = \"{id}\"\n"+\
+        "{s}texture = ExtResource( {texture} )\n"+\
+        "{s}tex_offset = Vector2( 0, 0 )\n"+\
+        "{s}modulate = Color( 1, 1, 1, 1 )\n"+\
+        "{s}region = Rect2( {x}, {y}, {width}, {height})\n"+\
+        "{s}tile_mode = 0\n"+\
+        "{s}occluder_offset = Vector2( 0, 0 )\n"+\
+        "{s}navigation_offset = Vector2( 0, 0)\n"+\
+        "{s}shape_offset = Vector2( 0, 0 )\n"+\
+        "{s}shape_transform = Transform2D( 1, 0, 0, 1, 0, 0 )\n"+\
+        "{shape}"+\
+        "{s}shape_one_way = false\n"+\
+        "{s}shape_one_way_margin = 0.0\n"+\
+        "{s}shapes = [ {shapes} ]\n"+\
+        "{s}z_index = 0\n"
+
+    # Entry of a tile's shapes list
+    TILE_SHAPE_TEMPLATE = \
+        "{{\n"+\
+        '"autotile_coord": Vector2( 0, 0 ),\n'+\
+        '"one_way": false,\n'+\
+        '"one_way_margin": 1.0,\n'+\
+        '"shape":SubResource( {shape} ),\n'+\
+        '"shape_transform": Transform2D( 1, 0, 0, 1, 0, 0 )}}, \n'
+
+    def __init__(self, tilemap:Tilemap, stream:bool=False, merge_collisions:bool=False, prune_tiles:bool=False, atlas:bool=False, binary:bool=False, chunk_size:int=0, object_grid:int=0, cache_directory:str=None) -> None:  #type:ignore
         """
         Generates map file, tileset file, and image paths into instance variables
+        When streaming, nothing is generated until write_tres and write_tscn are called
+        When merging collisions, full tile colliders are merged per layer instead of being set on each tile
+        When pruning tiles, only tiles placed in the map are written to the tres, renumbered in order
+        When packing an atlas, every tileset image is packed into one texture, cached in cache_directory
+        When binary, Godot's binary .res and .scn are generated instead of the text .tres and .tscn
+        When chunking, each layer is split into TileMaps of chunk_size by chunk_size cells, leaving out empty chunks
+        With an object grid, zone and point objects are indexed by object_grid pixel cells in the Objects node's metadata
         """
+        self.tilemap = tilemap
+        self.sets    = [tileset[0] for tileset in tilemap.tileset_list]
+        # Options that change the output
+        self.options = {"merge_collisions": merge_collisions, "prune_tiles": prune_tiles, "atlas": atlas, "binary": binary, "chunk_size": chunk_size, "object_grid": object_grid}
+        self.binary  = binary
+        self.chunk_size = chunk_size
+        if chunk_size < 0:
+            throw("Chunk size must be a positive number of cells")
+        self.object_grid = object_grid
+        if object_grid < 0:
+            throw("Object grid must be a positive number of pixels")
+        # The map name names the output files and, when nesting, a folder whose other files are removed
+        if any(part in f"{tilemap.mode}_{tilemap.name}" for part in ["/", "\\", ".."]):
+            throw(f"Properties hva:mode and hva:name of Tilemap \"{tilemap.filepath[1]}\" can't contain path separators or \"..\"")
+
+        # Global tile id -> pruned tile id, 0 for unused tiles
+        self.tile_remap = None
+        if prune_tiles:
+            with span("prune"):
+                self.tile_remap = self.remap_used_tiles(tilemap)
+
+        self.collect_shapes(tilemap, merge_collisions)
+        # Object shapes are declared ahead of every node, so objects are read before layers
+        self.collect_object_shapes(tilemap.load_objects())
 
-        # Generate tres first
-        sets = [tileset[0] for tileset in tilemap.tileset_list]
-        
-        tres = ""
-        tile_objects = {}
+        # Save data
+        self.name        = tilemap.name
+        self.mode        = tilemap.mode
+        self.tile_size   = tilemap.tile_size
+        self.map_name    = f"{tilemap.mode}_{tilemap.name}"
+        self.tileset_file, self.scene_file = (f"{self.map_name}.res", f"{self.map_name}.scn") if binary else (f"{self.map_name}.tres", f"{self.map_name}.tscn")
+        self.directory   = tilemap.filepath[0]
+        self.source      = realpath(join(*tilemap.filepath))
+        self.tilesets    = [set.filepath for set in self.sets]
+        self.images = [tileset[0].full_image_path for tileset in tilemap.tileset_list]
+        # Images written next to the map, and the files they are copied from
+        self.image_sources = {image: join(self.directory, image) for image in self.images}
+
+        # Texture of each tileset, and where its image starts in that texture
+        self.textures = [(set.image, (0, 0)) for set in self.sets]
+        if atlas:
+            self.pack_atlas(cache_directory)
+
+        # Filled in once the tscn is generated
+        self.layers      = 0
+        self.objects     = 0
+
+        self.tres   = None
+        self.tscn   = None
+        if not stream:
+            with span("tres"):
+                self.tres = Convert.render(self.generate_res if binary else self.generate_tres, binary)
+            with span("tscn"):
+                self.tscn = Convert.render(self.generate_scn if binary else self.generate_tscn, binary)
+
+    def pack_atlas(self, cache_directory:str=None) -> None:  #type:ignore
+        """
+        Replaces tileset images with a single packed texture
+        """
+        from converter.atlas import pack_atlas
+        from converter.ir import default_cache_directory
+
+        atlas = pack_atlas(list(self.image_sources.values()), cache_directory or default_cache_directory())
+        atlas_image = f"{self.map_name}_atlas.png"
+        # Tilesets sharing an image share its spot
+        self.textures = [(atlas_image, atlas.offsets[self.image_sources[set.full_image_path]]) for set in self.sets]
+        self.images = [atlas_image]
+        self.image_sources = {atlas_image: atlas.path}
+
+    def remap_used_tiles(self, tilemap:Tilemap) -> np.ndarray:
+        """
+        Counts how often each tile is placed, numbering used tiles from 1 in global id order
+        """
+        total_tiles = sum([set.tile_count for set in self.sets])
+        self.tile_usage = np.zeros(total_tiles + 1, dtype=np.int64)
+
+        for name, tiles in tilemap.iter_layers():
+            if isinstance(tiles, SparseLayer):
+                tiles = tiles.cells()[2]
+            tile_ids = tiles.view(np.uint32).ravel() & 0x1FFFFFFF
+            self.tile_usage += np.bincount(tile_ids, minlength=total_tiles + 1)[:total_tiles + 1]
+        # Empty cells aren't tiles
+        self.tile_usage[0] = 0
+
+        used = np.nonzero(self.tile_usage)[0]
+        tile_remap = np.zeros(total_tiles + 1, dtype=np.uint32)
+        tile_remap[used] = np.arange(1, used.size + 1, dtype=np.uint32)
+        return tile_remap
+
+    def collect_shapes(self, tilemap:Tilemap, merge_collisions:bool) -> None:
+        """
+        Shares one sub_resource between identical tile shapes, and finds tiles with full tile colliders for merging
+        """
+        # normalized points -> (sub_resource id, points)
+        self.shape_resources = {}
+        # (set id, tile id) -> sub_resource ids
+        self.tile_objects = {}
+        solid_tiles = []
+
+        for set_id, set in enumerate(self.sets):
+            full_tile = TiledUtil.normalize_points(TiledUtil.square_to_points(0, 0, {"width": set.tile_size[0], "height": set.tile_size[1]}))  #type:ignore
+            tile_shapes = {}
+            for tile_id, object_id, points in set.shapes:
+                tile_shapes.setdefault(tile_id, []).append(TiledUtil.normalize_points(points))
+
+            for tile_id, shapes in tile_shapes.items():
+                # Skip shapes of pruned tiles
+                if self.tile_remap is not None and not self.tile_remap[tilemap.tileset_list[set_id][2] + tile_id + 1]:
+                    continue
+
+                # Tiles fully covered by a single collider are merged per layer instead
+                if merge_collisions and shapes == [full_tile]:
+                    solid_tiles.append(tilemap.tileset_list[set_id][2] + tile_id + 1)
+                    continue
+
+                self.tile_objects[(set_id, tile_id)] = []
+                for points in shapes:
+                    if points not in self.shape_resources:
+                        self.shape_resources[points] = (len(self.shape_resources) + 1, points)
+                    self.tile_objects[(set_id, tile_id)].append(self.shape_resources[points][0])
+
+        self.solid_tiles = np.array(solid_tiles, dtype=np.int32)
 
-        ext_resource_id = 0
-        sub_resource_id = 0
+    def collect_object_shapes(self, objects:list[tuple]) -> None:
+        """
+        Shares one sub_resource between identical rectangle or ellipse objects
+        """
+        # (kind, width, height) -> sub_resource id
+        self.object_shapes = {}
+        for object in objects:
+            if object[4][0] != "polygon":
+                self.object_shapes.setdefault(object[4], len(self.object_shapes) + 1)
+
+    @staticmethod
+    def primitive_shape(shape:tuple) -> tuple[str, list, bool]:
+        """
+        Picks the Godot shape of a rectangle or ellipse object, as its type, properties and whether it is turned on its side
+        Ellipses that aren't circles become capsules, which stand upright unless turned
+        """
+        kind, width, height = shape
+        if kind == "rectangle":
+            return "RectangleShape2D", [("extents", binary.Vector2(width / 2, height / 2))], False
+        if width == height:
+            return "CircleShape2D", [("radius", width / 2)], False
+        radius = min(width, height) / 2
+        return "CapsuleShape2D", [("radius", radius), ("height", max(width, height) - 2 * radius)], width > height
+
+    @staticmethod
+    def text_value(value) -> str:
+        """
+        Formats a number or Vector2 as it appears in a tscn
+        Whole numbers are written without a decimal point, others as the shortest text that reads back the same
+        """
+        if isinstance(value, binary.Vector2):
+            return f"Vector2( {Convert.text_value(value.x)}, {Convert.text_value(value.y)} )"
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    def object_grid_cells(self, objects:list[tuple]) -> dict:
+        """
+        Lists the zone and point objects overlapping each object_grid sized cell, by object id
+        """
+        size = self.object_grid
+        cells = {}
+        for object_id, object in enumerate(objects):
+            if object[1].get("type") not in ["zone", "point"]:
+                continue
+
+            # Bounding box, touching a cell's far edge doesn't overlap it
+            xs = [point[0] + object[2] for point in object[0]]
+            ys = [point[1] + object[3] for point in object[0]]
+            left, top = min(xs) // size, min(ys) // size
+            right, bottom = max(left, (max(xs) - 1) // size), max(top, (max(ys) - 1) // size)
+            for cell_y in range(top, bottom + 1):
+                for cell_x in range(left, right + 1):
+                    cells.setdefault((cell_x, cell_y), []).append(object_id)
+        return cells
+
+    @staticmethod
+    def render(generate, binary:bool=False) -> str | bytes:
+        """
+        Collects the output of a generator method into a string, or bytes when binary
+        """
+        buffer = BytesIO() if binary else StringIO()
+        generate(buffer)
+        return buffer.getvalue()
+
+    def write_tres(self, file) -> None:
+        """
+        Writes the tres, or res when binary, to an open file, generating it unless already generated
+        """
+        if self.tres is not None:
+            file.write(self.tres)
+        else:
+            with span("tres"):
+                (self.generate_res if self.binary else self.generate_tres)(file)
+
+    def write_tscn(self, file) -> None:
+        """
+        Writes the tscn, or scn when binary, to an open file, generating it unless already generated
+        """
+        if self.tscn is not None:
+            file.write(self.tscn)
+        else:
+            with span("tscn"):
+                (self.generate_scn if self.binary else self.generate_tscn)(file)
+
+    def generate_tres(self, file) -> None:
+        """
+        Generates the tres, writing it to an open file piece by piece
+        """
+        write = file.write
+        sets = self.sets
+        tile_objects = self.tile_objects
+
+        texture_ids = self.texture_ids()
+        ext_resource_id = len(texture_ids)
+        sub_resource_id = len(self.shape_resources)
+
+        write(f"[gd_resource type=\"TileSet\" load_steps={ext_resource_id+sub_resource_id+1} format=2]\n\n")
 
         # Add set image to tres
-        for set_id in range(0, len(sets)):
-            ext_resource_id += 1
-            tres += f"[ext_resource path=\"{sets[set_id].image}\" type=\"Texture\" id={ext_resource_id}]\n\n"
+        for image, texture_id in texture_ids.items():
+            write(f"[ext_resource path=\"{image}\" type=\"Texture\" id={texture_id}]\n\n")
 
-        # Object collision step
-        for set_id, set in enumerate(sets):
-            for shapes in set.shapes:
-                sub_resource_id += 1
-                points_list = []
+        # Object collision step, identical shapes share a sub_resource
+        for sub_resource_id, points in self.shape_resources.values():
+            points_list = []
 
-                for points in shapes[2]:
-                    points_list.append(str(points[0]))
-                    points_list.append(str(points[1]))
+            for point in points:
+                points_list.append(str(point[0]))
+                points_list.append(str(point[1]))
 
-                tres += f"[sub_resource type=\"ConvexPolygonShape2D\" id={sub_resource_id}]\n"
-                tres += f"points = PoolVector2Array( { ', '.join(points_list) } )\n\n"
-                
-                if tile_objects.get(shapes[0]) != None:
-                    tile_objects[(set_id, shapes[0])].append(sub_resource_id)
-                else:
-                    tile_objects[(set_id, shapes[0])] = [sub_resource_id]
+            count("shapes")
+            write(f"[sub_resource type=\"ConvexPolygonShape2D\" id={sub_resource_id}]\n"+\
+                  f"points = PoolVector2Array( { ', '.join(points_list) } )\n\n")
 
         # Tile step
-        tres += "[resource]\n"
+        write("[resource]\n")
         total_tiles = 0
         for set_id, set in enumerate(sets):
-            for set_tile_id in range(0, set.tile_count):
-                tile_id = total_tiles + 1
-
-                # Grab tile region
-                tile_width = set.tile_size[0]
-                tile_height = set.tile_size[1]
-                x = (set_tile_id) % set.columns
-                y = (set_tile_id) // set.columns
+            # Fill in tileset constants once
+            tile_width = set.tile_size[0]
+            tile_height = set.tile_size[1]
+            tile_template = Convert.TILE_TEMPLATE\
+                .replace("{texture}", str(texture_ids[self.textures[set_id][0]]))\
+                .replace("{width}", str(tile_width))\
+                .replace("{height}", str(tile_height))
+
+            set_tres = []
+            for set_tile_id, tile_id, x, y in self.iter_tiles(set_id, total_tiles):
+                s = f"{tile_id}/"
 
                 # Check if tile has collision
-                tile_object_key = (set_id, set_tile_id)
-                has_collision = False
+                shape = ""
                 tile_shapes = ""
+                shape_ids = tile_objects.get((set_id, set_tile_id))
+                if shape_ids != None:
+                    shape = f"{s}shape = SubResource( {shape_ids[0]} )\n"
+                    tile_shapes = "".join([Convert.TILE_SHAPE_TEMPLATE.format(shape=shape_id) for shape_id in shape_ids])
 
-                if tile_objects.get(tile_object_key) != None:
-                    has_collision = True
-                    for shape in tile_objects.get(tile_object_key):  #type:ignore
-                        tile_shapes += "{\n"+\
-                            '"autotile_coord": Vector2( 0, 0 ),\n'+\
-                            '"one_way": false,\n'+\
-                            '"one_way_margin": 1.0,\n'+\
-                           f'"shape":SubResource( {shape} ),\n'+\
-                            '"shape_transform": Transform2D( 1, 0, 0, 1, 0, 0 )}, \n'
+                # Grab tile region
+                set_tres.append(tile_template.format(
+                    s=s,
+                    id=tile_id,
+                    x=x,
+                    y=y,
+                    shape=shape,
+                    shapes=tile_shapes
+                ))
+            total_tiles += set.tile_count
+
+            # Write one tileset at a time
+            write("".join(set_tres))
+
+    def generate_res(self, file) -> None:
+        """
+        Generates the tileset as a binary res, with the same contents as the tres
+        """
+        resource = binary.ResourceWriter("TileSet")
+        textures = {image: resource.ext_resource(image, "Texture") for image in self.texture_ids()}
 
-                s = f"{tile_id}/"
-                tres += \
-                    f"{s}name = \"{tile_id}\"\n"+\
-                    f"{s}texture = ExtResource( {set_id + 1} )\n"+\
-                    f"{s}tex_offset = Vector2( 0, 0 )\n"+\
-                    f"{s}modulate = Color( 1, 1, 1, 1 )\n"+\
-                    f"{s}region = Rect2( {x * tile_width}, {y * tile_height}, {tile_width}, {tile_height})\n"+\
-                    f"{s}tile_mode = 0\n"+\
-                    f"{s}occluder_offset = Vector2( 0, 0 )\n"+\
-                    f"{s}navigation_offset = Vector2( 0, 0)\n"+\
-                    f"{s}shape_offset = Vector2( 0, 0 )\n"+\
-                    f"{s}shape_transform = Transform2D( 1, 0, 0, 1, 0, 0 )\n"+\
-                    (f"{s}shape = SubResource( {tile_objects[tile_object_key][0]} )\n" if has_collision else "")+\
-                    f"{s}shape_one_way = false\n"+\
-                    f"{s}shape_one_way_margin = 0.0\n"+\
-                    f"{s}shapes = [ {tile_shapes} ]\n"+\
-                    f"{s}z_index = 0\n"
-
-                total_tiles += 1
-
-        tres = \
-            f"[gd_resource type=\"TileSet\" load_steps={ext_resource_id+sub_resource_id+1} format=2]\n\n{tres}"
-
-        # Generate tscn
-        tscn = \
-          f'[gd_scene load_steps=3 format=2]\n\n\
+        # Object collision step, sub_resource ids are handed out in the same order as the tres
+        for sub_resource_id, points in self.shape_resources.values():
+            count("shapes")
+            resource.sub_resource("ConvexPolygonShape2D", [("points", binary.PoolVector2Array(np.array(points, dtype=np.float32)))])
+
+        # Tile step
+        properties = []
+        property_count = 0
+        total_tiles = 0
+        for set_id, set in enumerate(self.sets):
+            # (id length, shape ids) -> templates of tiles alike, filled in with the tile id, property name indices and region
+            templates = {}
+            for set_tile_id, tile_id, x, y in self.iter_tiles(set_id, total_tiles):
+                digits = str(tile_id).encode()
+                shape_ids = tuple(self.tile_objects.get((set_id, set_tile_id), []))
+                key = (len(digits), shape_ids)
+                if key not in templates:
+                    templates[key] = self.res_tile_templates(textures[self.textures[set_id][0]], set.tile_size, len(digits), shape_ids)
+                names, tile_properties, tile_property_count = templates[key]
+
+                # Tile names are all new, so are added to the string table without looking them up
+                indices = resource.add_names(names % ((digits,) * tile_property_count), tile_property_count)
+                # The name and region values follow the first and fifth names
+                properties.append(tile_properties % (indices[0], digits, *indices[1:5], struct.pack("<2f", x, y), *indices[5:]))
+                property_count += tile_property_count
+            total_tiles += set.tile_count
+
+        resource.write_encoded(file, [struct.pack("<I", property_count)] + properties, self.tileset_file)
+
+    @staticmethod
+    def res_tile_templates(texture:binary.ExtResource, tile_size:tuple, digit_count:int, shape_ids:tuple) -> tuple[bytes, bytes, int]:
+        """
+        Encodes the string table entries and properties of a tile as binary.template templates, with the values every tile of a tileset shares
+        Returns the names and properties templates and the number of properties, as in TILE_TEMPLATE
+        """
+        def encoded(value) -> bytes:
+            out = []
+            binary.encode_variant(value, out)
+            return b"".join(out)
+
+        zero = encoded(binary.Vector2(0, 0))
+        identity = encoded(binary.Transform2D(1, 0, 0, 1, 0, 0))
+        # Names, then the encoded value with None for the tile id or region corner
+        properties = [
+            ("name", [struct.pack("<II", binary.VARIANT_STRING, digit_count + 1), None, b"\0"]),
+            ("texture", [encoded(texture)]),
+            ("tex_offset", [zero]),
+            ("modulate", [encoded(binary.Color(1, 1, 1, 1))]),
+            ("region", [struct.pack("<I", binary.VARIANT_RECT2), None, struct.pack("<2f", *tile_size)]),
+            ("tile_mode", [encoded(0)]),
+            ("occluder_offset", [zero]),
+            ("navigation_offset", [zero]),
+            ("shape_offset", [zero]),
+            ("shape_transform", [identity])
+        ]
+        if shape_ids:
+            properties.append(("shape", [encoded(binary.SubResource(shape_ids[0]))]))
+        properties += [
+            ("shape_one_way", [encoded(False)]),
+            ("shape_one_way_margin", [encoded(0.0)]),
+            ("shapes", [encoded([{
+                "autotile_coord": binary.Vector2(0, 0),
+                "one_way": False,
+                "one_way_margin": 1.0,
+                "shape": binary.SubResource(shape_id),
+                "shape_transform": binary.Transform2D(1, 0, 0, 1, 0, 0)
+            } for shape_id in shape_ids])]),
+            ("z_index", [encoded(0)])
+        ]
+
+        # Names are "{id}/{property}", each property value follows the index of its name
+        names = binary.template([part for name, value in properties for part in [struct.pack("<I", digit_count + len(name) + 2), None, f"/{name}\0".encode()]])
+        values = binary.template([part for name, value in properties for part in [None] + value])
+        return names, values, len(properties)
+
+    def texture_ids(self) -> dict:
+        """
+        Numbers the textures used by tilesets, tilesets sharing a texture share its ext_resource
+        """
+        texture_ids = {}
+        for image, offset in self.textures:
+            texture_ids.setdefault(image, len(texture_ids) + 1)
+        return texture_ids
+
+    def iter_tiles(self, set_id:int, first_tile:int):
+        """
+        Yields the tile id within its tileset, the written tile id and the region corner of each tile in a tileset
+        """
+        set = self.sets[set_id]
+        offset_x, offset_y = self.textures[set_id][1]
+        for set_tile_id in range(0, set.tile_count):
+            tile_id = first_tile + set_tile_id + 1
+
+            # Pruned tiles are renumbered, unused ones skipped
+            if self.tile_remap is not None:
+                tile_id = int(self.tile_remap[tile_id])
+                if not tile_id:
+                    continue
+            yield set_tile_id, tile_id, offset_x + (set_tile_id % set.columns) * set.tile_size[0], offset_y + (set_tile_id // set.columns) * set.tile_size[1]
+
+    def remap_tiles(self, tiles:np.ndarray) -> np.ndarray:
+        """
+        Renumbers tiles to their pruned ids, keeping flip flags
+        """
+        if self.tile_remap is None:
+            return tiles
+        tiles = tiles.view(np.uint32)
+        return (self.tile_remap[tiles & 0x1FFFFFFF] | (tiles & 0xE0000000)).view(np.int32)
+
+    def merged_collision(self, xs:np.ndarray, ys:np.ndarray, tiles:np.ndarray) -> list[tuple]:
+        """
+        Merges the full tile colliders of a layer into rectangles, as left, top, right, bottom pixel coordinates
+        """
+        # Flip flags don't change a full tile collider
+        solid = np.isin(tiles.view(np.uint32) & 0x1FFFFFFF, self.solid_tiles)
+        if not solid.any():
+            return []
+
+        tile_width, tile_height = self.tile_size
+        rectangles = []
+        for x, y, width, height in TiledUtil.merge_rectangles(xs[solid], ys[solid]):
+            count("merged_shapes")
+            left, top = x * tile_width, y * tile_height
+            rectangles.append((left, top, left + width * tile_width, top + height * tile_height))
+        return rectangles
+
+    def write_merged_collision(self, write, layer_name:str, xs:np.ndarray, ys:np.ndarray, tiles:np.ndarray) -> None:
+        """
+        Writes the full tile colliders of a layer as merged rectangles on a StaticBody2D
+        """
+        rectangles = self.merged_collision(xs, ys, tiles)
+        if not rectangles:
+            return
+
+        write(f"[node name=\"Collision\" type=\"StaticBody2D\" parent=\"{layer_name}\"]\n\n")
+        for shape_id, (left, top, right, bottom) in enumerate(rectangles):
+            write(f"[node name=\"{shape_id}\" type=\"CollisionPolygon2D\" parent=\"{layer_name}/Collision\"]\n"+\
+                  f"polygon = PoolVector2Array( {left}, {top}, {right}, {top}, {right}, {bottom}, {left}, {bottom} )\n\n")
+
+    def generate_tscn(self, file) -> None:
+        """
+        Generates the tscn, writing it to an open file one layer and object at a time
+        """
+        write = file.write
+        tilemap = self.tilemap
+
+        write(
+          f'[gd_scene load_steps={3 + len(self.object_shapes)} format=2]\n\n\
             [ext_resource path="{tilemap.mode.lower() + "_" + tilemap.name.lower()+".tres"}" type="TileSet" id=1]\n\n\
-            [ext_resource path="res://Scripts/Objects/Objective.gd" type="Script" id=2]\n\n\
-            [node name="{tilemap.mode + "_" + tilemap.name.lower()}" type="Node2D"]\nscale = Vector2( 0.25, 0.25 )\n\n\
+            [ext_resource path="res://Scripts/Objects/Objective.gd" type="Script" id=2]\n\n')
+
+        # Shapes of rectangle and ellipse objects, which have to come before any node
+        for shape, sub_resource_id in self.object_shapes.items():
+            type, properties, turned = Convert.primitive_shape(shape)
+            write(f"[sub_resource type=\"{type}\" id={sub_resource_id}]\n" + \
+                  "".join([f"{name} = {Convert.text_value(value)}\n" for name, value in properties]) + "\n")
+
+        write(
+          f'            [node name="{tilemap.mode + "_" + tilemap.name.lower()}" type="Node2D"]\nscale = Vector2( 0.25, 0.25 )\n\n\
             __meta__ = {{\
                 "mode":"{tilemap.mode}"\
-            }}'
+            }}')
 
         # Write each layer
-        for layer in tilemap.layers:
-            tscn += f'[node name="{layer[0]}" type="TileMap" parent="."]\ntile_set = ExtResource( 1 )\n \
+        for layer in tilemap.iter_layers():
+            # Find placed tiles, sparse layers already hold placed tiles only
+            if isinstance(layer[1], SparseLayer):
+                xs, ys, tiles = layer[1].cells()
+            else:
+                ys, xs = np.nonzero(layer[1])
+                tiles = layer[1][ys, xs]
+
+            if self.chunk_size:
+                self.write_chunks(write, layer[0], xs, ys, tiles)
+            else:
+                write(f'[node name="{layer[0]}" type="TileMap" parent="."]\ntile_set = ExtResource( 1 )\n \
                     cell_size = Vector2( {tilemap.tile_size[0]}, {tilemap.tile_size[1]} )\n \
                     cell_custom_transform = Transform2D( 16, 0, 0, 16, 0, 0 )\n \
                     format = 1\n \
-                    tile_data = PoolIntArray('
-            flat_layer = []
-            
-            # Flatten layer array
-            row_id = 0
-            while row_id < len(layer[1]):
-                row = layer[1][row_id]
-                tile_id = 0
-                while tile_id < len(row):
-                    tile = row[tile_id]
-                    if tile != 0:
-                        flat_layer.append(f"{ tile_id + (row_id * 65536) }, {tile}, 0")
-                    tile_id += 1
-                row_id += 1
-            
-            # Write to tres
-            tscn += ", ".join(flat_layer)+")\n"
+                    tile_data = PoolIntArray(')
+
+                # Write to tscn
+                with span("tile_data"):
+                    write(TiledUtil.tile_data(xs, ys, self.remap_tiles(tiles))+")\n")
+
+            # Merged collision of full tile colliders
+            if self.solid_tiles.size:
+                with span("merge"):
+                    self.write_merged_collision(write, layer[0], xs, ys, tiles)
 
         # Object step
-        tscn += "[node name=\"Objects\" type=\"Node2D\" parent=\".\"]\n\n"
+        write("[node name=\"Objects\" type=\"Node2D\" parent=\".\"]\n")
+        if self.object_grid:
+            grid = ", ".join([f"Vector2( {x}, {y} ): [ {', '.join(map(str, object_ids))} ]" for (x, y), object_ids in self.object_grid_cells(tilemap.objects).items()])
+            write(f"__meta__ = {{\n\"grid\": {{ {grid} }},\n\"grid_size\": {self.object_grid}\n}}\n")
+        write("\n")
 
         for object_id, object in enumerate(tilemap.objects):
+            tscn = ""
             if object[1].get("type") == "zone":
                 tscn += f"[node name=\"{object_id}\" type=\"KinematicBody2D\" parent=\"Objects\"]\n"
                 # Set collision masks
@@ -398,25 +1294,158 @@ class Convert:
 
             # i know this is a super unpythonic way to do list comprehension but i think it's kinda funny so i'm keeping it
             tscn += f"position = Vector2( {object[2]}, {object[3]} )\n" + \
-                     "__meta__ = {\n" + "".join([ f"\"{k}\":\"{v}\",\n" for k,v in object[1].items() ]) + "}\n\n" + \
-                    f"[node name=\"Shape\" type=\"CollisionPolygon2D\" parent=\"Objects/{object_id}\"]\n"
-
-            points_list = []
-            for points in object[0]:
-                points_list.append(str(points[0]))
-                points_list.append(str(points[1]))
-            tscn += f"polygon = PoolVector2Array( {', '.join(points_list)} )\n\n"
+                     "__meta__ = {\n" + "".join([ f"\"{k}\":\"{v}\",\n" for k,v in object[1].items() ]) + "}\n\n"
+
+            # Rectangles and ellipses are centered primitive shapes
+            if object[4][0] != "polygon":
+                kind, width, height = object[4]
+                tscn += f"[node name=\"Shape\" type=\"CollisionShape2D\" parent=\"Objects/{object_id}\"]\n" + \
+                        f"position = {Convert.text_value(binary.Vector2(width / 2, height / 2))}\n"
+                if Convert.primitive_shape(object[4])[2]:
+                    tscn += "rotation_degrees = 90.0\n"
+                tscn += f"shape = SubResource( {self.object_shapes[object[4]]} )\n\n"
+            else:
+                tscn += f"[node name=\"Shape\" type=\"CollisionPolygon2D\" parent=\"Objects/{object_id}\"]\n"
+                points_list = []
+                for points in object[0]:
+                    points_list.append(str(points[0]))
+                    points_list.append(str(points[1]))
+                tscn += f"polygon = PoolVector2Array( {', '.join(points_list)} )\n\n"
+            write(tscn)
+            count("objects")
 
-        # Save data
-        self.name        = tilemap.name
-        self.mode        = tilemap.mode
-        self.tile_size   = tilemap.tile_size
-        self.layers      = len(tilemap.layers)
+        self.layers      = tilemap.layer_count
         self.objects     = len(tilemap.objects)
 
-        self.tscn   = tscn
-        self.tres   = tres
-        self.images = [tileset[0].full_image_path for tileset in tilemap.tileset_list]
+    def write_chunks(self, write, layer_name:str, xs:np.ndarray, ys:np.ndarray, tiles:np.ndarray) -> None:
+        """
+        Writes a layer as a Node2D holding one TileMap per chunk, each positioned at its chunk's corner
+        """
+        tile_width, tile_height = self.tile_size
+        write(f"[node name=\"{layer_name}\" type=\"Node2D\" parent=\".\"]\n\n")
+        for chunk_x, chunk_y, chunk_xs, chunk_ys, chunk_tiles in TiledUtil.split_chunks(xs, ys, tiles, self.chunk_size):
+            count("chunks")
+            write(f"[node name=\"{chunk_x}_{chunk_y}\" type=\"TileMap\" parent=\"{layer_name}\"]\n"+\
+                  f"position = Vector2( {chunk_x * self.chunk_size * tile_width}, {chunk_y * self.chunk_size * tile_height} )\n"+\
+                   "tile_set = ExtResource( 1 )\n"+\
+                  f"cell_size = Vector2( {tile_width}, {tile_height} )\n"+\
+                   "cell_custom_transform = Transform2D( 16, 0, 0, 16, 0, 0 )\n"+\
+                   "format = 1\n"+\
+                   "tile_data = PoolIntArray( ")
+            with span("tile_data"):
+                write(TiledUtil.tile_data(chunk_xs, chunk_ys, self.remap_tiles(chunk_tiles))+" )\n\n")
+
+    def generate_scn(self, file) -> None:
+        """
+        Generates the map as a binary scn, with the same nodes as the tscn
+        Tile data is written as raw int32 arrays, without formatting it as text
+        """
+        tilemap = self.tilemap
+        scene = binary.SceneWriter()
+        tileset = scene.ext_resource(tilemap.mode.lower() + "_" + tilemap.name.lower() + ".res", "TileSet")
+        script = scene.ext_resource("res://Scripts/Objects/Objective.gd", "Script")
+
+        # Shapes of rectangle and ellipse objects
+        object_shapes = {}
+        for shape in self.object_shapes:
+            type, properties, turned = Convert.primitive_shape(shape)
+            object_shapes[shape] = scene.sub_resource(type, properties)
+
+        root = scene.node(tilemap.mode + "_" + tilemap.name.lower(), "Node2D", properties=[
+            ("scale", binary.Vector2(0.25, 0.25)),
+            ("__meta__", {"mode": tilemap.mode})
+        ])
+
+        # Add each layer
+        for layer in tilemap.iter_layers():
+            # Find placed tiles, sparse layers already hold placed tiles only
+            if isinstance(layer[1], SparseLayer):
+                xs, ys, tiles = layer[1].cells()
+            else:
+                ys, xs = np.nonzero(layer[1])
+                tiles = layer[1][ys, xs]
+
+            tilemap_properties = [
+                ("tile_set", tileset),
+                ("cell_size", binary.Vector2(*tilemap.tile_size)),
+                ("cell_custom_transform", binary.Transform2D(16, 0, 0, 16, 0, 0)),
+                ("format", 1)
+            ]
+            if self.chunk_size:
+                layer_node = scene.node(layer[0], "Node2D", root)
+                for chunk_x, chunk_y, chunk_xs, chunk_ys, chunk_tiles in TiledUtil.split_chunks(xs, ys, tiles, self.chunk_size):
+                    count("chunks")
+                    with span("tile_data"):
+                        tile_data = TiledUtil.tile_cells(chunk_xs, chunk_ys, self.remap_tiles(chunk_tiles))
+                    position = binary.Vector2(chunk_x * self.chunk_size * tilemap.tile_size[0], chunk_y * self.chunk_size * tilemap.tile_size[1])
+                    scene.node(f"{chunk_x}_{chunk_y}", "TileMap", layer_node, [("position", position)] + tilemap_properties + [("tile_data", binary.PoolIntArray(tile_data))])
+            else:
+                with span("tile_data"):
+                    tile_data = TiledUtil.tile_cells(xs, ys, self.remap_tiles(tiles))
+                layer_node = scene.node(layer[0], "TileMap", root, tilemap_properties + [("tile_data", binary.PoolIntArray(tile_data))])
+
+            # Merged collision of full tile colliders
+            if self.solid_tiles.size:
+                with span("merge"):
+                    rectangles = self.merged_collision(xs, ys, tiles)
+                if rectangles:
+                    collision = scene.node("Collision", "StaticBody2D", layer_node)
+                    for shape_id, (left, top, right, bottom) in enumerate(rectangles):
+                        scene.node(str(shape_id), "CollisionPolygon2D", collision, [
+                            ("polygon", binary.PoolVector2Array(np.array([left, top, right, top, right, bottom, left, bottom], dtype=np.float32)))
+                        ])
+
+        # Object step
+        object_grid = []
+        if self.object_grid:
+            object_grid = [("__meta__", {
+                "grid": {binary.Vector2(x, y): object_ids for (x, y), object_ids in self.object_grid_cells(tilemap.objects).items()},
+                "grid_size": self.object_grid
+            })]
+        objects = scene.node("Objects", "Node2D", root, object_grid)
+
+        for object_id, object in enumerate(tilemap.objects):
+            if object[1].get("type") == "zone":
+                type = "KinematicBody2D"
+                # Set collision masks
+                if object[1].get("team") == "offense":
+                    properties = [("collision_layer", 2), ("collision_mask", 4)]
+                else:
+                    properties = [("collision_layer", 4), ("collision_mask", 2)]
+
+            else:
+                type = "Area2D"
+                if object[1].get("type") == "point":
+                    properties = [("collision_layer", 0), ("collision_mask", 24)]
+                else:
+                    properties = [("collision_layer", 0), ("collision_mask", 0)]
+
+            if object[1].get("type") == "point":
+                properties.append(("script", script))
+
+            properties += [
+                ("position", binary.Vector2(object[2], object[3])),
+                ("__meta__", {str(k): str(v) for k, v in object[1].items()})
+            ]
+            object_node = scene.node(str(object_id), type, objects, properties)
+
+            # Rectangles and ellipses are centered primitive shapes
+            if object[4][0] != "polygon":
+                kind, width, height = object[4]
+                shape_properties = [("position", binary.Vector2(width / 2, height / 2))]
+                if Convert.primitive_shape(object[4])[2]:
+                    shape_properties.append(("rotation_degrees", 90.0))
+                scene.node("Shape", "CollisionShape2D", object_node, shape_properties + [("shape", object_shapes[object[4]])])
+            else:
+                scene.node("Shape", "CollisionPolygon2D", object_node, [
+                    ("polygon", binary.PoolVector2Array(np.array(object[0], dtype=np.float32)))
+                ])
+            count("objects")
+
+        scene.write(file, self.scene_file)
+
+        self.layers      = tilemap.layer_count
+        self.objects     = len(tilemap.objects)
 
 ### KILL
 def throw(msg:str=None) -> None:  #type:ignore
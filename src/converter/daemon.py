@@ -0,0 +1,445 @@
+# tiled2hva daemon
+# Keeps parsed maps and tilesets in memory between conversions, serving them over a Unix socket or localhost HTTP
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import json
+import socket
+import secrets
+from argparse import ArgumentParser, REMAINDER
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from hmac import compare_digest
+from os import O_CREAT, O_TRUNC, O_WRONLY, chmod, cpu_count, makedirs, open as open_file, remove
+from os.path import abspath, dirname, exists, join, realpath
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import perf_counter
+
+from converter.core import Tileset, VERSION
+from converter.output import ImageBatch, convert_and_write, convert_batch
+from converter.instrument import Recorder, add_observer, remove_observer
+from converter.ir import MapIR, load_tilemap, default_cache_directory
+from converter.__main__ import parse_args, convert_options, find_maps
+
+# Used when Unix sockets aren't available, such as on Windows
+DEFAULT_PORT = 7765
+
+# Latencies kept for the percentiles in stats
+LATENCY_SAMPLES = 1000
+
+# Most maps kept in memory, the least recently converted are dropped first
+TILEMAP_CACHE_SIZE = 64
+
+# Host headers the daemon answers to, so pages on other names resolving to 127.0.0.1 can't reach it
+ALLOWED_HOSTS = ["localhost", "127.0.0.1"]
+
+# Kept in the cache folder when listening on a port, as any local user can connect to one
+TOKEN_FILE_NAME = "daemon.token"
+
+### SERVICE
+class Daemon:
+    """
+    Converts maps on request, reusing every map and tileset already read while they stay unchanged
+    Requests run concurrently, though each map is only converted by one of them at a time
+    """
+    def __init__(self, cache_directory:str, jobs:int) -> None:
+        self.cache_directory = cache_directory
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.recorder = Recorder()
+        add_observer(self.recorder)
+
+        self.lock = Lock()
+        # map path -> MapIR, least recently used first
+        self.tilemaps = OrderedDict()
+        # map path -> Lock, as a MapIR is iterated in place and its outputs can't be written twice at once
+        self.map_locks = {}
+
+        self.started = perf_counter()
+        self.requests = self.converted = self.up_to_date = self.failed = 0
+        self.tilemap_hits = self.tilemap_misses = 0
+        self.request_latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.map_latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        remove_observer(self.recorder)
+
+    def map_lock(self, path:str) -> Lock:
+        with self.lock:
+            return self.map_locks.setdefault(path, Lock())
+
+    def load(self, path:str):
+        """
+        Returns the map kept in memory, only going through the IR cache when it or its tilesets changed
+        Called with the map's lock held, so no other request is using its MapIR
+        """
+        with self.lock:
+            tilemap = self.tilemaps.get(path)
+            if tilemap is not None:
+                self.tilemaps.move_to_end(path)
+        if tilemap is not None and tilemap.is_current():
+            with self.lock:
+                self.tilemap_hits += 1
+            return tilemap
+
+        # The IR file is replaced when reloading, which Windows refuses while it's mapped
+        if tilemap is not None:
+            tilemap.close()
+        tilemap = load_tilemap(path, self.cache_directory)
+        with self.lock:
+            self.tilemap_misses += 1
+            self.tilemaps.pop(path, None)
+            # Maps that couldn't be cached are parsed again next time
+            if isinstance(tilemap, MapIR):
+                self.tilemaps[path] = tilemap
+            # Dropped maps aren't closed, as another request may be converting them, and are unmapped once released
+            while len(self.tilemaps) > TILEMAP_CACHE_SIZE:
+                self.tilemaps.popitem(last=False)
+        return tilemap
+
+    def convert_map(self, map:str, destinations:list[str], nest:bool, options:dict, images:ImageBatch) -> dict:
+        start = perf_counter()
+        path = realpath(map)
+        with self.map_lock(path):
+            convert, entry = convert_and_write(path, destinations, nest, options, self.cache_directory, load=self.load, images=images)
+        seconds = perf_counter() - start
+        with self.lock:
+            self.map_latencies.append(seconds)
+        return {"map_name": convert.map_name, "seconds": seconds, "entry": entry}
+
+    def convert(self, request:dict) -> dict:
+        """
+        Converts the stale maps of a request, returning the result of each map
+        Maps and destinations should be absolute, as the daemon's working directory is not the client's
+        """
+        start = perf_counter()
+        maps = request["maps"]
+        destinations = request["destinations"]
+        nest = request.get("nest", False)
+        options = request.get("options", {})
+
+        def submit(map:str, images:ImageBatch):
+            return self.executor.submit(self.convert_map, map, destinations, nest, options, images)
+        up_to_date, results, entries = convert_batch(maps, destinations, nest, options, submit, request.get("force", False))
+
+        seconds = perf_counter() - start
+        with self.lock:
+            self.requests += 1
+            failed = len([result for result in results if "error" in result])
+            self.converted += len(results) - failed
+            self.failed += failed
+            self.up_to_date += len(up_to_date)
+            self.request_latencies.append(seconds)
+
+        return {"results": results, "up_to_date": up_to_date, "seconds": seconds}
+
+    def stats(self) -> dict:
+        tilesets = Tileset.cached.cache_info()
+        with self.lock:
+            return {
+                "version": VERSION,
+                "uptime": perf_counter() - self.started,
+                "requests": self.requests,
+                "maps": {"converted": self.converted, "up_to_date": self.up_to_date, "failed": self.failed},
+                "tilemap_cache": {"hits": self.tilemap_hits, "misses": self.tilemap_misses, "size": len(self.tilemaps)},
+                "tileset_cache": {"hits": tilesets.hits, "misses": tilesets.misses, "size": tilesets.currsize},
+                "request_latency": latency_summary(self.request_latencies),
+                "map_latency": latency_summary(self.map_latencies),
+                **self.recorder.results()
+            }
+
+def latency_summary(latencies:deque) -> dict:
+    """
+    Mean, median, 95th percentile and maximum in seconds of the latest latencies
+    """
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1]
+    }
+
+### SERVER
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP: GET /stats, POST /convert and POST /stop
+    """
+    server_version = f"tiled2hva/{VERSION}"
+
+    def refuse(self) -> bool:
+        """
+        Replies with an error to requests a web page or another user could have sent, returning whether it did
+        Pages can send simple requests to localhost, such as a text/plain POST, but never without an Origin or with a JSON body
+        On a port, clients also send the token only the daemon's user can read
+        """
+        if "Origin" in self.headers or self.headers.get("Host", "").split(":")[0] not in ALLOWED_HOSTS:
+            self.reply(403, {"error": "Only local clients may use the daemon"})
+            return True
+        token = self.server.token  #type:ignore
+        if token is not None and not compare_digest(self.headers.get("Authorization", ""), f"Bearer {token}"):
+            self.reply(401, {"error": f"Requests must send the token in {TOKEN_FILE_NAME}"})
+            return True
+        if self.command == "POST" and self.headers.get_content_type() != "application/json":
+            self.reply(415, {"error": "Requests must be application/json"})
+            return True
+        return False
+
+    def do_GET(self) -> None:
+        if self.refuse():
+            return
+        if self.path == "/stats":
+            self.reply(200, self.server.daemon.stats())  #type:ignore
+        else:
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.refuse():
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.reply(400, {"error": "Request is not valid JSON"})
+            return
+
+        if self.path == "/convert":
+            try:
+                self.reply(200, self.server.daemon.convert(request))  #type:ignore
+            except (KeyError, TypeError, AttributeError) as e:
+                self.reply(400, {"error": f"Malformed convert request: {type(e).__name__}: {e}"})
+        elif self.path == "/stop":
+            self.reply(200, {})
+            # Shutting down waits for serve_forever, so can't happen on a request thread
+            Thread(target=self.server.shutdown).start()
+        else:
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+
+    def reply(self, status:int, body:dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format:str, *args) -> None:
+        # Unix socket clients have no address to log, and converted maps are printed instead
+        pass
+
+if hasattr(socket, "AF_UNIX"):
+    from socketserver import UnixStreamServer
+
+    class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+class UnixHTTPConnection(HTTPConnection):
+    """
+    HTTPConnection to a Unix socket instead of a host and port
+    """
+    def __init__(self, socket_path:str) -> None:
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+def serve(address, cache_directory:str, jobs:int) -> int:
+    """
+    Runs the daemon until stopped, on a Unix socket when address is a path or on a localhost port otherwise
+    """
+    if isinstance(address, str):
+        # A socket left by a daemon that didn't stop cleanly would block binding
+        if exists(address):
+            if is_running(address):
+                print(f"A daemon is already listening on {address}", file=sys.stderr)
+                return 1
+            remove(address)
+        makedirs(dirname(address), exist_ok=True)
+        server = UnixHTTPServer(address, RequestHandler)  #type:ignore
+        # Only the daemon's user can connect to its socket
+        server.token = None  #type:ignore
+    else:
+        server = ThreadingHTTPServer(address, RequestHandler)
+        server.token = write_token(cache_directory)  #type:ignore
+
+    daemon = Daemon(cache_directory, jobs)
+    server.daemon = daemon  #type:ignore
+    print(f"Listening on {describe(address)}, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        if isinstance(address, str) and exists(address):
+            remove(address)
+    return 0
+
+def write_token(cache_directory:str) -> str:
+    """
+    Writes a new random token to a file only the current user can read, returning it
+    """
+    token = secrets.token_hex(32)
+    makedirs(cache_directory, exist_ok=True)
+    token_path = join(cache_directory, TOKEN_FILE_NAME)
+    descriptor = open_file(token_path, O_WRONLY | O_CREAT | O_TRUNC, 0o600)
+    # The mode only applies to new files
+    chmod(token_path, 0o600)
+    with open(descriptor, "w") as file:
+        file.write(token)
+    return token
+
+def read_token(cache_directory:str) -> str:
+    """
+    Reads the token of the daemon listening on a port, None when there isn't one
+    """
+    try:
+        with open(join(cache_directory, TOKEN_FILE_NAME)) as file:
+            return file.read().strip()
+    except OSError:
+        return None  #type:ignore
+
+### CLIENT
+def call(address, method:str, path:str, body:dict=None, token:str=None) -> dict:  #type:ignore
+    """
+    Sends a request to the daemon, raising OSError when it isn't running
+    Daemons listening on a port need the token from their cache folder
+    """
+    connection = UnixHTTPConnection(address) if isinstance(address, str) else HTTPConnection(*address)
+    headers = {"Content-Type": "application/json"}
+    if token is not None:
+        headers["Authorization"] = f"Bearer {token}"
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+def is_running(address) -> bool:
+    try:
+        call(address, "GET", "/stats")
+        return True
+    except (OSError, ValueError):
+        return False
+
+def describe(address) -> str:
+    return address if isinstance(address, str) else f"http://{address[0]}:{address[1]}"
+
+def not_running(address, error:OSError) -> int:
+    print(f"No daemon on {describe(address)}, start one with python -m converter.daemon serve ({error})", file=sys.stderr)
+    return 1
+
+def convert_command(address, argv:list[str], token:str=None) -> int:  #type:ignore
+    """
+    Takes the same arguments as python -m converter, but converts on the daemon
+    """
+    args = parse_args(argv)
+    if args.watch or args.profile or args.no_cache:
+        print("--watch, --profile and --no-cache are ignored by the daemon", file=sys.stderr)
+
+    # Paths are resolved here, as the daemon may run from another folder
+    maps = {abspath(map): map for map in find_maps(args.maps)}
+    try:
+        response = call(address, "POST", "/convert", {
+            "maps": list(maps),
+            "destinations": [abspath(destination) for destination in args.destination],
+            "nest": args.nest,
+            "options": convert_options(args),
+            "force": args.force
+        }, token)
+    except OSError as e:
+        return not_running(address, e)
+    if "error" in response:
+        print(response["error"], file=sys.stderr)
+        return 1
+
+    failed = 0
+    for map in response["up_to_date"]:
+        print(f"{maps[map]} is up to date")
+    for result in response["results"]:
+        if "error" in result:
+            failed += 1
+            print(f"{maps[result['map']]}: {result['error']}", file=sys.stderr)
+        else:
+            changed = ", but its inputs changed while converting so it stays out of date" if result.get("changed") else ""
+            print(f"{maps[result['map']]} -> {result['map_name']} ({result['seconds'] * 1000:.1f}ms){changed}")
+
+    converted = len(response["results"])
+    print(f"Converted {converted - failed}/{converted} maps in {response['seconds'] * 1000:.1f}ms, {len(response['up_to_date'])} up to date")
+    return 1 if failed else 0
+
+def format_stats(stats:dict) -> str:
+    lines = [
+        f"tiled2hva {stats['version']} daemon, up {stats['uptime']:.0f}s, {stats['requests']} requests",
+        f"Maps: {stats['maps']['converted']} converted, {stats['maps']['up_to_date']} up to date, {stats['maps']['failed']} failed"
+    ]
+    for name, cache in [("Map cache", stats["tilemap_cache"]), ("Tileset cache", stats["tileset_cache"])]:
+        lines.append(f"{name}: {cache['hits']} hits, {cache['misses']} misses, {cache['size']} held")
+    for name, latency in [("Request latency", stats["request_latency"]), ("Map latency", stats["map_latency"])]:
+        if latency["count"]:
+            lines.append(f"{name}: mean {latency['mean'] * 1000:.1f}ms, p50 {latency['p50'] * 1000:.1f}ms, p95 {latency['p95'] * 1000:.1f}ms, max {latency['max'] * 1000:.1f}ms over {latency['count']}")
+    for counter, amount in sorted(stats["counters"].items()):
+        lines.append(f"{counter}: {amount}")
+    return "\n".join(lines)
+
+### RUN
+def main(argv:list[str]=None) -> int:  #type:ignore
+    parser = ArgumentParser(prog="python -m converter.daemon", description="Keeps maps and tilesets in memory, converting them on request")
+    parser.add_argument("--socket", metavar="PATH", help="Unix socket to listen or connect on (default: daemon.sock in the cache folder)")
+    parser.add_argument("--port", type=int, help=f"listen or connect on this localhost port instead of a socket (default without Unix sockets: {DEFAULT_PORT})")
+    parser.add_argument("--cache-dir", default=default_cache_directory(), help="where parsed maps and atlases are cached (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count(), help="maps to convert at once across requests (default: cpu count)")
+    parser.add_argument("command", choices=["serve", "convert", "stats", "stop"], help="run the daemon, convert maps on it, print its stats or stop it")
+    parser.add_argument("arguments", nargs=REMAINDER, help="for convert, the arguments of python -m converter")
+    args = parser.parse_args(argv)
+
+    if args.port is not None or not hasattr(socket, "AF_UNIX"):
+        address = ("127.0.0.1", DEFAULT_PORT if args.port is None else args.port)
+    else:
+        address = args.socket or join(args.cache_dir, "daemon.sock")
+
+    if args.command == "serve":
+        return serve(address, args.cache_dir, args.jobs)
+
+    token = None if isinstance(address, str) else read_token(args.cache_dir)
+    if args.command == "convert":
+        return convert_command(address, args.arguments, token)
+    try:
+        response = call(address, "GET", "/stats", token=token) if args.command == "stats" else call(address, "POST", "/stop", token=token)
+    except OSError as e:
+        return not_running(address, e)
+    if "error" in response:
+        print(response["error"], file=sys.stderr)
+        return 1
+    print(format_stats(response) if args.command == "stats" else f"Stopped the daemon on {describe(address)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
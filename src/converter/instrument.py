@@ -0,0 +1,187 @@
+# tiled2hva API
+# Timing spans, counters and profiling for the converter
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import cProfile
+import pstats
+import tracemalloc
+from io import StringIO
+from threading import Lock
+from time import perf_counter
+
+### OBSERVERS
+class Observer:
+    """
+    Receives timing spans and counters from the converter, override the hooks needed
+    """
+    def span(self, stage:str, seconds:float) -> None:
+        pass
+
+    def count(self, counter:str, amount:int) -> None:
+        pass
+
+# Replaced rather than mutated, so hooks can iterate it from any thread
+observers:tuple = ()
+
+def add_observer(observer:Observer) -> None:
+    global observers
+    observers = observers + (observer,)
+
+def remove_observer(observer:Observer) -> None:
+    global observers
+    observers = tuple([registered for registered in observers if registered is not observer])
+
+### HOOKS
+class Span:
+    """
+    Times a stage, reporting it to every observer on exit
+    """
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage:str) -> None:
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exception) -> None:
+        record(self.stage, perf_counter() - self.start)
+
+class NullSpan:
+    """
+    Stands in for Span while nothing is observing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception) -> None:
+        pass
+
+NULL_SPAN = NullSpan()
+
+def span(stage:str):
+    """
+    Context manager timing a stage, free when there are no observers
+    """
+    return Span(stage) if observers else NULL_SPAN
+
+def record(stage:str, seconds:float) -> None:
+    for observer in observers:
+        observer.span(stage, seconds)
+
+def count(counter:str, amount:int=1) -> None:
+    for observer in observers:
+        observer.count(counter, amount)
+
+### RECORDING
+class Recorder(Observer):
+    """
+    Totals spans and counters, safe to share between threads
+    """
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # stage -> [calls, seconds]
+        self.spans = {}
+        self.counters = {}
+
+    def span(self, stage:str, seconds:float) -> None:
+        with self.lock:
+            totals = self.spans.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, counter:str, amount:int) -> None:
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def results(self) -> dict:
+        with self.lock:
+            return {
+                "spans": {stage: list(totals) for stage, totals in self.spans.items()},
+                "counters": dict(self.counters)
+            }
+
+    def merge(self, results:dict) -> None:
+        """
+        Adds results recorded elsewhere, such as in a worker process
+        """
+        with self.lock:
+            for stage, (calls, seconds) in results["spans"].items():
+                totals = self.spans.setdefault(stage, [0, 0.0])
+                totals[0] += calls
+                totals[1] += seconds
+            for counter, amount in results["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+
+class Profile:
+    """
+    Records spans and counters while active, optionally capturing cProfile stats and peak traced memory
+    cProfile only sees the thread that entered the Profile
+    """
+    def __init__(self, cprofile:bool=False, memory:bool=False) -> None:
+        self.recorder = Recorder()
+        self.profiler = cProfile.Profile() if cprofile else None
+        self.memory = memory
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        add_observer(self.recorder)
+        if self.memory:
+            tracemalloc.start()
+        if self.profiler:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exception) -> None:
+        if self.profiler:
+            self.profiler.disable()
+        if self.memory:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        remove_observer(self.recorder)
+
+    def results(self) -> dict:
+        return {**self.recorder.results(), "peak_bytes": self.peak_bytes}
+
+### REPORT
+def format_report(results:dict, stats:pstats.Stats=None, limit:int=30) -> str:  #type:ignore
+    """
+    Formats recorded results, and optionally cProfile stats, as a plain text report
+    """
+    report = StringIO()
+    report.write(f"{'stage':<16}{'calls':>8}{'total s':>12}{'mean ms':>12}\n")
+    for stage, (calls, seconds) in sorted(results["spans"].items(), key=lambda item: -item[1][1]):
+        report.write(f"{stage:<16}{calls:>8}{seconds:>12.3f}{seconds / calls * 1000:>12.3f}\n")
+
+    report.write(f"\n{'counter':<16}{'total':>12}\n")
+    for counter, amount in sorted(results["counters"].items()):
+        report.write(f"{counter:<16}{amount:>12}\n")
+
+    if results.get("peak_bytes"):
+        report.write(f"\npeak traced memory {results['peak_bytes'] / 1048576:.2f}MB\n")
+
+    if stats:
+        report.write("\n")
+        stats.stream = report  #type:ignore
+        stats.sort_stats("cumulative").print_stats(limit)
+    return report.getvalue()
@@ -0,0 +1,301 @@
+# tiled2hva API
+# Compact binary representation of parsed maps, cached on disk
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import struct
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ
+from os import getenv, getpid, makedirs, remove, replace, stat
+from os.path import join, split, realpath, expanduser
+from threading import get_ident
+
+import numpy as np
+
+from converter.core import Tilemap, Tileset, SparseLayer, VERSION
+from converter.instrument import span
+
+# Bump whenever the layout below changes
+IR_FORMAT = 2
+
+# magic, format, metadata offset, metadata length
+HEADER = struct.Struct("<6sHQQ")
+MAGIC = b"T2H-IR"
+
+# Object shape kinds, stored by index
+SHAPE_KINDS = ["polygon", "rectangle", "ellipse"]
+
+def default_cache_directory() -> str:
+    """
+    Per-user cache folder, next to the UI's config on Windows
+    """
+    if getenv("APPDATA"):
+        return join(getenv("APPDATA"), "tiled2hva", "cache")  #type:ignore
+    return join(getenv("XDG_CACHE_HOME") or expanduser("~/.cache"), "tiled2hva")
+
+def cache_path(filepath:str, cache_directory:str) -> str:
+    return join(cache_directory, sha1(realpath(filepath).encode()).hexdigest() + ".ir")
+
+def fingerprints(filepaths:list[str]) -> dict:
+    """
+    Modification time and size of each file, None for missing files
+    """
+    stats = {}
+    for filepath in filepaths:
+        try:
+            file_stat = stat(filepath)
+            stats[filepath] = [file_stat.st_mtime_ns, file_stat.st_size]
+        except OSError:
+            stats[filepath] = None
+    return stats
+
+### LOAD
+def load_tilemap(filepath:str, cache_directory:str=None):  #type:ignore
+    """
+    Opens a map from its cached representation, parsing the .tmx and caching it only when it or its tilesets changed
+    Returns a MapIR, which can be converted just like a Tilemap, or the parsed Tilemap when the cache can't be written
+    """
+    cache_directory = cache_directory or default_cache_directory()
+    ir_path = cache_path(filepath, cache_directory)
+
+    # Reuse cache when the map and its tilesets are unchanged
+    try:
+        with span("ir_load"):
+            return MapIR(ir_path, validate=True)
+    except (OSError, ValueError, KeyError, struct.error):
+        pass
+
+    tilemap = Tilemap(filepath)
+    try:
+        makedirs(cache_directory, exist_ok=True)
+        with span("ir_write"):
+            write_ir(tilemap, ir_path)
+    except OSError:
+        # Windows can't replace a cached file another process has mapped, so convert without caching this time
+        return tilemap
+    return MapIR(ir_path)
+
+### WRITE
+class IRWriter:
+    """
+    Appends int32 arrays to a file, keeping track of where each one went
+    """
+    def __init__(self, file) -> None:
+        self.file = file
+        self.offset = HEADER.size
+
+    def array(self, values) -> list[int]:
+        """
+        Writes an array, returning its [offset, count]
+        """
+        values = np.ascontiguousarray(values, dtype="<i4")
+        reference = [self.offset, int(values.size)]
+        data = values.tobytes()
+        # Keep arrays 8 byte aligned
+        padding = -len(data) % 8
+        self.file.write(data + b"\0" * padding)
+        self.offset += len(data) + padding
+        return reference
+
+def write_ir(tilemap:Tilemap, ir_path:str) -> None:
+    """
+    Streams a Tilemap's layers and objects to an IR file, metadata goes last so layers never have to be held together
+    """
+    # Write then swap, each writer to its own file, as the same map may be cached by several threads or processes at once
+    temp_path = f"{ir_path}.{getpid()}.{get_ident()}.tmp"
+    try:
+        write_ir_file(tilemap, temp_path)
+        replace(temp_path, ir_path)
+    except BaseException:
+        try:
+            remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def write_ir_file(tilemap:Tilemap, filepath:str) -> None:
+    strings = {}
+    def intern(value) -> int:
+        return strings.setdefault(str(value), len(strings))
+
+    with open(filepath, "wb") as file:
+        file.write(HEADER.pack(MAGIC, IR_FORMAT, 0, 0))
+        writer = IRWriter(file)
+
+        # Layers
+        layers = []
+        for name, tiles in tilemap.iter_layers():
+            if isinstance(tiles, SparseLayer):
+                xs, ys, cell_tiles = tiles.cells()
+                layers.append({"name": name, "sparse": {
+                    "xs": writer.array(xs),
+                    "ys": writer.array(ys),
+                    "tiles": writer.array(cell_tiles),
+                    "chunk_xs": writer.array([chunk[0] for chunk in tiles.chunks]),
+                    "chunk_ys": writer.array([chunk[1] for chunk in tiles.chunks]),
+                    "chunk_sizes": writer.array([chunk[2].size for chunk in tiles.chunks]),
+                }})
+            else:
+                layers.append({"name": name, "dense": {"tiles": writer.array(tiles), "shape": list(tiles.shape)}})
+
+        # Objects, with points packed together and properties interned
+        objects = tilemap.objects
+        object_metadata = {
+            "xs": writer.array([object[2] for object in objects]),
+            "ys": writer.array([object[3] for object in objects]),
+            "point_counts": writer.array([len(object[0]) for object in objects]),
+            "points": writer.array([coordinate for object in objects for point in object[0] for coordinate in point]),
+            "property_counts": writer.array([len(object[1]) for object in objects]),
+            "properties": writer.array([intern(part) for object in objects for item in object[1].items() for part in item]),
+            "shapes": writer.array([SHAPE_KINDS.index(object[4][0]) for object in objects]),
+            "shape_sizes": writer.array([size for object in objects for size in object[4][1:]]),
+        }
+
+        # As they were before parsing, so a map saved while it was cached is parsed again
+        sources = {realpath(join(*tilemap.filepath)): tilemap.fingerprint, **{tileset.filepath: tileset.fingerprint for tileset, firstgid, optimized_firstgid in tilemap.tileset_list}}
+        metadata = json.dumps({
+            "version": VERSION,
+            "sources": sources,
+            "tile_size": list(tilemap.tile_size),
+            "properties": tilemap.properties,
+            "tilesets": [[tileset.filepath, firstgid, optimized_firstgid] for tileset, firstgid, optimized_firstgid in tilemap.tileset_list],
+            "layers": layers,
+            "objects": object_metadata,
+            "strings": list(strings),
+        }).encode()
+
+        file.write(metadata)
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, IR_FORMAT, writer.offset, len(metadata)))
+
+### READ
+class MapIR:
+    """
+    A parsed map read back from an IR file, layers are memory mapped rather than loaded
+    Offers the same interface Convert uses on Tilemap
+    """
+    def __init__(self, ir_path:str, validate:bool=False) -> None:
+        with open(ir_path, "rb") as file:
+            self.buffer = mmap(file.fileno(), 0, access=ACCESS_READ)
+
+        magic, format, metadata_offset, metadata_length = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or format != IR_FORMAT:
+            raise ValueError("Not a current IR file")
+        self.metadata = json.loads(self.buffer[metadata_offset:metadata_offset + metadata_length])
+
+        # Stale if the converter, map or tilesets changed since caching
+        if validate and not self.is_current():
+            raise ValueError("IR file is out of date")
+
+        self.source = list(self.metadata["sources"])[0]
+        self.fingerprint = self.metadata["sources"][self.source]
+        self.filepath = split(self.source)
+        self.file_name = self.filepath[1]
+        self.tile_size = tuple(self.metadata["tile_size"])
+        self.properties = self.metadata["properties"]
+        self.mode = self.properties["hva:mode"]
+        self.name = self.properties["hva:name"]
+
+        # Tilesets are small and cached by Tileset.load
+        self.tileset_list = [
+            (Tileset.load(tileset_path), firstgid, optimized_firstgid)
+            for tileset_path, firstgid, optimized_firstgid in self.metadata["tilesets"]
+        ]
+
+        self.objects = self.read_objects()
+        self.layer_count = 0
+
+    def close(self) -> None:
+        """
+        Releases the mapped file, so it can be replaced on Windows
+        Layers still referenced keep it mapped until they are released
+        """
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass
+
+    def is_current(self) -> bool:
+        """
+        Checks the converter, map and tilesets are unchanged since caching, only stat-ing the files
+        """
+        sources = self.metadata["sources"]
+        return self.metadata["version"] == VERSION and fingerprints(list(sources)) == sources
+
+    def array(self, reference:list[int]) -> np.ndarray:
+        """
+        Maps an array stored in the file without copying it
+        """
+        offset, count = reference
+        return np.frombuffer(self.buffer, dtype="<i4", count=count, offset=offset)
+
+    def iter_layers(self):
+        """
+        Yields each layer as a (name, tiles) tuple, as Tilemap.iter_layers does
+        """
+        self.layer_count = 0
+        for layer in self.metadata["layers"]:
+            if "dense" in layer:
+                tiles = self.array(layer["dense"]["tiles"]).reshape(layer["dense"]["shape"])
+            else:
+                sparse = layer["sparse"]
+                xs, ys, cell_tiles = self.array(sparse["xs"]), self.array(sparse["ys"]), self.array(sparse["tiles"])
+                tiles = SparseLayer()
+                start = 0
+                for x, y, size in zip(self.array(sparse["chunk_xs"]).tolist(), self.array(sparse["chunk_ys"]).tolist(), self.array(sparse["chunk_sizes"]).tolist()):
+                    tiles.chunks.append((x, y, xs[start:start + size], ys[start:start + size], cell_tiles[start:start + size]))
+                    start += size
+            self.layer_count += 1
+            yield layer["name"], tiles
+
+    def read_objects(self) -> list[tuple]:
+        objects = self.metadata["objects"]
+        strings = self.metadata["strings"]
+        xs = self.array(objects["xs"]).tolist()
+        ys = self.array(objects["ys"]).tolist()
+        points = self.array(objects["points"]).tolist()
+        properties = self.array(objects["properties"]).tolist()
+        shapes = self.array(objects["shapes"]).tolist()
+        shape_sizes = self.array(objects["shape_sizes"]).tolist()
+
+        # Unpack points and properties of each object
+        unpacked = []
+        point_start = 0
+        property_start = 0
+        for index, (x, y, point_count, property_count) in enumerate(zip(xs, ys, self.array(objects["point_counts"]).tolist(), self.array(objects["property_counts"]).tolist())):
+            object_points = points[point_start:point_start + point_count * 2]
+            object_properties = properties[property_start:property_start + property_count * 2]
+            unpacked.append((
+                list(zip(object_points[0::2], object_points[1::2])),
+                {strings[object_properties[i]]: strings[object_properties[i + 1]] for i in range(0, len(object_properties), 2)},
+                x, y,
+                (SHAPE_KINDS[shapes[index]], shape_sizes[index * 2], shape_sizes[index * 2 + 1])
+            ))
+            point_start += point_count * 2
+            property_start += property_count * 2
+        return unpacked
+
+    def load_objects(self) -> list[tuple]:
+        """
+        Objects are read with the rest of the metadata, as Tilemap.load_objects would
+        """
+        return self.objects
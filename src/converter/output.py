@@ -0,0 +1,442 @@
+# tiled2hva API
+# Writes converted maps to destination folders
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from converter.core import Convert, ConversionError, Tilemap, VERSION
+from converter.instrument import span, count
+from converter.ir import load_tilemap, fingerprints
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from json import dump, load
+from os import mkdir, listdir, remove, replace, stat, link, getpid
+from os.path import join, normpath, realpath, exists, samefile
+from contextlib import contextmanager
+from shutil import copyfile, copystat
+from tempfile import gettempdir
+from threading import Lock, get_ident
+
+try:
+    from fcntl import ioctl, flock, LOCK_EX
+except ImportError:
+    ioctl = flock = None
+try:
+    from msvcrt import locking, LK_LOCK, LK_UNLCK
+except ImportError:
+    locking = None
+
+# Most image copies in flight at once
+COPY_WORKERS = 4
+# Linux ioctl to share a file's extents on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Held while saving a manifest, as file locks may not exclude threads of one process
+SAVE_LOCK = Lock()
+
+### WRITE
+def convert_and_write(map:str, destinations:list[str], nest:bool=False, options:dict=None, cache_directory:str=None, load=None, stage=None, images=None) -> tuple[Convert, dict | None]:  #type:ignore
+    """
+    Converts a single map and writes it to every destination, returning the conversion and its manifest entry
+    Maps are read through the IR cache unless cache_directory is None, or with load(map) when given
+    Images are synced through images, the ImageBatch or PendingImages of the map's batch, or for this map alone when None
+    Each step runs through stage(name, function, *args, **kwargs) when given, so front ends can time or cancel it
+    Manifests are shared between conversions, so entries are left for the caller to pass to record_maps
+    The entry is None when an input was saved while converting, as its changes may be missing from the output
+    """
+    if load is None:
+        load = (lambda map: load_tilemap(map, cache_directory)) if cache_directory else Tilemap
+    if stage is None:
+        stage = lambda name, function, *args, **kwargs: function(*args, **kwargs)
+
+    tilemap = stage("parse", load, map)
+    # Inputs as they were before being read, the map and tilesets are stat-ed before parsing and images are read from here on
+    inputs = {realpath(join(*tilemap.filepath)): tilemap.fingerprint}
+    inputs.update({tileset.filepath: tileset.fingerprint for tileset, firstgid, optimized_firstgid in tilemap.tileset_list})
+    inputs.update(fingerprints([realpath(join(tilemap.filepath[0], tileset.full_image_path)) for tileset, firstgid, optimized_firstgid in tilemap.tileset_list]))
+
+    # Only a single destination can be streamed without generating twice
+    convert = stage("generate", Convert, tilemap, stream=len(destinations) == 1, cache_directory=cache_directory, **(options or {}))
+    stage("write", write_maps, [convert], destinations, nest, False, images)
+
+    # Left unrecorded so the map is converted again, hashing the inputs as they are now would hide the change
+    entry = manifest_entry(convert, nest)
+    if fingerprints(list(inputs)) != inputs:
+        count("inputs_changed")
+        return convert, None  #type:ignore
+    return convert, entry
+
+def write_maps(converts:list[Convert], destinations:list[str], nest:bool=False, record:bool=True, images=None) -> None:
+    """
+    Writes already converted maps to every destination, one thread per destination
+    Unless record is False, each destination's manifest is updated with the written maps
+    Images are synced through images, an ImageBatch shared by a batch of maps or PendingImages, or for these maps alone when None
+    """
+    if not destinations:
+        return
+    if images is None:
+        with ImageBatch() as images:
+            write_maps(converts, destinations, nest, record, images)
+        return
+
+    # No need for threads with a single destination
+    if len(destinations) == 1:
+        write_destination(converts, destinations[0], nest, record, images)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+        futures = [executor.submit(write_destination, converts, destination, nest, record, images) for destination in destinations]
+        # Raise the first error, if any
+        for future in futures:
+            future.result()
+
+def write_destination(converts:list[Convert], destination:str, nest:bool, record:bool, images) -> None:
+    """
+    Writes converted maps to a single destination, syncing their images through images
+    """
+    manifest = Manifest(destination) if record else None
+    map_images = {}
+    for convert in converts:
+        # path to destination folder
+        full_destination = normpath(join(
+            destination,
+            f"{convert.map_name}/" if nest else "" # grab name
+        ))
+
+        try:
+            mkdir(full_destination)
+        except FileExistsError as e:
+            if nest:
+                # Images are kept so unchanged ones aren't copied again
+                for file in set(listdir(full_destination)) - set(convert.images):
+                    remove(join(full_destination, file))
+
+        with span("write"):
+            mode = "wb" if convert.binary else "w+"
+            with open(join(full_destination, convert.tileset_file), mode) as file:
+                convert.write_tres(file)
+                count("bytes_written", file.tell())
+
+            with open(join(full_destination, convert.scene_file), mode) as file:
+                convert.write_tscn(file)
+                count("bytes_written", file.tell())
+
+        # Images shared between maps are only synced once
+        for image, source in convert.image_sources.items():
+            map_images.setdefault(join(full_destination, image), source)
+
+        if manifest:
+            manifest.update(manifest_entry(convert, nest))
+
+    with span("copy"):
+        images.sync(map_images)
+
+    if manifest:
+        manifest.save()
+
+### BATCH
+def convert_batch(maps:list[str], destinations:list[str], nest:bool, options:dict, submit, force:bool=False, report=None) -> tuple[list[str], list[dict], dict]:  #type:ignore
+    """
+    Converts the stale maps of a batch and records them, returning the up to date maps, a result per stale map and the manifest entries by map
+    submit(map, images) starts a map, returning a future of a dict with its map name, seconds, manifest entry and any images left to sync
+    Results hold the map with either its error or the rest of that dict, and are passed to report as each map finishes
+    """
+    # Skip maps whose inputs are unchanged
+    stale = maps if force else stale_maps(maps, destinations, nest, options)
+
+    results = []
+    entries = {}
+    with ImageBatch() as images:
+        futures = [(map, submit(map, images)) for map in stale]
+
+        # Report each map, without stopping the batch on errors
+        for map, future in futures:
+            try:
+                result = {"map": map, **future.result()}
+                # Maps sharing an image sync it once, including those written in other processes
+                images.sync(result.pop("images", {}))
+                # Maps saved while converting stay out of date
+                entry = result.pop("entry")
+                if entry:
+                    entries[map] = entry
+                else:
+                    result["changed"] = True
+            except ConversionError as e:
+                result = {"map": map, "error": str(e)}
+            except Exception as e:
+                result = {"map": map, "error": f"{type(e).__name__}: {e}"}
+            results.append(result)
+            if report:
+                report(result)
+
+    # Record converted maps, destinations are only created once a map is written
+    record_maps(destinations, list(entries.values()))
+    return [map for map in maps if map not in stale], results, entries
+
+### IMAGES
+class ImageBatch:
+    """
+    Syncs the images of a batch of maps on a bounded thread pool, each destination path only once however many maps use it
+    Maps written at once wait for images another map already started syncing, sharing its result
+    """
+    def __init__(self) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=COPY_WORKERS)
+        self.lock = Lock()
+        # destination path -> Future of its sync
+        self.syncs = {}
+
+    def __enter__(self) -> "ImageBatch":
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def sync(self, images:dict[str, str]) -> None:
+        """
+        Syncs images, keyed by destination path, from their source paths, raising the first error
+        """
+        with self.lock:
+            for destination, source in images.items():
+                if destination not in self.syncs:
+                    self.syncs[destination] = self.executor.submit(sync_file, source, destination)
+            futures = [self.syncs[destination] for destination in images]
+        for future in futures:
+            future.result()
+
+class PendingImages:
+    """
+    Collects images instead of syncing them, for maps written in another process than their batch's ImageBatch
+    """
+    def __init__(self) -> None:
+        self.images = {}
+
+    def sync(self, images:dict[str, str]) -> None:
+        self.images.update(images)
+
+def sync_file(source:str, destination:str) -> bool:
+    """
+    Copies a file unless the destination already has the same contents, returning whether it was copied
+    Identical destinations are left untouched so their modification times stay stable
+    """
+    if is_identical(source, destination):
+        count("images_skipped")
+        return False
+
+    # Link or copy next to the destination, then swap, so readers never see a partial image
+    # Maps sharing an image may sync it at once, so each writer has its own temporary file
+    temp_destination = f"{destination}.{getpid()}.{get_ident()}.tmp"
+    if exists(temp_destination):
+        remove(temp_destination)
+    if reflink(source, temp_destination):
+        count("images_reflinked")
+    else:
+        try:
+            link(source, temp_destination)
+            count("images_linked")
+        except OSError:
+            copyfile(source, temp_destination)
+            count("bytes_copied", stat(temp_destination).st_size)
+    # Matching modification times let the next sync skip without hashing
+    copystat(source, temp_destination)
+    replace(temp_destination, destination)
+    return True
+
+def is_identical(source:str, destination:str) -> bool:
+    """
+    Compares size and modification time, only hashing when those disagree
+    """
+    try:
+        source_stat = stat(source)
+        destination_stat = stat(destination)
+    except FileNotFoundError:
+        return False
+
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    if source_stat.st_mtime_ns == destination_stat.st_mtime_ns or samefile(source, destination):
+        return True
+    return file_hash(source) == file_hash(destination)
+
+def reflink(source:str, destination:str) -> bool:
+    """
+    Clones a file sharing its data where the filesystem supports it, returning whether it did
+    """
+    if ioctl is None:
+        return False
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            pass
+    remove(destination)
+    return False
+
+def output_files(convert:Convert, nest:bool=False) -> list[str]:
+    """
+    Lists the files written for a converted map, relative to the destination
+    """
+    folder = f"{convert.map_name}/" if nest else ""
+    return [
+        normpath(f"{folder}{convert.tileset_file}"),
+        normpath(f"{folder}{convert.scene_file}")
+    ] + [normpath(join(folder, image)) for image in convert.images]
+
+### MANIFEST
+def fingerprint(filepath:str) -> dict:
+    """
+    Records the modification time, size and content hash of a file
+    """
+    file_stat = stat(filepath)
+    return {
+        "mtime": file_stat.st_mtime_ns,
+        "size": file_stat.st_size,
+        "sha1": file_hash(filepath)
+    }
+
+def file_hash(filepath:str) -> str:
+    """
+    Hashes the contents of a file
+    """
+    file_sha1 = sha1()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            file_sha1.update(block)
+    return file_sha1.hexdigest()
+
+def manifest_entry(convert:Convert, nest:bool=False) -> dict:
+    """
+    Describes the inputs and outputs of a converted map for a manifest
+    """
+    # Tileset images are inputs even when packed into an atlas
+    inputs = [convert.source] + convert.tilesets + [realpath(join(convert.directory, set.full_image_path)) for set in convert.sets]
+    return {
+        "source": convert.source,
+        "version": VERSION,
+        "nest": nest,
+        "options": convert.options,
+        "inputs": {input: fingerprint(input) for input in inputs},
+        "outputs": output_files(convert, nest)
+    }
+
+class Manifest:
+    """
+    Tracks which maps in a destination are up to date with their source files
+    """
+    FILE_NAME = ".tiled2hva.json"
+
+    def __init__(self, destination:str) -> None:
+        self.destination = destination
+        self.filepath = join(destination, Manifest.FILE_NAME)
+        self.maps = {}
+        # Entries updated since loading, which are kept over those saved meanwhile
+        self.updated = {}
+
+        # Start over if the manifest is missing or unreadable
+        try:
+            with open(self.filepath, "r") as file:
+                self.maps = load(file)
+        except (OSError, ValueError):
+            pass
+
+    def is_current(self, map:str, nest:bool=False, options:dict=None) -> bool:  #type:ignore
+        """
+        Checks whether a map's outputs exist and none of its inputs, the converter or its options changed
+        """
+        entry = self.maps.get(realpath(map))
+        if not entry or entry.get("version") != VERSION or entry.get("nest") != nest:
+            return False
+        if options is not None and entry.get("options") != options:
+            return False
+
+        for output in entry["outputs"]:
+            if not exists(join(self.destination, output)):
+                return False
+
+        for input, recorded in entry["inputs"].items():
+            try:
+                file_stat = stat(input)
+            except OSError:
+                return False
+            # Only hash when the file was touched
+            if file_stat.st_mtime_ns == recorded["mtime"] and file_stat.st_size == recorded["size"]:
+                continue
+            if file_stat.st_size != recorded["size"] or file_hash(input) != recorded["sha1"]:
+                return False
+        return True
+
+    def update(self, entry:dict) -> None:
+        self.maps[entry["source"]] = entry
+        self.updated[entry["source"]] = entry
+
+    def save(self) -> None:
+        """
+        Saves updated entries, keeping those other front ends saved since this manifest was loaded
+        """
+        # Locked outside the destination, which is part of a game project
+        with locked(join(gettempdir(), f"tiled2hva-{sha1(realpath(self.filepath).encode()).hexdigest()}.lock")):
+            self.maps = {**Manifest(self.destination).maps, **self.updated}
+            # Write then swap, so an interrupted save never leaves a broken manifest
+            temp_filepath = f"{self.filepath}.{getpid()}.{get_ident()}.tmp"
+            with open(temp_filepath, "w") as file:
+                dump(self.maps, file, indent=1)
+            replace(temp_filepath, self.filepath)
+
+@contextmanager
+def locked(filepath:str):
+    """
+    Holds a lock file across threads and, where the platform locks files, processes
+    """
+    with SAVE_LOCK, open(filepath, "a") as file:
+        if flock:
+            # Released when the file is closed
+            flock(file.fileno(), LOCK_EX)
+        elif locking:
+            # Locks the first byte, from the current position
+            file.seek(0)
+            locking(file.fileno(), LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if not flock and locking:
+                file.seek(0)
+                locking(file.fileno(), LK_UNLCK, 1)
+
+def record_maps(destinations:list[str], entries:list[dict]) -> None:
+    """
+    Records converted maps in every destination's manifest
+    Destinations are only created once a map is written, so nothing is recorded without entries
+    """
+    for destination in destinations if entries else []:
+        manifest = Manifest(destination)
+        for entry in entries:
+            manifest.update(entry)
+        manifest.save()
+
+def stale_maps(maps:list[str], destinations:list[str], nest:bool=False, options:dict=None) -> list[str]:  #type:ignore
+    """
+    Filters maps down to those out of date in at least one destination
+    Options are the Convert keyword arguments the maps will be converted with
+    """
+    manifests = [Manifest(destination) for destination in destinations]
+    return [map for map in maps if not all([manifest.is_current(map, nest, options) for manifest in manifests])]
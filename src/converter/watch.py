@@ -0,0 +1,87 @@
+# tiled2hva API
+# Watches maps and the files they reference for changes
+
+# Copyright (c) 2023 Caleb North
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sellcccccc
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from os import stat
+from os.path import realpath
+from time import sleep, monotonic
+
+### WATCH
+class Watcher:
+    """
+    Polls the files each map depends on, reporting the maps affected by changes
+    Used for headless runs, the UI uses QFileSystemWatcher instead
+    """
+    def __init__(self, debounce:float=0.3, interval:float=0.1) -> None:
+        self.debounce = debounce
+        self.interval = interval
+        # map -> files it depends on
+        self.maps = {}
+        # file -> (mtime, size)
+        self.stats = {}
+
+    def watch(self, map:str, inputs:list[str]=None) -> None:  #type:ignore
+        """
+        Watches a map along with the files it references, the map itself is always watched
+        """
+        self.maps[map] = set([realpath(map)] + (inputs or []))
+        for input in self.maps[map]:
+            if input not in self.stats:
+                self.stats[input] = Watcher.file_stat(input)
+
+    def changed_files(self) -> set[str]:
+        """
+        Finds watched files modified since the last check
+        """
+        changed = set()
+        for input in set().union(*self.maps.values()):
+            file_stat = Watcher.file_stat(input)
+            if file_stat != self.stats.get(input):
+                self.stats[input] = file_stat
+                changed.add(input)
+        return changed
+
+    def affected_maps(self, changed:set[str]) -> list[str]:
+        return [map for map, inputs in self.maps.items() if inputs & changed]
+
+    def wait(self) -> list[str]:
+        """
+        Blocks until watched files change, then waits for saves to settle and returns the affected maps
+        """
+        changed = set()
+        settle_time = None
+        while True:
+            new_changes = self.changed_files()
+            if new_changes:
+                changed |= new_changes
+                settle_time = monotonic() + self.debounce
+            elif settle_time and monotonic() >= settle_time:
+                return self.affected_maps(changed)
+            sleep(self.interval)
+
+    @staticmethod
+    def file_stat(filepath:str) -> tuple:
+        try:
+            file_stat = stat(filepath)
+        except OSError:
+            return None  #type:ignore
+        return (file_stat.st_mtime_ns, file_stat.st_size)
@@ -0,0 +1,19 @@
+import shutil
+import sys
+from os.path import dirname, join
+
+import pytest
+
+# The converter lives in src/ without being installed, as the UI runs it from there
+sys.path.insert(0, join(dirname(dirname(__file__)), "src"))
+
+FIXTURES = join(dirname(__file__), "fixtures")
+
+@pytest.fixture
+def basic_map(tmp_path):
+    """
+    A copy of the basic fixture map, whose tilesets are listed out of firstgid order
+    """
+    directory = tmp_path / "basic"
+    shutil.copytree(join(FIXTURES, "basic"), directory, ignore=shutil.ignore_patterns("expected"))
+    return str(directory / "map.tmx")
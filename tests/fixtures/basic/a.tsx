@@ -0,0 +1,7 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<tileset version="1.9" tiledversion="1.9.2" name="a" tilewidth="16" tileheight="16" tilecount="16" columns="4">
+<image source="a.png" width="64" height="64"/>
+<tile id="0"><objectgroup draworder="index" id="2"><object id="1" x="0" y="0" width="16" height="16"/><object id="2" x="2" y="3"><polygon points="0,0 8,0 8,8"/></object></objectgroup></tile>
+<tile id="3"><objectgroup draworder="index" id="2"><object id="1" x="0" y="0" width="16" height="16"/></objectgroup></tile>
+<tile id="6"><objectgroup draworder="index" id="2"><object id="1" x="0" y="0" width="16" height="16"/><object id="2" x="2" y="3"><polygon points="0,0 8,0 8,8"/></object></objectgroup></tile>
+</tileset>
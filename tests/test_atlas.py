@@ -0,0 +1,33 @@
+import pytest
+
+from converter import Convert, Tilemap, write_maps
+
+pytest.importorskip("PySide6.QtGui")
+
+@pytest.fixture
+def shared_image_map(basic_map, tmp_path):
+    """
+    The basic map with a third tileset using the same image as tileset a
+    """
+    directory = tmp_path / "basic"
+    (directory / "c.tsx").write_text((directory / "a.tsx").read_text().replace('name="a"', 'name="c"'))
+    map_path = directory / "map.tmx"
+    map_path.write_text(map_path.read_text().replace('<tileset firstgid="1" source="a.tsx"/>', '<tileset firstgid="1" source="a.tsx"/>\n<tileset firstgid="25" source="c.tsx"/>'))
+    return str(map_path)
+
+def test_tilesets_sharing_an_image(shared_image_map, tmp_path):
+    convert = Convert(Tilemap(shared_image_map), atlas=True, cache_directory=str(tmp_path / "cache"))
+    # b, a, then c, which shares a's image
+    assert len(convert.textures) == 3
+    assert convert.textures[1] == convert.textures[2]
+    assert convert.textures[0][1] != convert.textures[1][1]
+
+    write_maps([convert], [str(tmp_path / "out")])
+    assert sorted([path.name for path in (tmp_path / "out").iterdir()]) == [".tiled2hva.json", "koth_Basic.tres", "koth_Basic.tscn", "koth_Basic_atlas.png"]
+
+def test_atlas_regions_match_cached_atlas(shared_image_map, tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    packed = Convert(Tilemap(shared_image_map), atlas=True, cache_directory=cache_directory)
+    cached = Convert(Tilemap(shared_image_map), atlas=True, cache_directory=cache_directory)
+    assert packed.textures == cached.textures
+    assert packed.tres == cached.tres
@@ -0,0 +1,104 @@
+import json
+import os
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from converter import daemon
+from converter.daemon import Daemon
+
+# Every option, as the client sends them
+OPTIONS = {"merge_collisions": False, "prune_tiles": False, "atlas": False, "binary": False, "chunk_size": 0, "object_grid": 0}
+
+def convert_request(map:str, destination:str, **request) -> dict:
+    return {"maps": [map], "destinations": [destination], "options": OPTIONS, **request}
+
+def touch_later(filepath:str) -> None:
+    file_stat = os.stat(filepath)
+    os.utime(filepath, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1_000_000_000))
+
+def test_repeated_conversions_reuse_the_map(basic_map, tmp_path):
+    service = Daemon(str(tmp_path / "cache"), jobs=2)
+    try:
+        destination = str(tmp_path / "out")
+        first = service.convert(convert_request(basic_map, destination))
+        assert "error" not in first["results"][0]
+        assert service.convert(convert_request(basic_map, destination))["up_to_date"] == [basic_map]
+        service.convert(convert_request(basic_map, destination, force=True))
+
+        stats = service.stats()
+        assert stats["tilemap_cache"] == {"hits": 1, "misses": 1, "size": 1}
+        assert stats["maps"] == {"converted": 2, "up_to_date": 1, "failed": 0}
+    finally:
+        service.close()
+
+def test_changed_map_is_reloaded(basic_map, tmp_path):
+    service = Daemon(str(tmp_path / "cache"), jobs=1)
+    try:
+        destination = str(tmp_path / "out")
+        service.convert(convert_request(basic_map, destination))
+        old_tilemap = service.tilemaps[os.path.realpath(basic_map)]
+
+        touch_later(basic_map)
+        result = service.convert(convert_request(basic_map, destination, force=True))["results"][0]
+        assert "error" not in result
+        # The old IR is unmapped before its file is replaced
+        assert old_tilemap.buffer.closed
+        assert service.tilemaps[os.path.realpath(basic_map)] is not old_tilemap
+    finally:
+        service.close()
+
+def test_kept_maps_are_bounded(basic_map, tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, "TILEMAP_CACHE_SIZE", 1)
+    other_map = tmp_path / "basic" / "other.tmx"
+    other_map.write_text((tmp_path / "basic" / "map.tmx").read_text().replace('value="Basic"', 'value="Other"'))
+
+    service = Daemon(str(tmp_path / "cache"), jobs=1)
+    try:
+        service.convert({"maps": [basic_map, str(other_map)], "destinations": [str(tmp_path / "out")], "options": OPTIONS})
+        assert list(service.tilemaps) == [os.path.realpath(other_map)]
+    finally:
+        service.close()
+
+@pytest.fixture
+def server(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), daemon.RequestHandler)
+    server.daemon = Daemon(str(tmp_path / "cache"), jobs=1)  #type:ignore
+    server.token = daemon.write_token(str(tmp_path / "cache"))  #type:ignore
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.daemon.close()  #type:ignore
+
+def post(server, path:str, body:bytes, headers:dict) -> int:
+    connection = HTTPConnection(*server.server_address)
+    try:
+        connection.request("POST", path, body, {"Authorization": f"Bearer {server.token}", **headers})
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+def test_requests_from_web_pages_are_refused(server, basic_map, tmp_path):
+    body = json.dumps(convert_request(basic_map, str(tmp_path / "out"))).encode()
+    # A simple request any page can send
+    assert post(server, "/convert", body, {"Content-Type": "text/plain"}) == 415
+    assert post(server, "/stop", b"", {}) == 415
+    assert post(server, "/convert", body, {"Content-Type": "application/json", "Origin": "http://example.com"}) == 403
+    assert post(server, "/convert", body, {"Content-Type": "application/json", "Host": "example.com"}) == 403
+    # Other local users can't read the token
+    assert post(server, "/convert", body, {"Content-Type": "application/json", "Authorization": ""}) == 401
+    assert post(server, "/convert", body, {"Content-Type": "application/json", "Authorization": "Bearer guess"}) == 401
+    assert not (tmp_path / "out").exists()
+
+    assert post(server, "/convert", body, {"Content-Type": "application/json"}) == 200
+    assert (tmp_path / "out").exists()
+
+def test_client_calls(server, tmp_path):
+    token = daemon.read_token(str(tmp_path / "cache"))
+    assert os.stat(tmp_path / "cache" / daemon.TOKEN_FILE_NAME).st_mode & 0o777 == 0o600
+    assert daemon.call(server.server_address, "GET", "/stats", token=token)["requests"] == 0
+    assert "error" in daemon.call(server.server_address, "GET", "/stats")
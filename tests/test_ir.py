@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+from converter import Tilemap
+from converter.ir import MapIR, cache_path, load_tilemap, write_ir
+
+def test_concurrent_writes_of_one_map(basic_map, tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    ir_path = cache_path(basic_map, cache_directory)
+    (tmp_path / "cache").mkdir()
+
+    for trial in range(10):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(write_ir, Tilemap(basic_map), ir_path) for writer in range(4)]
+            for future in futures:
+                future.result()
+        assert MapIR(ir_path, validate=True).is_current()
+
+    # Every writer swapped its own temporary file in
+    assert not glob(ir_path + "*.tmp")
+
+def test_concurrent_loads_of_one_map(basic_map, tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tilemaps = list(executor.map(lambda writer: load_tilemap(basic_map, cache_directory), range(8)))
+    layers = [[(name, tiles.tolist()) for name, tiles in tilemap.iter_layers()] for tilemap in tilemaps]
+    assert all([tilemap_layers == layers[0] for tilemap_layers in layers])
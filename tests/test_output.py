@@ -0,0 +1,384 @@
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from io import BytesIO
+from os import listdir, stat, utime
+from os.path import dirname, exists, join
+from shutil import copyfile
+
+import numpy as np
+import pytest
+
+from converter import Convert, ConversionError, Tilemap, write_maps, binary
+from converter.ir import load_tilemap
+from converter import output
+from converter.output import ImageBatch, Manifest, convert_and_write, convert_batch, record_maps, stale_maps, sync_file
+
+FIXTURES = join(dirname(__file__), "fixtures")
+
+def read(filepath:str) -> str:
+    with open(filepath, "r") as file:
+        return file.read()
+
+# The tscn is what the original converter wrote, the tres matches it apart from shapes shared since
+@pytest.mark.parametrize("file_name", ["koth_Basic.tres", "koth_Basic.tscn"])
+@pytest.mark.parametrize("cached", [False, True])
+def test_output_matches_fixture(basic_map, tmp_path, file_name, cached):
+    tilemap = load_tilemap(basic_map, str(tmp_path / "cache")) if cached else Tilemap(basic_map)
+    write_maps([Convert(tilemap)], [str(tmp_path / "out")])
+    assert read(str(tmp_path / "out" / file_name)) == read(join(FIXTURES, "basic", "expected", file_name))
+
+def test_text_values_round_trip():
+    assert Convert.text_value(16.0) == "16"
+    assert Convert.text_value(-3) == "-3"
+    assert Convert.text_value(0.5) == "0.5"
+    assert Convert.text_value(1234567.5) == "1234567.5"
+    assert Convert.text_value(binary.Vector2(1234567.5, 2.25)) == "Vector2( 1234567.5, 2.25 )"
+
+def tres_tiles(tres:str) -> dict:
+    """
+    Tile id -> texture path, region and shape points of a text TileSet
+    """
+    textures = dict([(id, path) for path, id in re.findall(r'path="([^"]+)" type="Texture" id=(\d+)', tres)])
+    shapes = dict(re.findall(r'id=(\d+)\]\npoints = PoolVector2Array\( ([^)]*) \)', tres))
+    tiles = {}
+    for id, texture in re.findall(r"^(\d+)/texture = ExtResource\( (\d+) \)", tres, re.M):
+        region = re.search(rf"^{id}/region = (.*)$", tres, re.M).group(1)  #type:ignore
+        shape_ids = re.findall(r"SubResource\( (\d+) \)", re.search(rf"^{id}/shapes? = (.*)$", tres, re.M).group(1))  #type:ignore
+        tiles[int(id)] = (textures[texture], region, [shapes[shape_id] for shape_id in shape_ids])
+    return tiles
+
+def tscn_cells(tscn:str) -> dict:
+    """
+    (layer, cell key) -> tile of every placed tile, flip flags included
+    """
+    cells = {}
+    for layer, data in enumerate(re.findall(r"tile_data = PoolIntArray\(([^)]*)\)", tscn)):
+        values = [int(value) for value in data.split(",")]
+        for key, tile in zip(values[0::3], values[1::3]):
+            cells[(layer, key)] = tile
+    return cells
+
+def test_pruned_tiles_match_the_tscn(basic_map):
+    full = Convert(Tilemap(basic_map))
+    pruned = Convert(Tilemap(basic_map), prune_tiles=True)
+    full_tiles, pruned_tiles = tres_tiles(full.tres), tres_tiles(pruned.tres)
+    full_cells, pruned_cells = tscn_cells(full.tscn), tscn_cells(pruned.tscn)
+    assert full_cells.keys() == pruned_cells.keys()
+
+    # Only placed tiles are kept, numbered from 1
+    used = {tile & 0x1FFFFFFF for tile in pruned_cells.values()}
+    assert sorted(pruned_tiles) == sorted(used) == list(range(1, len(used) + 1))
+    assert len(pruned_tiles) < len(full_tiles)
+
+    # Every cell still shows the same image and shapes, with the same flips
+    for cell, tile in pruned_cells.items():
+        full_tile = full_cells[cell]
+        assert tile >> 29 == full_tile >> 29
+        assert pruned_tiles[tile & 0x1FFFFFFF] == full_tiles[full_tile & 0x1FFFFFFF]
+
+class ResourceReader:
+    """
+    Reads back the header, string table and property tables of a binary resource, for the variants the converter writes
+    """
+    def __init__(self, data:bytes) -> None:
+        assert data[:4] == data[-4:] == binary.MAGIC
+        self.data = data
+        self.offset = 4
+
+    def unpack(self, format:str) -> tuple:
+        values = struct.unpack_from(format, self.data, self.offset)
+        self.offset += struct.calcsize(format)
+        return values
+
+    def string(self) -> str:
+        [length] = self.unpack("<I")
+        self.offset += length
+        assert self.data[self.offset - 1] == 0
+        return self.data[self.offset - length:self.offset - 1].decode()
+
+    def variant(self):
+        [kind] = self.unpack("<I")
+        if kind == binary.VARIANT_BOOL:
+            return bool(self.unpack("<I")[0])
+        if kind == binary.VARIANT_INT:
+            return self.unpack("<i")[0]
+        if kind == binary.VARIANT_REAL:
+            return self.unpack("<f")[0]
+        if kind == binary.VARIANT_STRING:
+            return self.string()
+        if kind == binary.VARIANT_VECTOR2:
+            return binary.Vector2(*self.unpack("<2f"))
+        if kind == binary.VARIANT_RECT2:
+            return binary.Rect2(*self.unpack("<4f"))
+        if kind == binary.VARIANT_TRANSFORM2D:
+            return binary.Transform2D(*self.unpack("<6f"))
+        if kind == binary.VARIANT_COLOR:
+            return binary.Color(*self.unpack("<4f"))
+        if kind == binary.VARIANT_OBJECT:
+            object_kind, index = self.unpack("<II")
+            return binary.ExtResource(index + 1) if object_kind == binary.OBJECT_EXTERNAL_RESOURCE_INDEX else binary.SubResource(index)
+        if kind == binary.VARIANT_DICTIONARY:
+            return dict([(self.variant(), self.variant()) for item in range(self.unpack("<I")[0])])
+        if kind == binary.VARIANT_ARRAY:
+            return [self.variant() for item in range(self.unpack("<I")[0])]
+        if kind == binary.VARIANT_INT_ARRAY:
+            [size] = self.unpack("<I")
+            return list(self.unpack(f"<{size}i"))
+        if kind == binary.VARIANT_VECTOR2_ARRAY:
+            [size] = self.unpack("<I")
+            return list(self.unpack(f"<{size * 2}f"))
+        raise ValueError(f"Unexpected variant {kind}")
+
+    def read(self) -> dict:
+        big_endian, long_offsets, major, minor, format_version = self.unpack("<5I")
+        assert (big_endian, long_offsets, (major, minor), format_version) == (0, 0, binary.ENGINE_VERSION, binary.FORMAT_VERSION)
+        type = self.string()
+        self.unpack("<Q14I")
+        names = [self.string() for name in range(self.unpack("<I")[0])]
+        ext_resources = [(self.string(), self.string()) for resource in range(self.unpack("<I")[0])]
+        bodies = [(self.string(), self.unpack("<Q")[0]) for body in range(self.unpack("<I")[0])]
+
+        resources = []
+        for path, offset in bodies:
+            self.offset = offset
+            resource_type = self.string()
+            properties = [(names[self.unpack("<I")[0]], self.variant()) for property in range(self.unpack("<I")[0])]
+            resources.append((path, resource_type, properties))
+        return {"type": type, "names": names, "ext_resources": ext_resources, "resources": resources}
+
+def test_resource_round_trip():
+    writer = binary.ResourceWriter("TileSet")
+    texture = writer.ext_resource("res://a.png", "Texture")
+    points = np.array([0, 0, 16, 0, 16, 16], dtype=np.float32)
+    shape = writer.sub_resource("ConvexPolygonShape2D", [("points", binary.PoolVector2Array(points))])
+    properties = [
+        ("0/name", "tile ü"),
+        ("0/texture", texture),
+        ("0/region", binary.Rect2(0, 16, 16, 16)),
+        ("0/shapes", [shape]),
+        ("1/texture", texture),
+        ("1/z_index", -3),
+        ("1/offset", binary.Vector2(0.5, -2.25)),
+        ("tile_data", binary.PoolIntArray(np.array([0, -2147483648, 2147483647], dtype=np.int32))),
+    ]
+    file = BytesIO()
+    writer.write(file, properties, "res://map.res")
+
+    resource = ResourceReader(file.getvalue()).read()
+    assert resource["type"] == "TileSet"
+    assert resource["ext_resources"] == [("Texture", "res://a.png")]
+    # Names are stored once, however many properties use them
+    assert len(resource["names"]) == len(set(resource["names"])) == 9
+    assert resource["resources"] == [
+        ("local://1", "ConvexPolygonShape2D", [("points", points.tolist())]),
+        ("res://map.res", "TileSet", [(name, value.values.tolist() if isinstance(value, binary.PoolIntArray) else value) for name, value in properties]),
+    ]
+
+def test_binary_tileset_matches_text(basic_map):
+    text = Convert(Tilemap(basic_map))
+    resource = ResourceReader(Convert(Tilemap(basic_map), binary=True).tres).read()
+    [(path, type, properties)] = [body for body in resource["resources"] if body[1] == "TileSet"]
+    regions = {int(name.split("/")[0]): value for name, value in properties if name.endswith("/region")}
+    assert regions == {id: binary.Rect2(*map(float, region[6:-1].split(","))) for id, (texture, region, shapes) in tres_tiles(text.tres).items()}
+
+def test_chunked_layers_hold_every_cell_once(basic_map):
+    whole = tscn_cells(Convert(Tilemap(basic_map)).tscn)
+    tscn = Convert(Tilemap(basic_map), chunk_size=5).tscn
+    chunks = re.findall(r'type="TileMap" parent="(\w+)"\]\nposition = Vector2\( (-?\d+), (-?\d+) \)\n(?:.*\n)*?tile_data = PoolIntArray\(([^)]*)\)', tscn)
+    assert len(chunks) > 4
+
+    chunked = []
+    layers = list(dict.fromkeys([layer for layer, x, y, data in chunks]))
+    for layer, x, y, data in chunks:
+        values = [int(value) for value in data.split(",")]
+        for key, tile in zip(values[0::3], values[1::3]):
+            # Chunk cells are relative to the chunk's corner, 16 pixel tiles
+            cell_x, cell_y = (key & 0xFFFF) + int(x) // 16, (key >> 16) + int(y) // 16
+            chunked.append(((layers.index(layer), (cell_y << 16) | cell_x), tile))
+    assert sorted(chunked) == sorted(whole.items())
+
+def test_primitive_objects_and_grid(basic_map):
+    # Rectangle, circle, wide and tall ellipses, a rectangle sharing the first one's shape, then an object left out of the grid
+    objects = [
+        ("zone", 64, 0, 32, 16, ""), ("point", 0, 0, 20, 20, "<ellipse/>"), ("zone", 30, 60, 40, 20, "<ellipse/>"),
+        ("point", 100, 100, 20, 40, "<ellipse/>"), ("point", 0, 96, 32, 16, ""), ("spawn", 160, 160, 16, 16, ""),
+    ]
+    with open(basic_map, "r+") as file:
+        text = file.read().replace("</objectgroup>", "".join([
+            f'<object id="{id}" x="{x}" y="{y}" width="{width}" height="{height}"><properties><property name="type" value="{type}"/></properties>{extra}</object>'
+            for id, (type, x, y, width, height, extra) in enumerate(objects, 4)
+        ]) + "</objectgroup>")
+        file.seek(0)
+        file.write(text)
+
+    assert Convert.primitive_shape(("rectangle", 32, 16)) == ("RectangleShape2D", [("extents", binary.Vector2(16, 8))], False)
+    assert Convert.primitive_shape(("ellipse", 20, 20)) == ("CircleShape2D", [("radius", 10)], False)
+    assert Convert.primitive_shape(("ellipse", 40, 20)) == ("CapsuleShape2D", [("radius", 10), ("height", 20)], True)
+    assert Convert.primitive_shape(("ellipse", 20, 40)) == ("CapsuleShape2D", [("radius", 10), ("height", 20)], False)
+
+    convert = Convert(Tilemap(basic_map), object_grid=32)
+    tscn = convert.tscn
+    assert convert.object_shapes == {("rectangle", 32, 16): 1, ("ellipse", 20, 20): 2, ("ellipse", 40, 20): 3, ("ellipse", 20, 40): 4, ("rectangle", 16, 16): 5}
+    assert tscn.startswith("[gd_scene load_steps=8 format=2]")
+    assert '[sub_resource type="RectangleShape2D" id=1]\nextents = Vector2( 16, 8 )\n' in tscn
+    assert '[sub_resource type="CapsuleShape2D" id=3]\nradius = 10\nheight = 20\n' in tscn
+    # Primitives are centered on their object, and wide capsules turned on their side
+    assert 'parent="Objects/5"]\nposition = Vector2( 20, 10 )\nrotation_degrees = 90.0\nshape = SubResource( 3 )' in tscn
+    assert 'parent="Objects/7"]\nposition = Vector2( 16, 8 )\nshape = SubResource( 1 )' in tscn
+    assert tscn.count("rotation_degrees") == 1
+
+    # Each zone and point overlaps the cells its bounding box does, touching a far edge doesn't count
+    grid = {(int(x), int(y)): sorted(map(int, ids.split(","))) for x, y, ids in re.findall(r"Vector2\( (-?\d+), (-?\d+) \): \[ ([\d, ]+) \]", tscn)}
+    expected = {}
+    for object_id, (points, properties, x, y, shape) in enumerate(convert.tilemap.objects):
+        if properties["type"] not in ["zone", "point"]:
+            continue
+        left, top = min([point[0] for point in points]) + x, min([point[1] for point in points]) + y
+        right, bottom = max([point[0] for point in points]) + x, max([point[1] for point in points]) + y
+        for cell_y in range(-2, 8):
+            for cell_x in range(-2, 8):
+                if left < (cell_x + 1) * 32 and cell_x * 32 < right and top < (cell_y + 1) * 32 and cell_y * 32 < bottom:
+                    expected.setdefault((cell_x, cell_y), []).append(object_id)
+    assert grid == expected
+    assert grid[(2, 0)] == [3] and grid[(0, 3)] == [7] and 8 not in sum(grid.values(), [])
+    assert '"grid_size": 32' in tscn
+
+def test_convert_and_write_records_only_when_asked(basic_map, tmp_path):
+    destinations = [str(tmp_path / "a"), str(tmp_path / "b")]
+    stages = []
+    def stage(name, function, *args, **kwargs):
+        stages.append(name)
+        return function(*args, **kwargs)
+
+    record_maps(destinations, [])
+    assert not any(exists(destination) for destination in destinations)
+
+    convert, entry = convert_and_write(basic_map, destinations, stage=stage)
+    assert stages == ["parse", "generate", "write"]
+    assert all(Manifest.FILE_NAME not in listdir(destination) for destination in destinations)
+
+    record_maps(destinations, [entry])
+    assert all(Manifest(destination).is_current(basic_map, options=convert.options) for destination in destinations)
+
+def test_manifest_skips_until_an_input_or_option_changes(basic_map, tmp_path):
+    destination = str(tmp_path / "out")
+    convert, entry = convert_and_write(basic_map, [destination])
+    record_maps([destination], [entry])
+    assert stale_maps([basic_map], [destination], options=convert.options) == []
+
+    # Touched but identical inputs are hashed, not rebuilt
+    tileset_path = join(dirname(basic_map), "a.tsx")
+    with open(tileset_path) as file:
+        text = file.read()
+    with open(tileset_path, "w") as file:
+        file.write(text)
+    assert stale_maps([basic_map], [destination], options=convert.options) == []
+    assert stale_maps([basic_map], [destination], options={**convert.options, "prune_tiles": True}) == [basic_map]
+
+    with open(tileset_path, "w") as file:
+        file.write(text.replace('name="a"', 'name="edited"'))
+    assert stale_maps([basic_map], [destination], options=convert.options) == [basic_map]
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_map_saved_while_converting_stays_out_of_date(basic_map, tmp_path, cache):
+    destination = str(tmp_path / "out")
+    cache_directory = str(tmp_path / "cache") if cache else None
+    def stage(name, function, *args, **kwargs):
+        result = function(*args, **kwargs)
+        # Renamed once the old name was read
+        if name == "parse":
+            with open(basic_map, "r+") as file:
+                text = file.read().replace('value="Basic"', 'value="Edited"')
+                file.seek(0)
+                file.write(text)
+        return result
+
+    convert, entry = convert_and_write(basic_map, [destination], cache_directory=cache_directory, stage=stage)
+    assert convert.map_name == "koth_Basic" and entry is None
+    assert stale_maps([basic_map], [destination], options=convert.options) == [basic_map]
+
+    # Neither the manifest nor the IR cache hold on to the old name
+    convert, entry = convert_and_write(basic_map, [destination], cache_directory=cache_directory)
+    assert convert.map_name == "koth_Edited"
+    record_maps([destination], [entry])
+    assert stale_maps([basic_map], [destination], options=convert.options) == []
+
+@pytest.mark.parametrize("name", ["../Basic", "sub/Basic", "sub\\Basic"])
+def test_map_names_stay_in_their_destination(basic_map, tmp_path, name):
+    with open(basic_map, "r+") as file:
+        text = file.read().replace('value="Basic"', f'value="{name}"')
+        file.seek(0)
+        file.write(text)
+    with pytest.raises(ConversionError, match="path separators"):
+        convert_and_write(basic_map, [str(tmp_path / "out")], nest=True)
+    assert not (tmp_path / "out").exists()
+
+def test_identical_images_are_left_untouched(basic_map, tmp_path):
+    source = join(dirname(basic_map), "a.png")
+    destination = str(tmp_path / "a.png")
+    # A copy of its own rather than a link, with another modification time
+    copyfile(source, destination)
+    utime(destination, ns=(1_000_000_000, 1_000_000_000))
+
+    assert not sync_file(source, destination)
+    assert stat(destination).st_mtime_ns == 1_000_000_000
+    assert not glob(destination + "*.tmp")
+
+    # A different image with the same size is still copied
+    with open(destination, "r+b") as file:
+        file.write(b"x")
+    assert sync_file(source, destination)
+    with open(source, "rb") as file, open(destination, "rb") as copy:
+        assert file.read() == copy.read()
+
+def test_images_shared_by_a_batch_sync_once(basic_map, tmp_path, monkeypatch):
+    other_map = join(dirname(basic_map), "other.tmx")
+    with open(basic_map) as file, open(other_map, "w") as other:
+        other.write(file.read().replace('value="Basic"', 'value="Other"'))
+
+    synced = []
+    sync_file = output.sync_file
+    def count_sync(source, destination):
+        synced.append(destination)
+        return sync_file(source, destination)
+    monkeypatch.setattr(output, "sync_file", count_sync)
+
+    destination = str(tmp_path / "out")
+    with ImageBatch() as images:
+        for map in [basic_map, other_map]:
+            convert_and_write(map, [destination], images=images)
+    assert sorted(synced) == [join(destination, "a.png"), join(destination, "b.png")]
+
+def test_batch_reports_errors_and_records_converted_maps(basic_map, tmp_path):
+    broken_map = join(dirname(basic_map), "broken.tmx")
+    with open(broken_map, "w") as file:
+        file.write("<map")
+    destination = str(tmp_path / "out")
+    def convert(map, images):
+        convert, entry = convert_and_write(map, [destination], images=images)
+        return {"map_name": convert.map_name, "seconds": 0.0, "entry": entry}
+
+    reported = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        submit = lambda map, images: executor.submit(convert, map, images)
+        up_to_date, results, entries = convert_batch([broken_map, basic_map], [destination], False, None, submit, report=reported.append)
+        assert up_to_date == [] and reported == results
+        assert "error" in results[0] and results[1] == {"map": basic_map, "map_name": "koth_Basic", "seconds": 0.0}
+        assert list(entries) == [basic_map] and stale_maps([basic_map], [destination]) == []
+
+        up_to_date, results, entries = convert_batch([broken_map, basic_map], [destination], False, None, submit)
+        assert up_to_date == [basic_map] and [result["map"] for result in results] == [broken_map]
+
+def test_concurrent_saves_keep_every_entry(tmp_path):
+    destination = str(tmp_path)
+    def save(index:int) -> None:
+        manifest = Manifest(destination)
+        manifest.update({"source": f"map_{index}.tmx"})
+        manifest.save()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(save, range(32)))
+    assert sorted(Manifest(destination).maps) == sorted([f"map_{index}.tmx" for index in range(32)])
+    assert not glob(join(destination, "*.tmp"))
@@ -0,0 +1,219 @@
+import gzip
+import random
+import zlib
+from base64 import b64encode
+from os.path import dirname, join
+
+import numpy as np
+import pytest
+
+from converter.core import ConversionError, SparseLayer, Tilemap, Tileset, TiledUtil
+
+class FakeTileset:
+    def __init__(self, tile_count:int) -> None:
+        self.tile_count = tile_count
+
+def baseline_tiles(gids:np.ndarray, tileset_list:list) -> np.ndarray:
+    """
+    Per tile linear scan of the original converter, where the first matching set wins
+    """
+    flags = {"000":"000", "101":"-011", "110":"011", "011":"-010", "100":"001", "111":"-001", "010":"010", "001":"-100"}
+    tiles = []
+    for tile in gids.ravel().tolist():
+        tile_byte = f"{tile:032b}"
+        rotation_value = int(flags[tile_byte[0:3]] + "0" * 29, 2)
+        tile_value = int(tile_byte[3:], 2)
+        global_tile = 0
+        for tileset, firstgid, optimized_firstgid in tileset_list:
+            if tile_value in range(firstgid, firstgid + tileset.tile_count):
+                global_tile = tile_value - firstgid + 1 + optimized_firstgid + rotation_value
+                break
+        tiles.append(global_tile)
+    return np.array(tiles, dtype=np.int64).astype(np.uint32).view(np.int32).reshape(gids.shape)
+
+def test_gids_match_baseline_for_any_tileset_order():
+    rng = np.random.default_rng(1)
+    for trial in range(100):
+        # Adjacent sets, some overlapping the next one as hva:tiles allows
+        tileset_list = []
+        firstgid = 1
+        optimized_firstgid = 0
+        for set_id in range(4):
+            tile_count = random.Random(trial * 4 + set_id).randint(1, 12)
+            tileset_list.append((FakeTileset(tile_count), firstgid, optimized_firstgid))
+            firstgid += tile_count - (set_id % 2)
+            optimized_firstgid += tile_count
+        random.Random(trial).shuffle(tileset_list)
+
+        values = rng.integers(0, firstgid + 4, size=(8, 8), dtype=np.uint32)
+        gids = values | (rng.integers(0, 8, size=(8, 8), dtype=np.uint32) << 29)
+        assert np.array_equal(TiledUtil.gids_to_tiles(gids, tileset_list), baseline_tiles(gids, tileset_list))
+
+def test_gids_outside_every_set_are_empty():
+    tileset_list = [(FakeTileset(4), 10, 0), (FakeTileset(4), 1, 4)]
+    gids = np.array([[0, 1, 5, 9, 10, 14]], dtype=np.uint32)
+    assert TiledUtil.gids_to_tiles(gids, tileset_list).tolist() == [[0, 5, 0, 0, 1, 0]]
+
+def test_csv_accepts_trailing_separator():
+    assert TiledUtil.csv_to_gids("\n1,2,\n3,4\n", (2, 2), "Ground").tolist() == [[1, 2], [3, 4]]
+    assert TiledUtil.csv_to_gids("\n1,2,\n3,4,\n", (2, 2), "Ground").tolist() == [[1, 2], [3, 4]]
+    assert TiledUtil.csv_to_gids("\n4294967295\n", (1, 1), "Ground").tolist() == [[4294967295]]
+
+@pytest.mark.parametrize("csv, error", [
+    ("\n1,2,\n3,4,\n5,6\n", "has 6 cells instead of 2x2"),
+    ("\n1,2,\n3\n", "has invalid csv data"),
+    ("\n1,2,\n3,x\n", "has invalid csv data"),
+    ("\n1,2,\n3,-4\n", "has invalid csv data"),
+    ("\n1,2,\n3,4294967296\n", "has invalid csv data"),
+])
+def test_csv_not_matching_the_layer(csv, error):
+    with pytest.raises(ConversionError, match=f'Tilemap layer "Ground" {error}'):
+        TiledUtil.csv_to_gids(csv, (2, 2), "Ground")
+
+def test_format_ints_matches_str():
+    values = np.array([0, 1, -1, 9, 10, 99, 100, -100, 65536, 2147483647, -2147483648, 1000000000, -999999999], dtype=np.int32)
+    assert TiledUtil.format_ints(values) == ", ".join(map(str, values.tolist()))
+    values = np.random.default_rng(2).integers(-2**31, 2**31, size=10000).astype(np.int32)
+    assert TiledUtil.format_ints(values) == ", ".join(map(str, values.tolist()))
+    assert TiledUtil.format_ints(np.zeros(0, dtype=np.int32)) == ""
+    assert TiledUtil.format_ints(np.zeros(3, dtype=np.int32)) == "0, 0, 0"
+
+# Layer data compressors, by Tiled's compression attribute
+COMPRESSORS = {
+    None: lambda data: data,
+    "zlib": zlib.compress,
+    "gzip": gzip.compress,
+    "zstd": lambda data: pytest.importorskip("zstandard").ZstdCompressor().compress(data),
+}
+
+@pytest.mark.parametrize("compression", COMPRESSORS)
+def test_base64_matches_csv(compression):
+    gids = np.random.default_rng(3).integers(0, 2**32, size=(5, 7), dtype=np.uint32)
+    csv = "\n" + ",\n".join([",".join(map(str, row)) for row in gids.tolist()]) + "\n"
+    data = "\n   " + b64encode(COMPRESSORS[compression](gids.astype("<u4").tobytes())).decode() + "\n  "
+    attrib = {"encoding": "base64", **({"compression": compression} if compression else {})}
+
+    expected = TiledUtil.data_to_gids(csv, {"encoding": "csv"}, gids.shape, "Ground")
+    assert np.array_equal(expected, gids)
+    assert np.array_equal(TiledUtil.data_to_gids(data, attrib, gids.shape, "Ground"), expected)
+
+def test_infinite_map_with_negative_chunks(basic_map):
+    # Chunk x, y -> 2x2 gids, as Tiled writes chunks of any size
+    chunks = {(-2, -2): [[1, 0], [0, 2]], (0, -2): [[0, 0], [0, 0]], (2, 0): [[0, 3], [17 | 0x80000000, 0]]}
+    chunk_elements = "".join([
+        f'<chunk x="{x}" y="{y}" width="2" height="2">' + ",\n".join([",".join(map(str, row)) for row in gids]) + "</chunk>"
+        for (x, y), gids in chunks.items()
+    ])
+    map_path = join(dirname(basic_map), "infinite.tmx")
+    with open(map_path, "w") as file:
+        file.write(f'''<?xml version="1.0" encoding="UTF-8"?>
+<map version="1.9" orientation="orthogonal" renderorder="right-down" width="30" height="20" tilewidth="16" tileheight="16" infinite="1">
+<properties><property name="hva:mode" value="koth"/><property name="hva:name" value="Infinite"/></properties>
+<tileset firstgid="17" source="b.tsx"/>
+<tileset firstgid="1" source="a.tsx"/>
+<layer id="1" name="Ground" width="30" height="20"><data encoding="csv">{chunk_elements}</data></layer>
+</map>''')
+
+    tilemap = Tilemap(map_path)
+    [(name, layer)] = list(tilemap.iter_layers())
+    assert name == "Ground" and isinstance(layer, SparseLayer)
+    # Empty chunks hold nothing
+    assert len(layer.chunks) == 2
+
+    xs, ys, tiles = layer.cells()
+    assert list(zip(xs.tolist(), ys.tolist())) == [(-2, -2), (-1, -1), (3, 0), (2, 1)]
+    # Godot keys keep 16 bits of each coordinate
+    assert TiledUtil.cell_keys(xs, ys).tolist() == [-65538, -1, 3, 65538]
+    expected = TiledUtil.gids_to_tiles(np.array([1, 2, 3, 17 | 0x80000000], dtype=np.uint32), tilemap.tileset_list)
+    assert tiles.tolist() == expected.tolist()
+
+def test_tileset_cache_follows_the_tsx(basic_map):
+    tileset_path = join(dirname(basic_map), "a.tsx")
+    tileset = Tileset.load(tileset_path)
+    assert Tileset.load(tileset_path) is tileset
+    assert Tilemap(basic_map).tileset_list[1][0] is tileset
+
+    with open(tileset_path, "r+") as file:
+        text = file.read().replace('tilecount="16"', 'tilecount="9"')
+        file.seek(0)
+        file.write(text)
+        file.truncate()
+    changed = Tileset.load(tileset_path)
+    assert changed is not tileset and changed.tile_count == 9
+    assert Tilemap(basic_map).tileset_list[1][0] is changed
+
+def polygon_area(points:tuple) -> int:
+    """
+    Twice the signed area of a polygon
+    """
+    return sum([points[i - 1][0] * points[i][1] - points[i][0] * points[i - 1][1] for i in range(len(points))])
+
+@pytest.mark.parametrize("points", [
+    # L, comb and arrow, in either orientation
+    ((0, 0), (16, 0), (16, 8), (8, 8), (8, 16), (0, 16)),
+    ((0, 0), (24, 0), (24, 16), (20, 16), (20, 4), (14, 4), (14, 16), (10, 16), (10, 4), (4, 4), (4, 16), (0, 16)),
+    ((0, 8), (8, 0), (16, 8), (8, 4)),
+    ((0, 16), (8, 16), (8, 8), (16, 8), (16, 0), (0, 0)),
+])
+def test_convex_parts_cover_concave_polygons(points):
+    parts = TiledUtil.convex_parts(points)
+    assert len(parts) > 1
+    assert sum([polygon_area(part) for part in parts]) == polygon_area(points)
+    for part in parts:
+        # Same orientation as the polygon
+        oriented = part if polygon_area(points) > 0 else tuple(reversed(part))
+        assert TiledUtil.is_convex(list(oriented))
+        assert set(part) <= set(points)
+
+def test_convex_polygons_stay_whole():
+    square = ((0, 0), (16, 0), (16, 16), (0, 16))
+    assert TiledUtil.convex_parts(square) == (square,)
+
+def test_chunks_cover_every_cell_once():
+    rng = np.random.default_rng(4)
+    # Distinct cells around the origin, so chunks on both sides of it
+    cells = rng.choice(80 * 80, size=500, replace=False)
+    xs, ys = (cells % 80 - 40).astype(np.int32), (cells // 80 - 40).astype(np.int32)
+    tiles = rng.integers(1, 100, size=xs.size).astype(np.int32)
+
+    covered = []
+    for chunk_x, chunk_y, chunk_xs, chunk_ys, chunk_tiles in TiledUtil.split_chunks(xs, ys, tiles, 16):
+        assert chunk_xs.size and chunk_xs.min() >= 0 and chunk_ys.min() >= 0 and chunk_xs.max() < 16 and chunk_ys.max() < 16
+        covered += zip((chunk_xs + chunk_x * 16).tolist(), (chunk_ys + chunk_y * 16).tolist(), chunk_tiles.tolist())
+    # The cells are distinct, so matching them means each is covered once
+    assert sorted(covered) == sorted(zip(xs.tolist(), ys.tolist(), tiles.tolist()))
+
+def test_merged_rectangles_cover_every_cell_once():
+    rng = np.random.default_rng(5)
+    cells = rng.choice(40 * 40, size=900, replace=False)
+    xs, ys = (cells % 40 - 20).astype(np.int32), (cells // 40 - 20).astype(np.int32)
+
+    rectangles = TiledUtil.merge_rectangles(xs, ys)
+    assert len(rectangles) < xs.size
+    covered = []
+    for x, y, width, height in rectangles:
+        covered += [(x + i, y + j) for j in range(height) for i in range(width)]
+    assert sorted(covered) == sorted(zip(xs.tolist(), ys.tolist()))
+
+def test_merged_rectangles_of_sparse_cells():
+    # A mask over the bounding box of these cells would need 16 TB
+    xs = np.array([-4_000_000, -3_999_999, 4_000_000, -4_000_000, -3_999_999], dtype=np.int32)
+    ys = np.array([-4_000_000, -4_000_000, 4_000_000, -3_999_999, -3_999_999], dtype=np.int32)
+    assert TiledUtil.merge_rectangles(xs, ys) == [(-4_000_000, -4_000_000, 2, 2), (4_000_000, 4_000_000, 1, 1)]
+
+def test_objects_load_without_parsing_layers(basic_map):
+    # Markup the scan has to step over: a comment, a quoted ">", entities and an object layer inside a group
+    nested = '''<!-- <objectgroup name="Commented"> --><group id="5" name="Nested"><objectgroup id="6" name="Inner">
+<object id="9" x="0" y="0" width="8" height="8"><properties><property name="type" value="zone"/></properties></object>
+</objectgroup></group>'''
+    with open(basic_map, "r+") as file:
+        text = file.read().replace('<layer id="2"', nested + '<layer id="2"')
+        text = text.replace('value="defense"', 'value="a > b &amp; &quot;c&quot;"')
+        file.seek(0)
+        file.write(text)
+
+    tilemap = Tilemap(basic_map)
+    objects = tilemap.load_objects()
+    list(tilemap.iter_layers())
+    assert objects == tilemap.objects and len(objects) == 3
+    assert objects[2][1]["team"] == 'a > b & "c"'